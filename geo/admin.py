@@ -1,15 +1,73 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.db import transaction
+from django.template.response import TemplateResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 
-from .models import Asignatura, Calendario, Categoria, Curso, Pod, ProfesorCurso
+from .aprovisionamiento import aprovisionar_varios
+from .borrado import borrar_en_segundo_plano, contar
+from .models import (
+    Asignatura,
+    Calendario,
+    Categoria,
+    Curso,
+    OperacionMoodle,
+    Pod,
+    ProfesorCurso,
+    Tarea,
+)
+from .operaciones import encolar_varias, grupo_curso, rechazo
 
 # Register your models here.
 
-admin.site.register(Asignatura)
 admin.site.register(Categoria)
 admin.site.register(Pod)
 
 
+@admin.register(Asignatura)
+class AsignaturaAdmin(admin.ModelAdmin):
+    actions = ['crear_cursos']
+    list_display = (
+        'id',
+        'anyo_academico',
+        'centro_id',
+        'plan_id_nk',
+        'asignatura_id',
+        'cod_grupo_asignatura',
+        'nombre_asignatura',
+    )
+    list_filter = ('anyo_academico', 'nombre_centro', 'nombre_estudio')
+    search_fields = ('nombre_asignatura', '=asignatura_id', '=plan_id_nk', '=centro_id')
+
+    def has_crear_cursos_permission(self, request):
+        return request.user.has_perm('geo.curso_administrar')
+
+    @admin.action(
+        description=_('Crear en Moodle los cursos de las asignaturas seleccionadas'),
+        permissions=['crear_cursos'],
+    )
+    def crear_cursos(self, request, queryset):
+        tarea, num_omitidas = aprovisionar_varios(queryset, request.user)
+        if num_omitidas:
+            self.message_user(
+                request,
+                _('%(num)s asignaturas ya tenían curso.') % {'num': num_omitidas},
+                messages.WARNING,
+            )
+        if tarea:
+            self.message_user(
+                request,
+                format_html(
+                    _('Se están creando los cursos en segundo plano: <a href="{}">tarea {}</a>.'),
+                    reverse('admin:geo_tarea_change', args=[tarea.id]),
+                    tarea.id,
+                ),
+            )
+
+
 @admin.register(Curso)
 class CursoAdmin(admin.ModelAdmin):
     list_display = ('id', 'curso_academico', 'nombre', 'id_nk', 'estado')
@@ -24,6 +82,40 @@ class CursoAdmin(admin.ModelAdmin):
     )
     ordering = ('estado', 'nombre')
     readonly_fields = ('estado', 'fecha_solicitud', 'motivo_solicitud', 'comentarios')
+    actions = ['borrar_cursos']
+
+    def has_borrar_cursos_permission(self, request):
+        return request.user.has_perm('geo.curso_delete')
+
+    @admin.action(
+        description=_('Borrar los cursos seleccionados, también en Moodle'),
+        permissions=['borrar_cursos'],
+    )
+    def borrar_cursos(self, request, queryset):
+        if not request.POST.get('post'):
+            # Primero se muestra cuánto se va a borrar, y se pide confirmación.
+            return TemplateResponse(
+                request,
+                'admin/geo/curso/borrar_cursos.html',
+                {
+                    **self.admin_site.each_context(request),
+                    'title': _('Borrar cursos'),
+                    'opts': self.model._meta,
+                    'queryset': queryset,
+                    'cuenta': contar(queryset),
+                    'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+                },
+            )
+
+        tarea = borrar_en_segundo_plano(queryset, request.user)
+        self.message_user(
+            request,
+            format_html(
+                _('Se están borrando los cursos en segundo plano: <a href="{}">tarea {}</a>.'),
+                reverse('admin:geo_tarea_change', args=[tarea.id]),
+                tarea.id,
+            ),
+        )
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == 'categoria':
@@ -43,9 +135,121 @@ class ProfesorCursoAdmin(admin.ModelAdmin):
     ordering = ('profesor', 'curso')
     readonly_fields = ('profesor', 'curso', 'fecha_alta')
 
+    actions = ['dar_de_baja']
+
     def nombre_profesor(self, obj):
         return obj.profesor.full_name
 
+    def has_anular_permission(self, request):
+        return request.user.has_perm('geo.pc_anular')
+
+    @admin.action(
+        description=_('Dar de baja en Moodle a los profesores seleccionados'),
+        permissions=['anular'],
+    )
+    def dar_de_baja(self, request, queryset):
+        asignaciones = list(
+            queryset.filter(fecha_baja=None, curso__id_nk__isnull=False).select_related(
+                'profesor', 'curso'
+            )
+        )
+        # Se guardan las bajas y las desmatriculaciones en Moodle a la vez,
+        # y se deshacen las bajas que Moodle rechace.
+        with transaction.atomic(durable=True):
+            ProfesorCurso.objects.filter(pk__in=[a.pk for a in asignaciones]).update(
+                fecha_baja=timezone.now()
+            )
+            operaciones = encolar_varias(
+                OperacionMoodle.Tipo.DESMATRICULAR,
+                [{'usuario_id': a.profesor_id, 'curso_id': a.curso_id} for a in asignaciones],
+                grupo=[grupo_curso(a.curso) for a in asignaciones],
+            )
+
+        rechazadas = []
+        for asignacion, operacion in zip(asignaciones, operaciones):
+            error = rechazo(operacion)
+            if error:
+                rechazadas.append(asignacion.pk)
+                self.message_user(
+                    request,
+                    _('ERROR al dar de baja a %(profesor)s en %(curso)s: %(error)s')
+                    % {'profesor': asignacion.profesor, 'curso': asignacion.curso, 'error': error},
+                    messages.ERROR,
+                )
+        ProfesorCurso.objects.filter(pk__in=rechazadas).update(fecha_baja=None)
+
+        num_pendientes = sum(
+            1 for operacion in operaciones if operacion.estado == OperacionMoodle.Estado.PENDIENTE
+        )
+        if num_pendientes:
+            self.message_user(
+                request,
+                _(
+                    'Moodle no está disponible en este momento. %(num)s bajas se aplicarán'
+                    ' automáticamente en Moodle en cuanto vuelva a estarlo.'
+                )
+                % {'num': num_pendientes},
+                messages.WARNING,
+            )
+        self.message_user(
+            request,
+            _('Dados de baja %(num)s profesores.') % {'num': len(asignaciones) - len(rechazadas)},
+        )
+
+
+@admin.register(OperacionMoodle)
+class OperacionMoodleAdmin(admin.ModelAdmin):
+    actions = ['reintentar']
+    date_hierarchy = 'fecha_creacion'
+    list_display = (
+        'id',
+        'tipo',
+        'datos',
+        'grupo',
+        'estado',
+        'intentos',
+        'proximo_intento',
+        'error',
+    )
+    list_filter = ('estado', 'tipo')
+    readonly_fields = ('fecha_creacion', 'fecha_envio')
+
+    @admin.action(description=_('Reintentar el envío a Moodle lo antes posible'))
+    def reintentar(self, request, queryset):
+        num = queryset.exclude(estado=OperacionMoodle.Estado.ENVIADA).update(
+            estado=OperacionMoodle.Estado.PENDIENTE, proximo_intento=timezone.now()
+        )
+        self.message_user(request, _('Se reintentarán %(num)s operaciones.') % {'num': num})
+
+
+@admin.register(Tarea)
+class TareaAdmin(admin.ModelAdmin):
+    actions = ['reintentar']
+    date_hierarchy = 'fecha_creacion'
+    list_display = (
+        'id',
+        'nombre',
+        'prioridad',
+        'estado',
+        'intentos',
+        'progreso',
+        'usuario',
+        'fecha_creacion',
+        'fecha_fin',
+    )
+    list_filter = ('estado', 'nombre', 'prioridad')
+    readonly_fields = ('trabajador', 'fecha_creacion', 'fecha_inicio', 'fecha_fin')
+
+    @admin.action(description=_('Volver a ejecutar las tareas fallidas'))
+    def reintentar(self, request, queryset):
+        num = queryset.filter(estado=Tarea.Estado.FALLIDA).update(
+            estado=Tarea.Estado.PENDIENTE,
+            intentos=0,
+            disponible_desde=timezone.now(),
+            fecha_fin=None,
+        )
+        self.message_user(request, _('Se volverán a ejecutar %(num)s tareas.') % {'num': num})
+
 
 admin.site.site_header = _('Administración de Geoda')
 admin.site.site_title = _('Administración de Geoda')
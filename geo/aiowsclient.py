@@ -0,0 +1,86 @@
+# standard library
+import asyncio
+import copy
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# third-party libraries
+from annoying.functions import get_config
+
+# Local Django
+from .wsclient import WSClient, trocear
+
+
+class AsyncWSClient:
+    """Versión asíncrona de `WSClient`, con los mismos métodos pero como corrutinas.
+
+    Cada llamada se ejecuta con el cliente síncrono en un hilo propio del cliente asíncrono,
+    de modo que se comparten el pool de conexiones, los reintentos, el circuit breaker
+    y la caché de usuarios.  Como mucho hay `concurrencia` llamadas en curso a la vez:
+    dentro de cada una, los lotes se envían uno tras otro, sin abrir otros `WS_HILOS` hilos.
+
+    Ejemplo de uso en una orden de consola:
+
+        with AsyncWSClient() as cliente:
+            nips_por_curso = asyncio.run(cliente.buscar_nips_matriculados_en_cursos(cursos))
+    """
+
+    def __init__(self, concurrencia=None, cliente=None):
+        # Una copia del cliente, con su misma sesión, que no envía lotes en paralelo.
+        self.cliente = copy.copy(cliente or WSClient())
+        self.cliente.hilos = 1
+        self.concurrencia = concurrencia or get_config('WS_CONCURRENCIA', 8)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.concurrencia, thread_name_prefix='AsyncWSClient'
+        )
+
+    def __getattr__(self, nombre):
+        metodo = getattr(self.cliente, nombre)
+        if nombre.startswith('_') or not callable(metodo):
+            return metodo
+
+        @functools.wraps(metodo)
+        async def corrutina(*args, **kwargs):
+            bucle = asyncio.get_running_loop()
+            return await bucle.run_in_executor(
+                self._executor, functools.partial(metodo, *args, **kwargs)
+            )
+
+        return corrutina
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cerrar()
+
+    def cerrar(self):
+        """Libera los hilos del cliente."""
+        self._executor.shutdown(wait=False)
+
+    async def reunir(self, corrutinas):
+        """Ejecuta simultáneamente las corrutinas indicadas.
+
+        Devuelve sus resultados en el mismo orden.  Si alguna falla,
+        en su posición se devuelve la excepción, sin interrumpir a las demás.
+        """
+        return await asyncio.gather(*corrutinas, return_exceptions=True)
+
+    async def buscar_nips_matriculados_en_cursos(self, cursos):
+        """Devuelve un diccionario con los NIPs matriculados en cada curso (o la excepción)."""
+        resultados = await self.reunir(self.buscar_nips_matriculados(curso) for curso in cursos)
+        return dict(zip((curso.id_nk for curso in cursos), resultados))
+
+    async def buscar_usuarios_nips(self, nips):
+        """Busca en Moodle los usuarios de los NIPs indicados, enviando varios lotes a la vez.
+
+        Devuelve los usuarios encontrados y la lista de NIPs no encontrados.
+        """
+        lotes = trocear(dict.fromkeys(str(nip).strip() for nip in nips), self.tamanyo_lote)
+        usuarios, no_encontrados = [], []
+        for resultado in await self.reunir(self.buscar_usuarios_nip(lote) for lote in lotes):
+            if isinstance(resultado, Exception):
+                raise resultado
+            usuarios.extend(resultado[0])
+            no_encontrados.extend(resultado[1])
+        return usuarios, no_encontrados
@@ -1,10 +1,11 @@
 from django.contrib.auth.models import Group
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from ninja import NinjaAPI
 
-from .models import Asignatura, Calendario, MatriculaAutomatica
-from .schema import AsignaturaSchema, NotFoundSchema
-from .utils import matricular_grupo_sigma
+from .models import Asignatura, Calendario, MatriculaAutomatica, Tarea
+from .schema import AsignaturaSchema, NotFoundSchema, TareaSchema
+from .utils import matricular_en_segundo_plano
 
 api = NinjaAPI()
 
@@ -47,16 +48,44 @@ def toggle_matricula_automatica(request, registro_id: int):
     if request.user not in profesores_del_curso and request.user not in gestores:
         return 403, None  # Forbidden
 
-    ma.active = not ma.active
-    ma.save()
-
-    num_matriculados = 0
-    if ma.active:
-        num_matriculados = matricular_grupo_sigma(
-            ma.courseid, ma.asignatura_nk, ma.cod_grupo_asignatura, ma.centro_id, ma.plan_id
-        )
+    # Los estudiantes se matriculan en segundo plano: el navegador consulta la tarea
+    # en `/api/tareas/{tarea_id}` para saber cuántos se han matriculado.
+    tarea = None
+    with transaction.atomic():
+        ma.active = not ma.active
+        ma.save()
+        if ma.active:
+            tarea = matricular_en_segundo_plano(ma, request.user)
 
     return 200, {
-        'num_matriculados': num_matriculados,
         'queda_activado': ma.active,
+        'tarea_id': tarea.id if tarea else None,
     }  # OK
+
+
+@api.get('/tareas/{tarea_id}', response={200: TareaSchema, 403: None, 404: NotFoundSchema})
+def estado_tarea(request, tarea_id: int):
+    """Devuelve el estado de una tarea en segundo plano"""
+    try:
+        tarea = Tarea.objects.get(pk=tarea_id)
+    except Tarea.DoesNotExist:
+        return 404, {'message': 'No se encontró esa tarea.'}
+
+    if not _puede_ver_tarea(request.user, tarea):
+        return 403, None  # Forbidden
+
+    return 200, tarea
+
+
+def _puede_ver_tarea(usuario, tarea):
+    if not usuario.is_authenticated:
+        return False
+    if (
+        tarea.usuario_id == usuario.id
+        or usuario.is_staff
+        or usuario.groups.filter(name='Gestores').exists()
+    ):
+        return True
+    # Las tareas de un curso (crearlo, matricular a sus estudiantes) se muestran en la página
+    # del curso, que puede ver cualquier usuario identificado, no sólo quien las solicitó.
+    return 'curso_id' in tarea.parametros or 'registro_id' in tarea.parametros
@@ -0,0 +1,426 @@
+"""Creación en segundo plano de los cursos de asignaturas Sigma.
+
+`ASCrearCursoView` sólo guarda el curso en Geoda y encola la tarea `aprovisionar_curso`,
+que realiza los pasos de `PASOS`.  Cada paso comprueba en la base de datos si ya se hizo
+en un intento anterior, de modo que si la tarea falla, al reintentarla se reanuda
+por el paso en el que se quedó.
+
+Los gestores pueden además crear de una vez los cursos de muchas asignaturas
+(p. ej. de varios planes o centros) con la tarea `aprovisionar_cursos`,
+que hace lo mismo para todas a la vez: crea los cursos en Moodle en lotes,
+y los registros en Geoda con una consulta por tabla.
+"""
+
+# Django
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+# Local Django
+from .models import (
+    Asignatura,
+    Categoria,
+    Curso,
+    MatriculaAutomatica,
+    OperacionMoodle,
+    Plan,
+    Pod,
+    ProfesorCurso,
+    Tarea,
+)
+from .operaciones import OperacionAplazada, encolar_varias, grupo_curso, rechazo
+from .tareas import encolar_tarea, informar_progreso, registrar_tarea
+from .wsclient import WSClient
+
+NOMBRE_TAREA = 'aprovisionar_curso'
+NOMBRE_TAREA_VARIOS = 'aprovisionar_cursos'
+
+
+def aprovisionar(curso, usuario):
+    """Encola la creación en Moodle del curso, y devuelve la tarea."""
+    return encolar_tarea(
+        NOMBRE_TAREA, {'curso_id': curso.id, 'usuario_id': usuario.id}, usuario=usuario
+    )
+
+
+def ultima_tarea(curso):
+    """Devuelve la última tarea de creación del curso, o `None` si no tiene."""
+    return (
+        Tarea.objects.filter(nombre=NOMBRE_TAREA, parametros__curso_id=curso.id)
+        .order_by('-id')
+        .first()
+    )
+
+
+@registrar_tarea(NOMBRE_TAREA, max_intentos=5, visibilidad=10 * 60, prioridad=Tarea.Prioridad.ALTA)
+def aprovisionar_curso(curso_id, usuario_id):
+    """Crea el curso en Moodle, y matricula a su profesorado.
+
+    Devuelve los avisos de los pasos que no se pudieron completar,
+    pero que no impiden usar el curso.
+    """
+    curso = Curso.objects.select_related('asignatura', 'categoria').get(pk=curso_id)
+    solicitante = get_user_model().objects.get(pk=usuario_id)
+    avisos = []
+    for num, (descripcion, paso) in enumerate(PASOS, start=1):
+        informar_progreso(
+            _('Paso %(num)s de %(total)s: %(paso)s')
+            % {'num': num, 'total': len(PASOS), 'paso': descripcion}
+        )
+        avisos += paso(curso, solicitante) or []
+    return {'avisos': avisos}
+
+
+def _crear_categoria(curso, _solicitante):
+    if not curso.categoria:
+        # Puede crear la categoría (y sus categorías superiores) en Moodle.
+        curso.categoria = curso.asignatura.get_categoria()
+        curso.save(update_fields=['categoria'])
+
+    categoria = curso.categoria
+    if not categoria.id_nk:
+        categoria.crear_en_plataforma()
+    if not categoria.id_nk:
+        raise OperacionAplazada(_('La categoría del curso todavía no se ha creado en Moodle.'))
+
+
+def _crear_curso(curso, _solicitante):
+    if curso.id_nk:
+        return
+
+    cliente = WSClient()
+    # Si otro intento (de esta tarea, o una creación anterior que falló) llegó a crearlo
+    # pero no recibimos la respuesta, no lo duplicamos.
+    existentes = cliente.buscar_cursos('idnumber', curso.id)
+    datos_recibidos = existentes[0] if existentes else cliente.crear_curso(curso.get_datos())
+    curso.actualizar_tras_creacion(datos_recibidos)
+
+
+def _crear_matricula_automatica(curso, _solicitante):
+    """Crea el registro desactivado en la tabla `matricula_automatica` local."""
+    if MatriculaAutomatica.objects.filter(curso=curso).exists():
+        return None
+
+    asignatura = curso.asignatura
+    try:
+        MatriculaAutomatica.objects.create(
+            courseid=curso.id_nk,
+            asignatura_nk=asignatura.asignatura_id,  # Cód. Sigma de la asignatura
+            cod_grupo_asignatura=asignatura.cod_grupo_asignatura,
+            centro_id=asignatura.centro_id,
+            plan_id=asignatura.plan_id_nk,
+            active=False,
+            fijo=True,
+            curso_id=curso.id,
+        )
+    except Exception as ex:
+        return [_('No fue posible crear el registro de matrícula automática. %s') % ex]
+    return None
+
+
+def _matricular_profesores(curso, solicitante):
+    """Matricula primero al solicitante, y luego a los demás profesores según el POD."""
+    profesores = sorted(curso.asignatura.get_profesores(), key=lambda p: p.username)
+    profesores = [solicitante] + [p for p in profesores if p != solicitante]
+    ya_anyadidos = set(
+        ProfesorCurso.objects.filter(curso=curso).values_list('profesor_id', flat=True)
+    )
+    profesores = [p for p in profesores if p.id not in ya_anyadidos]
+
+    return [
+        _('No se pudo matricular a %(profesor)s: %(ex)s')
+        % {'profesor': profesor.full_name, 'ex': error}
+        for profesor, (_pc, error) in zip(profesores, curso.anyadir_profesores(profesores))
+        if error
+    ]
+
+
+PASOS = (
+    (_('Creando la categoría en Moodle'), _crear_categoria),
+    (_('Creando el curso en Moodle'), _crear_curso),
+    (_('Creando el registro de matrícula automática'), _crear_matricula_automatica),
+    (_('Matriculando al profesorado'), _matricular_profesores),
+)
+
+
+def aprovisionar_varios(asignaturas, usuario):
+    """Encola la creación de los cursos de las asignaturas que todavía no tienen.
+
+    Devuelve la tarea (o `None` si todas tenían ya curso), y el número de asignaturas omitidas.
+    """
+    pendientes, num_omitidas = sin_curso(asignaturas)
+    if not pendientes:
+        return None, num_omitidas
+    tarea = encolar_tarea(
+        NOMBRE_TAREA_VARIOS,
+        {'asignatura_ids': pendientes, 'usuario_id': usuario.id},
+        usuario=usuario,
+    )
+    return tarea, num_omitidas
+
+
+def sin_curso(asignaturas):
+    """Devuelve los `id` de las asignaturas sin curso creado, y el número de las que lo tienen."""
+    ids = set(asignaturas.values_list('id', flat=True))
+    con_curso = set(
+        Curso.objects.filter(asignatura_id__in=ids, estado=Curso.Estado.CREADO).values_list(
+            'asignatura_id', flat=True
+        )
+    )
+    return sorted(ids - con_curso), len(con_curso)
+
+
+@registrar_tarea(
+    NOMBRE_TAREA_VARIOS, max_intentos=5, visibilidad=30 * 60, prioridad=Tarea.Prioridad.BAJA
+)
+def aprovisionar_cursos(asignatura_ids, usuario_id):
+    """Crea los cursos de varias asignaturas, en Geoda y en Moodle, y matricula a su profesorado.
+
+    Devuelve el resultado de cada asignatura: el curso creado, o el error que lo impidió,
+    y los avisos de los pasos que no se pudieron completar.
+    """
+    solicitante = get_user_model().objects.get(pk=usuario_id)
+    asignaturas = list(Asignatura.objects.filter(pk__in=asignatura_ids).order_by('id'))
+    filas = {
+        asignatura.id: {
+            'asignatura': asignatura.get_shortname(),
+            'curso_id': None,
+            'error': None,
+            'avisos': [],
+        }
+        for asignatura in asignaturas
+    }
+
+    planes = set(
+        Plan.objects.filter(id__in={a.plan_id_nk for a in asignaturas}).values_list(
+            'id', flat=True
+        )
+    )
+    for asignatura in asignaturas:
+        if asignatura.plan_id_nk not in planes:
+            filas[asignatura.id]['error'] = str(
+                _('No se encontró el plan %d en la tabla de planes de GEO.')
+                % asignatura.plan_id_nk
+            )
+    asignaturas = [asignatura for asignatura in asignaturas if asignatura.plan_id_nk in planes]
+
+    informar_progreso(_('Creando las categorías en Moodle'))
+    indice = _crear_categorias_varias(asignaturas)
+
+    informar_progreso(_('Guardando los cursos en Geoda'))
+    cursos = _guardar_cursos(asignaturas, indice, solicitante, filas)
+
+    informar_progreso(_('Creando %(num)s cursos en Moodle') % {'num': len(cursos)})
+    _crear_cursos(cursos, filas)
+
+    creados = [curso for curso in cursos if curso.estado == Curso.Estado.CREADO]
+    informar_progreso(_('Creando los registros de matrícula automática'))
+    _crear_matriculas_automaticas(creados, filas)
+
+    informar_progreso(_('Matriculando al profesorado'))
+    _matricular_profesores_varios(creados, filas)
+
+    return {
+        'num_creados': len(creados),
+        'num_errores': sum(1 for fila in filas.values() if fila['error']),
+        'filas': list(filas.values()),
+    }
+
+
+def _crear_categorias_varias(asignaturas):
+    """Crea las categorías que falten, y devuelve un índice {(año, centro, plan): categoría}."""
+    indice, errores = {}, []
+    for anyo in {asignatura.anyo_academico for asignatura in asignaturas}:
+        arbol, errores_anyo = Categoria.crear_arbol(anyo)
+        indice.update(
+            {(anyo, centro_id, plan_id_nk): cat for (centro_id, plan_id_nk), cat in arbol.items()}
+        )
+        errores += errores_anyo
+    if any(not indice[_clave_categoria(asignatura)].id_nk for asignatura in asignaturas):
+        if errores:
+            raise Exception('; '.join(errores))
+        raise OperacionAplazada(_('Todavía no se han creado en Moodle todas las categorías.'))
+    return indice
+
+
+def _clave_categoria(asignatura):
+    return (asignatura.anyo_academico, asignatura.centro_id, asignatura.plan_id_nk)
+
+
+def _guardar_cursos(asignaturas, indice, solicitante, filas):
+    """Crea en Geoda los cursos que falten, y devuelve los de las asignaturas.
+
+    Se omiten los que se están creando a la vez desde la ficha de la asignatura.
+    """
+    ahora = timezone.now()
+    Curso.objects.bulk_create(
+        [
+            Curso(
+                nombre=asignatura.nombre_asignatura,
+                solicitante=solicitante,
+                fecha_solicitud=ahora,
+                # Las asignaturas Sigm@ se aprueban automáticamente, por el administrador.
+                fecha_autorizacion=ahora,
+                autorizador_id=1,
+                plataforma_id=1,
+                categoria=indice[_clave_categoria(asignatura)],
+                anyo_academico=asignatura.anyo_academico,
+                asignatura_id=asignatura.id,
+                estado=Curso.Estado.AUTORIZADO,
+            )
+            for asignatura in asignaturas
+        ],
+        ignore_conflicts=True,  # Las asignaturas que ya tienen curso
+    )
+    cursos = list(
+        Curso.objects.filter(asignatura__in=asignaturas)
+        .select_related('asignatura', 'categoria')
+        .order_by('id')
+    )
+    # Los cursos de intentos fallidos desde la ficha de la asignatura pueden no tener categoría.
+    sin_categoria = [curso for curso in cursos if not curso.categoria]
+    for curso in sin_categoria:
+        curso.categoria = indice[_clave_categoria(curso.asignatura)]
+    Curso.objects.bulk_update(sin_categoria, ['categoria'])
+
+    en_curso = set(
+        Tarea.objects.filter(
+            nombre=NOMBRE_TAREA,
+            parametros__curso_id__in=[curso.id for curso in cursos],
+            estado__in=(Tarea.Estado.PENDIENTE, Tarea.Estado.EN_CURSO),
+        ).values_list('parametros__curso_id', flat=True)
+    )
+    for curso in cursos:
+        filas[curso.asignatura_id]['curso_id'] = curso.id
+        if curso.id in en_curso:
+            filas[curso.asignatura_id]['error'] = str(
+                _('El curso se está creando desde la ficha de la asignatura.')
+            )
+    return [curso for curso in cursos if curso.id not in en_curso]
+
+
+def _crear_cursos(cursos, filas):
+    """Crea en Moodle los cursos que todavía no existen, en lotes."""
+    pendientes = [curso for curso in cursos if not curso.id_nk]
+    if not pendientes:
+        return
+    cliente = WSClient()
+
+    # Si otro intento llegó a crearlos pero no recibimos la respuesta, no los duplicamos.
+    # Para ello se consultan los cursos de cada categoría, una sola vez.
+    existentes = {}
+    for categoria_id_nk in {curso.categoria.id_nk for curso in pendientes}:
+        for datos in cliente.buscar_cursos('category', categoria_id_nk):
+            existentes[datos['idnumber']] = datos
+    nuevos = [curso for curso in pendientes if str(curso.id) not in existentes]
+    respuestas = dict(zip(nuevos, cliente.crear_cursos([curso.get_datos() for curso in nuevos])))
+
+    for curso in pendientes:
+        respuesta = respuestas.get(curso) or existentes[str(curso.id)]
+        if isinstance(respuesta, Exception):
+            filas[curso.asignatura_id]['error'] = str(respuesta)
+        else:
+            curso.actualizar_tras_creacion(respuesta, guardar=False)
+    Curso.objects.bulk_update(
+        [curso for curso in pendientes if curso.id_nk],
+        ['id_nk', 'fecha_creacion', 'url', 'estado'],
+    )
+
+
+def _crear_matriculas_automaticas(cursos, filas):
+    """Crea los registros desactivados en la tabla `matricula_automatica` que falten."""
+    con_registro = set(
+        MatriculaAutomatica.objects.filter(curso__in=cursos).values_list('curso_id', flat=True)
+    )
+    registros = [
+        MatriculaAutomatica(
+            courseid=curso.id_nk,
+            asignatura_nk=curso.asignatura.asignatura_id,  # Cód. Sigma de la asignatura
+            cod_grupo_asignatura=curso.asignatura.cod_grupo_asignatura,
+            centro_id=curso.asignatura.centro_id,
+            plan_id=curso.asignatura.plan_id_nk,
+            active=False,
+            fijo=True,
+            curso_id=curso.id,
+        )
+        for curso in cursos
+        if curso.id not in con_registro
+    ]
+    try:
+        with transaction.atomic():
+            MatriculaAutomatica.objects.bulk_create(registros)
+        return
+    except Exception:
+        pass
+
+    # Si falla alguno, los creamos uno a uno, para saber cuáles fallan.
+    asignatura_de_curso = {curso.id: curso.asignatura_id for curso in cursos}
+    for registro in registros:
+        try:
+            with transaction.atomic():
+                registro.save()
+        except Exception as ex:
+            filas[asignatura_de_curso[registro.curso_id]]['avisos'].append(
+                str(_('No fue posible crear el registro de matrícula automática. %s') % ex)
+            )
+
+
+def _matricular_profesores_varios(cursos, filas):
+    """Añade a cada curso los profesores del POD que falten, y los matricula a todos a la vez."""
+    User = get_user_model()
+    asignaturas = [curso.asignatura for curso in cursos]
+    nips_de_grupo = {}
+    for pod in Pod.objects.filter(
+        anyo_academico__in={a.anyo_academico for a in asignaturas},
+        asignatura_id__in={a.asignatura_id for a in asignaturas},
+    ):
+        clave = (
+            pod.anyo_academico,
+            pod.asignatura_id,
+            pod.cod_grupo_asignatura,
+            pod.centro_id,
+            pod.plan_id_nk,
+        )
+        nips_de_grupo.setdefault(clave, set()).add(pod.nip)
+    usuarios = User.objects.in_bulk(set().union(*nips_de_grupo.values()), field_name='username')
+    ya_anyadidos = set(
+        ProfesorCurso.objects.filter(curso__in=cursos).values_list('curso_id', 'profesor_id')
+    )
+
+    asignaciones = []
+    for curso in cursos:
+        a = curso.asignatura
+        nips = nips_de_grupo.get(
+            (a.anyo_academico, a.asignatura_id, a.cod_grupo_asignatura, a.centro_id, a.plan_id_nk),
+            (),
+        )
+        # Si llegara una asignación a un NIP que no exista en la tabla de usuarios, la omitimos.
+        for nip in sorted(nip for nip in nips if nip in usuarios):
+            if (curso.id, usuarios[nip].id) not in ya_anyadidos:
+                asignaciones.append(ProfesorCurso(curso=curso, profesor=usuarios[nip]))
+
+    ahora = timezone.now()
+    for asignacion in asignaciones:
+        asignacion.fecha_alta = ahora
+    with transaction.atomic(durable=True):
+        ProfesorCurso.objects.bulk_create(asignaciones)
+        operaciones = encolar_varias(
+            OperacionMoodle.Tipo.MATRICULAR_PROFESOR,
+            [{'usuario_id': pc.profesor_id, 'curso_id': pc.curso_id} for pc in asignaciones],
+            grupo=[grupo_curso(pc.curso) for pc in asignaciones],
+        )
+    # Los profesores que Moodle ha rechazado no quedan asignados al curso.
+    errores = [rechazo(operacion) for operacion in operaciones]
+    ProfesorCurso.objects.filter(
+        pk__in=[pc.pk for pc, error in zip(asignaciones, errores) if error]
+    ).delete()
+
+    for asignacion, error in zip(asignaciones, errores):
+        if error:
+            filas[asignacion.curso.asignatura_id]['avisos'].append(
+                str(
+                    _('No se pudo matricular a %(profesor)s: %(ex)s')
+                    % {'profesor': asignacion.profesor.full_name, 'ex': error}
+                )
+            )
@@ -0,0 +1,104 @@
+"""Borrado por lotes de los cursos de años pasados.
+
+Los cursos se borran en Moodle en lotes de `TAMANYO_LOTE_BORRADO`, uno detrás de otro
+y con una pausa entre lotes, porque borrar un curso (y todos sus materiales) es costoso
+para Moodle.  Tras cada lote se borran en Geoda, con una consulta por tabla,
+los cursos que Moodle ha borrado, sus profesores y sus registros de matrícula automática.
+
+Se usa desde la acción «Borrar los cursos seleccionados, también en Moodle»
+de la administración de Curso, que encola la tarea `borrar_cursos`,
+y desde la orden `borrar_cursos`.
+"""
+
+# Standard library
+import time
+
+# Third-party
+from annoying.functions import get_config
+
+# Django
+from django.db import transaction
+from django.db.models import Q
+from django.utils.translation import gettext_lazy as _
+
+# Local Django
+from .models import Curso, MatriculaAutomatica, ProfesorCurso
+from .tareas import encolar_tarea, informar_progreso, registrar_tarea
+from .wsclient import WSClient, trocear
+
+NOMBRE_TAREA = 'borrar_cursos'
+
+TAMANYO_LOTE_BORRADO = get_config('TAMANYO_LOTE_BORRADO', 20)
+PAUSA_BORRADO = get_config('PAUSA_BORRADO', 2)  # Segundos entre lotes
+
+# Aviso de Moodle cuando el curso no existe (p. ej. porque ya se borró en un intento anterior).
+CURSO_INEXISTENTE = 'unknowncourseidnumber'
+
+
+def contar(cursos):
+    """Devuelve cuántos cursos, profesores y registros de matrícula automática se borrarían."""
+    ids = cursos.values('id')
+    return {
+        'cursos': cursos.count(),
+        'en_moodle': cursos.exclude(id_nk=None).count(),
+        'profesores': ProfesorCurso.objects.filter(curso_id__in=ids).count(),
+        'matriculas_automaticas': MatriculaAutomatica.objects.filter(curso_id__in=ids).count(),
+    }
+
+
+def borrar_en_segundo_plano(cursos, usuario):
+    """Encola el borrado de los cursos indicados, y devuelve la tarea."""
+    return encolar_tarea(
+        NOMBRE_TAREA, {'curso_ids': list(cursos.values_list('id', flat=True))}, usuario=usuario
+    )
+
+
+@registrar_tarea(NOMBRE_TAREA, max_intentos=3, visibilidad=30 * 60)
+def borrar_cursos(curso_ids):
+    """Tarea que borra los cursos, en Moodle y en Geoda."""
+    num_borrados, errores = borrar(Curso.objects.filter(pk__in=curso_ids), informar_progreso)
+    return {'num_borrados': num_borrados, 'errores': errores}
+
+
+def borrar(cursos, informar=print, tamanyo_lote=None, pausa=None):
+    """Borra los cursos en Moodle, en lotes, y después en Geoda.
+
+    Los cursos que Moodle no borra se mantienen en Geoda.
+    Devuelve el número de cursos borrados, y la lista de errores.
+    """
+    tamanyo_lote = tamanyo_lote or TAMANYO_LOTE_BORRADO
+    pausa = PAUSA_BORRADO if pausa is None else pausa
+    cursos = list(cursos.only('id', 'id_nk', 'nombre').order_by('id'))
+    cliente = WSClient()
+    num_borrados, errores = 0, []
+
+    for num_lote, lote in enumerate(trocear(cursos, tamanyo_lote)):
+        if num_lote and pausa:
+            time.sleep(pausa)
+        en_moodle = [curso for curso in lote if curso.id_nk]
+        avisos = cliente.borrar_cursos([curso.id_nk for curso in en_moodle]) if en_moodle else {}
+
+        borrados = []
+        for curso in lote:
+            aviso = avisos.get(int(curso.id_nk)) if curso.id_nk else None
+            if aviso and aviso.get('warningcode') != CURSO_INEXISTENTE:
+                errores.append(f'{curso.id} «{curso.nombre}»: {aviso.get("message")}')
+            else:
+                borrados.append(curso)
+        _borrar_en_geoda(borrados)
+
+        num_borrados += len(borrados)
+        informar(
+            str(_('Borrados %(num)s de %(total)s cursos.'))
+            % {'num': num_borrados, 'total': len(cursos)}
+        )
+    return num_borrados, errores
+
+
+def _borrar_en_geoda(cursos):
+    ids = [curso.id for curso in cursos]
+    ids_nk = [curso.id_nk for curso in cursos if curso.id_nk]
+    with transaction.atomic():
+        ProfesorCurso.objects.filter(curso_id__in=ids).delete()
+        MatriculaAutomatica.objects.filter(Q(curso_id__in=ids) | Q(courseid__in=ids_nk)).delete()
+        Curso.objects.filter(pk__in=ids).delete()
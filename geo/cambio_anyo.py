@@ -0,0 +1,159 @@
+"""Cambio de año académico, en segundo plano.
+
+Al cambiar el año académico actual en `CalendarioUpdate` se encola la tarea `cambiar_anyo`,
+que realiza los pasos de `PASOS`.  Cada paso comprueba qué queda por hacer,
+así que la tarea se puede repetir sin peligro, y si falla se reanuda donde se quedó.
+
+Las categorías «Varios» y «Escuela de Doctorado» (la que tiene 1 curso por cada PD,
+directamente en «Cursos 20xx-20yy») pasan cada año a la categoría del nuevo año,
+así como la de cursos no reglados bienales del año anterior, que pasa a «No reglada».
+La Escuela de Doctorado tiene además, dentro de «No reglada», otra categoría para actividades
+de formación transversal y específica, que se crea cada año con las demás no regladas.
+"""
+
+# Third-party
+from annoying.functions import get_config
+
+# Django
+from django.utils.translation import gettext_lazy as _
+
+# Local Django
+from .models import Categoria, Matriculacion, Tarea
+from .operaciones import OperacionAplazada
+from .tareas import encolar_tarea, informar_progreso, registrar_tarea
+from .wsclient import WSClient
+
+NOMBRE_TAREA = 'cambiar_anyo'
+
+# `id_nk` de las categorías que pasan cada año a la categoría del nuevo año:
+# «Varios» y «Escuela de Doctorado».
+CATEGORIAS_ANUALES = get_config('CATEGORIAS_ANUALES', ('5047', '5021'))
+
+# Número de filas de `matriculacion` que se borran de cada vez.
+TAMANYO_BORRADO = 10_000
+
+
+class CambioAnyoEnCurso(Exception):
+    """Ya se está preparando otro año académico."""
+
+
+def iniciar_cambio_anyo(anyo, usuario):
+    """Encola el cambio al año académico indicado, y devuelve la tarea.
+
+    Si ya hay un cambio a ese mismo año en curso, devuelve su tarea.
+    Si está en curso el cambio a otro año, lanza `CambioAnyoEnCurso`.
+    """
+    tarea = ultimo_cambio()
+    if tarea and not tarea.esta_acabada:
+        if tarea.parametros.get('anyo') != anyo:
+            raise CambioAnyoEnCurso(
+                _('Se está preparando el año %(anyo)s. Espere a que acabe para cambiar de año.')
+                % {'anyo': tarea.parametros.get('anyo')}
+            )
+        return tarea
+    return encolar_tarea(NOMBRE_TAREA, {'anyo': anyo}, usuario=usuario)
+
+
+def ultimo_cambio():
+    """Devuelve la tarea del último cambio de año, o `None`."""
+    return Tarea.objects.filter(nombre=NOMBRE_TAREA).order_by('-id').first()
+
+
+@registrar_tarea(NOMBRE_TAREA, max_intentos=5, visibilidad=30 * 60)
+def cambiar_anyo(anyo):
+    """Prepara Geoda y Moodle para el año académico indicado."""
+    resumen = {}
+    for num, (descripcion, paso) in enumerate(PASOS, start=1):
+        informar_progreso(
+            _('Paso %(num)s de %(total)s: %(paso)s')
+            % {'num': num, 'total': len(PASOS), 'paso': descripcion}
+        )
+        resumen.update(paso(anyo))
+    return resumen
+
+
+def _crear_categorias(anyo):
+    """Crea las categorías del año y las de sus cursos no reglados, por niveles y en lotes."""
+    cat_anyo = _obtener_categoria(anyo, f'Cursos {anyo}-{anyo + 1}', None)
+    cat_nr = _obtener_categoria(anyo, 'No reglada', cat_anyo)
+    categorias = [cat_anyo, cat_nr] + [
+        _obtener_categoria(anyo, nombre, cat_nr)
+        for nombre in Categoria.NO_REGLADAS + (f'Bienales {anyo}-{anyo + 2}',)
+    ]
+
+    errores = [str(e) for e in Categoria.crear_varias_en_plataforma(categorias) if e]
+    if errores:
+        raise Exception('; '.join(errores))
+    if any(not categoria.id_nk for categoria in categorias):
+        # Moodle no está disponible: se crearán al enviar las operaciones pendientes.
+        raise OperacionAplazada(_('Todavía no se han creado en Moodle todas las categorías.'))
+    return {'categorias': len(categorias)}
+
+
+def _obtener_categoria(anyo, nombre, supercategoria):
+    """Devuelve la categoría de Geoda, creándola si no existía."""
+    categoria, _creada = Categoria.objects.get_or_create(
+        anyo_academico=anyo,
+        nombre=nombre,
+        supercategoria=supercategoria,
+        defaults={'plataforma_id': 1},
+    )
+    return categoria
+
+
+def _mover_categorias(anyo):
+    """Mueve las categorías que pasan de un año a otro, en Moodle y en Geoda."""
+    cat_anyo = _obtener_categoria(anyo, f'Cursos {anyo}-{anyo + 1}', None)
+    cat_nr = _obtener_categoria(anyo, 'No reglada', cat_anyo)
+
+    destinos = {
+        categoria: cat_anyo for categoria in Categoria.objects.filter(id_nk__in=CATEGORIAS_ANUALES)
+    }
+    bienal = (
+        Categoria.objects.filter(nombre=f'Bienales {anyo - 1}-{anyo + 1}')
+        .exclude(id_nk=None)
+        .order_by('-anyo_academico')
+        .first()
+    )
+    if bienal:
+        destinos[bienal] = cat_nr
+
+    pendientes = {
+        categoria: destino
+        for categoria, destino in destinos.items()
+        if categoria.supercategoria_id != destino.id
+    }
+    if pendientes:
+        WSClient().mover_categorias(
+            [(categoria.id_nk, destino.id_nk) for categoria, destino in pendientes.items()]
+        )
+        for categoria, destino in pendientes.items():
+            Categoria.objects.filter(pk=categoria.pk).update(
+                anyo_academico=anyo, supercategoria=destino
+            )
+    return {'categorias_movidas': [categoria.nombre for categoria in pendientes]}
+
+
+def _borrar_matriculaciones(anyo):
+    """Borra de la tabla `matriculacion` los alumnos del año anterior, por partes."""
+    num_borradas = 0
+    while True:
+        ids = list(
+            Matriculacion.objects.filter(anyo_academico=anyo - 1).values_list('pk', flat=True)[
+                :TAMANYO_BORRADO
+            ]
+        )
+        if not ids:
+            break
+        num_borradas += Matriculacion.objects.filter(pk__in=ids).delete()[0]
+        informar_progreso(
+            _('Borradas %(num)s matriculaciones del año anterior.') % {'num': num_borradas}
+        )
+    return {'matriculaciones_borradas': num_borradas}
+
+
+PASOS = (
+    (_('Creando las categorías del año'), _crear_categorias),
+    (_('Moviendo las categorías que pasan de un año a otro'), _mover_categorias),
+    (_('Borrando las matriculaciones del año anterior'), _borrar_matriculaciones),
+)
@@ -0,0 +1,162 @@
+"""Grabación y reproducción de las llamadas al Web Service de Moodle.
+
+En modo `grabar`, las peticiones se envían a Moodle como siempre, y cada respuesta se guarda
+en un casete: un fichero de líneas JSON comprimido con gzip.  En modo `reproducir`,
+no se conecta con Moodle: cada petición se responde con la respuesta grabada
+para la misma `wsfunction` y los mismos parámetros (sin contar el token ni las fechas).
+
+Así se puede grabar una vez, por ejemplo, la ejecución nocturna de `matricular_grupo_sigma`,
+y repetirla después sin red, para medir por separado el coste en CPU, memoria y
+base de datos de la sincronización:
+
+    WS_CASETE=/tmp/sigma.jsonl.gz WS_CASETE_MODO=grabar ./manage.py matricular_grupo_sigma
+    WS_CASETE=/tmp/sigma.jsonl.gz ./manage.py matricular_grupo_sigma
+"""
+
+# Standard library
+import atexit
+import gzip
+import json
+import re
+import threading
+from collections import defaultdict, deque
+
+# Third-party
+import requests
+from requests.adapters import BaseAdapter
+
+# Local Django
+from .moodle_simulado import crear_respuesta, desanidar, parametros_peticion, separar_llamada
+
+# Parámetros que cambian en cada ejecución, y que no se tienen en cuenta para buscar la respuesta.
+PARAMETROS_VARIABLES = ('timestart', 'startdate')
+
+
+class PeticionNoGrabada(requests.exceptions.RequestException):
+    """La petición no está en el casete que se está reproduciendo."""
+
+
+def normalizar(parametros):
+    """Devuelve la clave con la que se busca una petición en el casete.
+
+    No se tiene en cuenta el orden de los elementos de las listas
+    (p. ej. de los NIPs buscados o de las matrículas de un lote).
+    """
+    wsfunction, parametros = separar_llamada(parametros)
+    estables = [
+        (clave, valor)
+        for clave, valor in parametros
+        if re.findall(r'[^\[\]]+', clave)[-1] not in PARAMETROS_VARIABLES
+    ]
+    return wsfunction, _canonico(desanidar(estables))
+
+
+def _canonico(nodo):
+    if isinstance(nodo, list):
+        return '[' + ','.join(sorted(_canonico(elemento) for elemento in nodo)) + ']'
+    if isinstance(nodo, dict):
+        return (
+            '{'
+            + ','.join(f'{json.dumps(k)}:{_canonico(v)}' for k, v in sorted(nodo.items()))
+            + '}'
+        )
+    return json.dumps(nodo, ensure_ascii=False)
+
+
+class Casete:
+    """Fichero con las peticiones a Moodle y sus respuestas."""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._fichero = None
+        self._respuestas = None
+
+    def grabar(self, parametros, estado, contenido):
+        """Añade al casete una petición y su respuesta."""
+        wsfunction, clave = normalizar(parametros)
+        linea = json.dumps(
+            {'f': wsfunction, 'p': clave, 's': estado, 'r': contenido.decode('utf-8')},
+            ensure_ascii=False,
+        )
+        with self._lock:
+            if self._fichero is None:
+                self._fichero = gzip.open(self.ruta, 'at', encoding='utf-8')
+                atexit.register(self.cerrar)
+            self._fichero.write(linea + '\n')
+
+    def reproducir(self, parametros):
+        """Devuelve el código de estado y el contenido grabados para la petición.
+
+        Si la misma petición se grabó varias veces, se devuelven sus respuestas en orden,
+        y cuando se acaban se repite la última.
+        """
+        wsfunction, clave = normalizar(parametros)
+        with self._lock:
+            if self._respuestas is None:
+                self._respuestas = self._cargar()
+            grabadas = self._respuestas.get((wsfunction, clave))
+            if not grabadas:
+                raise PeticionNoGrabada(f'Llamada a {wsfunction} no grabada en {self.ruta}')
+            respuesta = grabadas.popleft() if len(grabadas) > 1 else grabadas[0]
+        return respuesta['s'], respuesta['r'].encode('utf-8')
+
+    def cerrar(self):
+        with self._lock:
+            if self._fichero is not None:
+                self._fichero.close()
+                self._fichero = None
+
+    def _cargar(self):
+        respuestas = defaultdict(deque)
+        with gzip.open(self.ruta, 'rt', encoding='utf-8') as fichero:
+            for linea in fichero:
+                grabada = json.loads(linea)
+                respuestas[(grabada['f'], grabada['p'])].append(grabada)
+        return respuestas
+
+
+class AdaptadorGrabador(BaseAdapter):
+    """Adaptador de `requests` que envía las peticiones con otro adaptador, y las graba."""
+
+    def __init__(self, adaptador, casete):
+        super().__init__()
+        self.adaptador = adaptador
+        self.casete = casete
+
+    def send(self, request, **kwargs):
+        respuesta = self.adaptador.send(request, **kwargs)
+        self.casete.grabar(parametros_peticion(request), respuesta.status_code, respuesta.content)
+        return respuesta
+
+    def close(self):
+        self.adaptador.close()
+        self.casete.cerrar()
+
+
+class AdaptadorReproductor(BaseAdapter):
+    """Adaptador de `requests` que responde a las peticiones con las respuestas grabadas."""
+
+    def __init__(self, casete):
+        super().__init__()
+        self.casete = casete
+
+    def send(self, request, **kwargs):
+        estado, contenido = self.casete.reproducir(parametros_peticion(request))
+        return crear_respuesta(request, estado, contenido)
+
+    def close(self):
+        pass
+
+
+def montar_casete(sesion, ruta, modo, adaptador):
+    """Hace que la sesión grabe sus peticiones en el casete, o las responda con él."""
+    casete = Casete(ruta)
+    if modo == 'grabar':
+        adaptador = AdaptadorGrabador(adaptador, casete)
+    elif modo == 'reproducir':
+        adaptador = AdaptadorReproductor(casete)
+    else:
+        raise Exception(f'Modo de casete desconocido: {modo}')
+    sesion.mount('https://', adaptador)
+    sesion.mount('http://', adaptador)
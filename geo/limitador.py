@@ -0,0 +1,108 @@
+"""Límite global de llamadas simultáneas a Moodle, compartido por todos los procesos.
+
+Cada llamada al Web Service ocupa un turno mientras espera la respuesta de Moodle.
+Hay `total` turnos, y cada uno es un fichero del directorio `WS_LIMITE_DIR`,
+que se bloquea con `flock()`.  Así el límite se comparte entre los workers de uWSGI
+y las órdenes de consola del mismo contenedor, sin necesidad de ningún servidor adicional,
+y si un proceso muere el sistema operativo libera sus turnos.
+
+Las llamadas de las órdenes nocturnas y demás tareas por lotes sólo pueden usar
+los `lotes` primeros turnos, de modo que siempre quedan `total - lotes` turnos
+reservados para las peticiones interactivas de los usuarios de la web.
+"""
+
+# Standard library
+import fcntl
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Third-party
+import requests
+from annoying.functions import get_config
+
+INTERACTIVA = 'interactiva'
+LOTES = 'lotes'
+
+
+class MoodleSaturado(requests.exceptions.RequestException):
+    """No ha quedado libre ningún turno para llamar a Moodle en el tiempo de espera."""
+
+
+class Limitador:
+    """Semáforo entre procesos, con turnos reservados para las peticiones interactivas."""
+
+    def __init__(self, directorio, total, lotes, espera):
+        self.directorio = directorio
+        self.total = total
+        self.lotes = min(lotes, total)
+        self.espera = espera  # Segundos máximos de espera por un turno
+        self.prioridad = INTERACTIVA
+        self._preparado = False
+        self._lock = threading.Lock()
+
+    def establecer_prioridad(self, prioridad):
+        """Establece la prioridad de todas las llamadas a Moodle de este proceso."""
+        self.prioridad = prioridad
+
+    @contextmanager
+    def turno(self, prioridad=None):
+        """Espera a que quede libre un turno, y lo ocupa mientras dura el bloque `with`."""
+        if not self.total:
+            yield
+            return
+
+        descriptor = self._ocupar(prioridad or self.prioridad)
+        try:
+            yield
+        finally:
+            fcntl.flock(descriptor, fcntl.LOCK_UN)
+            os.close(descriptor)
+
+    def _ocupar(self, prioridad):
+        self._preparar()
+        num_turnos = self.lotes if prioridad == LOTES else self.total
+        # Las tareas por lotes comprueban con menos frecuencia si hay turnos libres.
+        intervalo = 0.2 if prioridad == LOTES else 0.02
+        limite = time.monotonic() + self.espera
+        while True:
+            # Empezamos por un turno al azar, para no competir todos por el primero.
+            inicio = random.randrange(num_turnos)
+            for i in range(num_turnos):
+                descriptor = os.open(self._ruta((inicio + i) % num_turnos), os.O_RDWR)
+                try:
+                    fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(descriptor)
+                else:
+                    return descriptor
+
+            if time.monotonic() >= limite:
+                raise MoodleSaturado(
+                    'Moodle está atendiendo demasiadas peticiones.'
+                    ' Inténtelo de nuevo dentro de unos minutos.'
+                )
+            time.sleep(random.uniform(intervalo / 2, intervalo))
+
+    def _preparar(self):
+        if self._preparado:
+            return
+        with self._lock:
+            os.makedirs(self.directorio, exist_ok=True)
+            for i in range(self.total):
+                with open(self._ruta(i), 'a'):
+                    pass
+            self._preparado = True
+
+    def _ruta(self, i):
+        return os.path.join(self.directorio, f'turno_{i}')
+
+
+limitador = Limitador(
+    directorio=get_config('WS_LIMITE_DIR', '/tmp/geoda_limitador_moodle'),
+    total=get_config('WS_LIMITE_TOTAL', 8),
+    lotes=get_config('WS_LIMITE_LOTES', 3),
+    espera=get_config('WS_LIMITE_ESPERA', 20),
+)
@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from geo.borrado import PAUSA_BORRADO, TAMANYO_LOTE_BORRADO, borrar, contar
+from geo.limitador import LOTES, limitador
+from geo.models import Categoria, Curso
+
+
+class Command(BaseCommand):
+    """
+    Borra en Moodle y en Geoda los cursos de años pasados.
+
+    Por ejemplo, para ver cuántos cursos de 2019 se borrarían, sin borrarlos:
+
+        ./manage.py borrar_cursos --anyo 2019 --simulacro
+    """
+
+    help = 'Borra en Moodle y en Geoda los cursos del año, estado o categoría indicados.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--anyo', type=int, help='Año académico de los cursos.')
+        parser.add_argument(
+            '--estado',
+            type=int,
+            choices=Curso.Estado.values,
+            help='Estado de los cursos ('
+            + ', '.join(f'{e.value}: {e.label}' for e in Curso.Estado)
+            + ').',
+        )
+        parser.add_argument(
+            '--categoria',
+            type=int,
+            help='Id en Geoda de la categoría de los cursos (incluye sus subcategorías).',
+        )
+        parser.add_argument(
+            '--simulacro',
+            action='store_true',
+            help='Sólo mostrar cuántos cursos se borrarían, sin borrarlos.',
+        )
+        parser.add_argument(
+            '--lote',
+            type=int,
+            default=TAMANYO_LOTE_BORRADO,
+            help=f'Cursos por cada llamada a Moodle (por defecto, {TAMANYO_LOTE_BORRADO}).',
+        )
+        parser.add_argument(
+            '--pausa',
+            type=float,
+            default=PAUSA_BORRADO,
+            help=f'Segundos de espera entre lotes (por defecto, {PAUSA_BORRADO}).',
+        )
+
+    def handle(self, *args, **options):
+        if not (options['anyo'] or options['estado'] or options['categoria']):
+            raise CommandError('Indique al menos el año, el estado o la categoría de los cursos.')
+
+        cursos = Curso.objects.all()
+        if options['anyo']:
+            cursos = cursos.filter(anyo_academico=options['anyo'])
+        if options['estado']:
+            cursos = cursos.filter(estado=options['estado'])
+        if options['categoria']:
+            cursos = cursos.filter(categoria_id__in=self.con_subcategorias(options['categoria']))
+
+        cuenta = contar(cursos)
+        print(
+            f"Se borrarán {cuenta['cursos']} cursos ({cuenta['en_moodle']} en Moodle),"
+            f" {cuenta['profesores']} asignaciones de profesores"
+            f" y {cuenta['matriculas_automaticas']} registros de matrícula automática."
+        )
+        if options['simulacro'] or not cuenta['cursos']:
+            return
+
+        limitador.establecer_prioridad(LOTES)
+        num_borrados, errores = borrar(cursos, print, options['lote'], options['pausa'])
+        for error in errores:
+            print(f'ERROR: {error}')
+        print(f'Borrados {num_borrados} cursos, {len(errores)} errores.')
+
+    @staticmethod
+    def con_subcategorias(categoria_id):
+        """Devuelve los ids de la categoría y de todas sus subcategorías."""
+        ids, nivel = {categoria_id}, {categoria_id}
+        while nivel:
+            nivel = (
+                set(
+                    Categoria.objects.filter(supercategoria_id__in=nivel).values_list(
+                        'id', flat=True
+                    )
+                )
+                - ids
+            )
+            ids |= nivel
+        return ids
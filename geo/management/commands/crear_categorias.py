@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from geo.limitador import LOTES, limitador
+from geo.models import Calendario, Categoria
+
+
+class Command(BaseCommand):
+    """
+    Crea de una vez todas las categorías que necesitan las asignaturas del año,
+    para que al crear el primer curso de cada plan no haya que esperar a crearlas.
+
+    Se puede lanzar tras cargar las asignaturas del nuevo año académico.
+    """
+
+    help = 'Crea las categorías de año, centro y plan que faltan para las asignaturas del año.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--anyo',
+            type=int,
+            help='Año académico (por defecto, el actual).',
+        )
+
+    def handle(self, *args, **options):
+        limitador.establecer_prioridad(LOTES)
+        anyo = options['anyo'] or Calendario.objects.get(slug='actual').anyo
+        indice, errores = Categoria.crear_arbol(anyo)
+        pendientes = sum(1 for categoria in indice.values() if not categoria.id_nk)
+        print(
+            f'Categorías del año {anyo}: {len(indice)} en total,'
+            f' {pendientes} pendientes de crear en Moodle, {len(errores)} errores.'
+        )
+        for error in errores:
+            print(error)
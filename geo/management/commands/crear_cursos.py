@@ -0,0 +1,62 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from geo.aprovisionamiento import aprovisionar_cursos, aprovisionar_varios, sin_curso
+from geo.limitador import LOTES, limitador
+from geo.models import Asignatura, Calendario
+
+
+class Command(BaseCommand):
+    """
+    Crea de una vez los cursos de todas las asignaturas de los planes o centros indicados.
+
+    Por omisión los crea directamente; con `--segundo-plano` encola la tarea
+    `aprovisionar_cursos`, que ejecuta el servicio `tareas`.
+    """
+
+    help = 'Crea en Moodle los cursos de las asignaturas de los planes o centros indicados.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--plan', type=int, nargs='+', default=[], help='Códigos de plan.')
+        parser.add_argument('--centro', type=int, nargs='+', default=[], help='Códigos de centro.')
+        parser.add_argument('--anyo', type=int, help='Año académico (por defecto, el actual).')
+        parser.add_argument(
+            '--solicitante',
+            required=True,
+            help='NIP del usuario que figurará como solicitante de los cursos.',
+        )
+        parser.add_argument(
+            '--segundo-plano', action='store_true', help='Encolar la tarea en lugar de ejecutarla.'
+        )
+
+    def handle(self, *args, **options):
+        if not options['plan'] and not options['centro']:
+            raise CommandError('Indique al menos un plan o un centro.')
+        solicitante = get_user_model().objects.get(username=options['solicitante'])
+        anyo = options['anyo'] or Calendario.objects.get(slug='actual').anyo
+        asignaturas = Asignatura.objects.filter(anyo_academico=anyo)
+        if options['plan']:
+            asignaturas = asignaturas.filter(plan_id_nk__in=options['plan'])
+        if options['centro']:
+            asignaturas = asignaturas.filter(centro_id__in=options['centro'])
+
+        if options['segundo_plano']:
+            tarea, num_omitidas = aprovisionar_varios(asignaturas, solicitante)
+            print(f'{num_omitidas} asignaturas ya tenían curso.')
+            if tarea:
+                print(f'Encolada la tarea {tarea.id}.')
+            return
+
+        ids, num_omitidas = sin_curso(asignaturas)
+        print(f'{num_omitidas} asignaturas ya tenían curso.')
+        if not ids:
+            return
+        limitador.establecer_prioridad(LOTES)
+        resultado = aprovisionar_cursos(ids, solicitante.id)
+        for fila in resultado['filas']:
+            for problema in filter(None, [fila['error']] + fila['avisos']):
+                print(f"{fila['asignatura']}: {problema}")
+        print(
+            f"Cursos creados: {resultado['num_creados']}."
+            f" Asignaturas con errores: {resultado['num_errores']}."
+        )
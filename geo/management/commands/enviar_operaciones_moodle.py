@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from geo.limitador import LOTES, limitador
+from geo.operaciones import enviar_pendientes
+
+
+class Command(BaseCommand):
+    """
+    Esta orden es lanzada por Ofelia (<https://github.com/taraspos/ofelia/>),
+    según esté configurado en `docker-compose.yml`.
+    Por ejemplo, cada minuto.
+    """
+
+    help = 'Envía a Moodle las operaciones pendientes (matrículas de profesores, categorías...).'
+
+    def handle(self, *args, **options):
+        limitador.establecer_prioridad(LOTES)
+        resumen = enviar_pendientes()
+        if resumen:
+            print(
+                f"Operaciones en Moodle: {resumen['enviadas']} enviadas,"
+                f" {resumen['aplazadas']} aplazadas, {resumen['fallidas']} fallidas."
+            )
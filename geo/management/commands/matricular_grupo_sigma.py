@@ -1,7 +1,9 @@
 from django.core.management.base import BaseCommand
-from django.db import connection
 
-from geo.utils import matricular_grupo_sigma
+from geo.limitador import LOTES, limitador
+from geo.metricas import metricas
+from geo.sincronizacion import matricular_registros, registros_activos
+from geo.wscache import cache_usuarios
 
 
 class Command(BaseCommand):
@@ -9,27 +11,93 @@ class Command(BaseCommand):
     Esta orden es lanzada por Ofelia (<https://github.com/taraspos/ofelia/>),
     según esté configurado en `docker-compose.yml`.
     Por ejemplo, cada día a las 06:45:00.
+
+    Los NIPs de Sigma de todos los registros se calculan de una vez, y al final
+    se muestra una tabla con el resultado de cada registro (véase `geo.sincronizacion`).
+    Los registros cuyos NIPs no han cambiado se omiten, y los que faltan por matricular
+    se calculan con la copia local de las matrículas de Moodle.  Sólo se piden a Moodle
+    los matriculados en un curso cada `MATRICULAS_RECONCILIAR_DIAS` días,
+    o siempre con `--completa`.
     """
 
     help = 'Matricula en los cursos Moodle los NIPs matriculados en Sigma que cumplan los filtros.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--metricas',
+            metavar='FICHERO',
+            help='Escribe en este fichero las métricas de las llamadas a Moodle,'
+            ' en el formato del textfile collector de Prometheus.',
+        )
+        parser.add_argument(
+            '--completa',
+            action='store_true',
+            help='Verifica en Moodle los matriculados en todos los cursos,'
+            ' aunque sus NIPs de Sigma no hayan cambiado.',
+        )
+
     def handle(self, *args, **options):
-        # Obtenemos todos los registros activos de matrícula automática.
-        with connection.cursor() as cursor:
-            cursor.execute(
-                '''
-                SELECT courseid, asignatura_nk, cod_grupo_asignatura, centro_id, plan_id
-                FROM matricula_automatica
-                JOIN curso ON matricula_automatica.curso_id = curso.id
-                JOIN calendario ON curso.anyo_academico = calendario.anyo
-                WHERE matricula_automatica.active = 1
-                  AND calendario.slug = 'actual'
-                ORDER BY courseid, asignatura_nk;
-                '''
-            )
-            registros = cursor.fetchall()
-
-        # Para cada registro de matrícula automática
-        for registro in registros:
-            # Matricular en el curso Moodle los NIPs matriculados en Sigma que cumplan los filtros
-            matricular_grupo_sigma(*registro)
+        # Las peticiones de los usuarios de la web tienen preferencia sobre esta orden.
+        limitador.establecer_prioridad(LOTES)
+
+        resultados = matricular_registros(registros_activos(), completa=options['completa'])
+        self.imprimir_resumen(resultados)
+
+        self.stdout.write(cache_usuarios.estadisticas())
+        if options['metricas']:
+            metricas.escribir_textfile(options['metricas'])
+
+    @staticmethod
+    def imprimir_resumen(resultados):
+        """Muestra una tabla con el resultado de cada registro, y una fila de totales."""
+        print(' '.join(f'{titulo:>{ancho}}' for titulo, ancho in COLUMNAS), ' Observaciones')
+        for r in resultados:
+            registro = r['registro']
+            valores = (
+                registro.courseid,
+                registro.asignatura_nk,
+                registro.cod_grupo_asignatura,
+                registro.centro_id,
+                registro.plan_id,
+            ) + tuple(r[cifra] for cifra in CIFRAS)
+            print(_fila(valores), '', _observaciones(r))
+
+        totales = [sum(r[cifra] for r in resultados) for cifra in CIFRAS]
+        num_errores = sum(1 for r in resultados if r['error'])
+        num_sin_cambios = sum(1 for r in resultados if r['sin_cambios'])
+        print(
+            _fila(['TOTAL', len(resultados), None, None, None] + totales),
+            '',
+            f'{num_errores} errores, {num_sin_cambios} sin cambios',
+        )
+
+
+# Título y ancho de las columnas del resumen, y cifras de cada registro que se muestran.
+COLUMNAS = (
+    ('Curso', 8),
+    ('Asign.', 7),
+    ('Grupo', 5),
+    ('Centro', 6),
+    ('Plan', 5),
+    ('Sigma', 6),
+    ('Ya mat.', 7),
+    ('A mat.', 6),
+    ('Matric.', 7),
+    ('No enc.', 7),
+)
+CIFRAS = ('en_sigma', 'ya_matriculados', 'a_matricular', 'matriculados', 'no_encontrados')
+
+
+def _observaciones(resultado):
+    if resultado['error']:
+        return resultado['error']
+    if resultado['sin_cambios']:
+        return 'sin cambios'
+    return 'verificado en Moodle' if resultado['verificado'] else ''
+
+
+def _fila(valores):
+    return ' '.join(
+        f'{"" if valor is None else valor:>{ancho}}'
+        for valor, (_titulo, ancho) in zip(valores, COLUMNAS)
+    )
@@ -3,13 +3,27 @@ from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand
 from django.db import connection
 
+from geo.limitador import LOTES, limitador
+from geo.metricas import metricas
 from geo.models import Curso
+from geo.wscache import cache_usuarios
 
 
 class Command(BaseCommand):
     help = 'Matricula en los cursos los NIPs que aparecen en el POD, si no lo estaban.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--metricas',
+            metavar='FICHERO',
+            help='Escribe en este fichero las métricas de las llamadas a Moodle,'
+            ' en el formato del textfile collector de Prometheus.',
+        )
+
     def handle(self, *args, **options):
+        # Las peticiones de los usuarios de la web tienen preferencia sobre esta orden.
+        limitador.establecer_prioridad(LOTES)
+
         # Obtenemos los NIPs que figuran en el POD
         # pero que no están en la lista de profesores del curso en GEO.
         with connection.cursor() as cursor:
@@ -49,3 +63,7 @@ class Command(BaseCommand):
                     curso.anyadir_profesor(profesor)
                 except Exception as ex:
                     print('ERROR: %s' % str(ex))
+
+        self.stdout.write(cache_usuarios.estadisticas())
+        if options['metricas']:
+            metricas.escribir_textfile(options['metricas'])
@@ -0,0 +1,53 @@
+import statistics
+import threading
+import time
+
+import requests
+from django.core.management.base import BaseCommand
+
+from geo.moodle_simulado import MoodleSimulado
+from geo.wscache import SinCache
+from geo.wsclient import WSClient
+
+
+class Command(BaseCommand):
+    help = (
+        'Compara la latencia por llamada de WSClient con y sin conexiones persistentes,'
+        ' contra un servidor local que imita a Moodle.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--llamadas', type=int, default=500, help='Nº de llamadas por modo')
+
+    def handle(self, *args, **options):
+        moodle = MoodleSimulado(usuarios_automaticos=False)
+        servidor = moodle.servir()
+        hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+        hilo.start()
+
+        try:
+            # El módulo `requests` tiene las mismas funciones `get()` y `post()` que una sesión,
+            # pero abre una conexión nueva en cada llamada (el comportamiento anterior).
+            for nombre, sesion in (('Sin pool', requests), ('Con pool', None)):
+                # Sin caché de usuarios, para que todas las búsquedas lleguen a Moodle.
+                cliente = WSClient(sesion=sesion, cache=SinCache())
+                cliente.api_url = moodle.api_url
+                tiempos = self._medir(cliente, options['llamadas'])
+                self.stdout.write(
+                    f'{nombre}: media {statistics.mean(tiempos):.3f} ms'
+                    f'  p50 {statistics.median(tiempos):.3f} ms'
+                    f'  p95 {statistics.quantiles(tiempos, n=20)[-1]:.3f} ms'
+                )
+        finally:
+            servidor.shutdown()
+            servidor.server_close()
+
+    @staticmethod
+    def _medir(cliente, llamadas):
+        """Devuelve la duración en milisegundos de cada una de las llamadas."""
+        tiempos = []
+        for i in range(llamadas):
+            inicio = time.perf_counter()
+            cliente.buscar_usuarios_nip([str(100_001 + i)])
+            tiempos.append((time.perf_counter() - inicio) * 1000)
+        return tiempos
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+
+from geo.moodle_simulado import MoodleSimulado
+
+
+class Command(BaseCommand):
+    help = (
+        'Arranca un servidor local que imita el Web Service REST de Moodle,'
+        ' con datos en memoria, para pruebas y mediciones de rendimiento.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--puerto', type=int, default=8081)
+        parser.add_argument(
+            '--latencia', type=float, default=0.0, help='Segundos que tarda cada llamada'
+        )
+        parser.add_argument(
+            '--dispersion', type=float, default=0.0, help='Segundos aleatorios adicionales'
+        )
+        parser.add_argument(
+            '--errores', type=float, default=0.0, help='Proporción de llamadas con error 503'
+        )
+        parser.add_argument(
+            '--relleno', type=int, default=0, help='Caracteres adicionales en cada usuario'
+        )
+        parser.add_argument(
+            '--desconocidos',
+            type=float,
+            default=0.0,
+            help='Proporción de NIPs que no existen en Moodle',
+        )
+        parser.add_argument('--semilla', type=int, default=0)
+
+    def handle(self, *args, **options):
+        moodle = MoodleSimulado(
+            latencia=options['latencia'],
+            dispersion=options['dispersion'],
+            tasa_errores=options['errores'],
+            relleno=options['relleno'],
+            tasa_desconocidos=options['desconocidos'],
+            semilla=options['semilla'],
+        )
+        servidor = moodle.servir(options['host'], options['puerto'])
+        self.stdout.write(f'Moodle simulado en {moodle.api_url}')
+        self.stdout.write('Configure API_URL con esta dirección. Pulse Ctrl+C para terminar.')
+        try:
+            servidor.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            servidor.server_close()
@@ -0,0 +1,64 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from geo.limitador import LOTES, limitador
+from geo.metricas import metricas
+from geo.models import Tarea
+from geo.tareas import cargar_tareas, ejecutar, nombre_trabajador, tomar_siguiente
+
+
+class Command(BaseCommand):
+    """
+    Trabajador que ejecuta las tareas en segundo plano guardadas en la tabla `tarea`.
+
+    Se ejecuta permanentemente en el servicio `tareas` de `docker-compose.yml`.
+    Se pueden lanzar varios trabajadores a la vez.
+    """
+
+    help = 'Ejecuta las tareas en segundo plano pendientes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--una-vez',
+            action='store_true',
+            help='Terminar cuando no queden tareas pendientes, en lugar de esperar otras nuevas.',
+        )
+        parser.add_argument(
+            '--espera',
+            type=float,
+            default=2,
+            help='Segundos entre consultas a la cola cuando está vacía (por defecto, 2).',
+        )
+
+    def handle(self, *args, **options):
+        cargar_tareas()
+        limitador.establecer_prioridad(LOTES)
+        metricas.compartir()
+        trabajador = nombre_trabajador()
+        self.parar = False
+        # Al parar el contenedor, terminamos la tarea en curso antes de salir.
+        signal.signal(signal.SIGTERM, self.pedir_parada)
+        signal.signal(signal.SIGINT, self.pedir_parada)
+
+        print(f'Trabajador {trabajador} esperando tareas.')
+        while not self.parar:
+            close_old_connections()
+            tarea = tomar_siguiente(trabajador)
+            if tarea is None:
+                if options['una_vez']:
+                    break
+                time.sleep(options['espera'])
+                continue
+
+            inicio = time.monotonic()
+            estado = ejecutar(tarea)
+            print(
+                f'Tarea {tarea.nombre} #{tarea.id} (intento {tarea.intentos}):'
+                f' {Tarea.Estado(estado).label} en {time.monotonic() - inicio:.1f} s.'
+            )
+
+    def pedir_parada(self, _signum, _frame):
+        self.parar = True
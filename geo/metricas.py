@@ -0,0 +1,276 @@
+"""Métricas de las llamadas al Web Service de Moodle.
+
+Para cada `wsfunction` se cuentan las llamadas, los errores (por clase de error),
+la duración de las peticiones (en un histograma) y los bytes enviados y recibidos.
+
+Cada proceso lleva sus propias métricas en memoria.  Los procesos de larga duración
+(los workers de uWSGI y el trabajador de `procesar_tareas`) las vuelcan periódicamente
+en un fichero JSON del directorio `METRICAS_MOODLE_DIR`, de modo que la vista `metricas`
+puede sumar las de todos ellos.  El fichero se borra al terminar el proceso, y al sumar
+se descartan los de procesos que ya no existen.  Las órdenes de consola de corta duración
+no vuelcan sus métricas, pero las pueden escribir con su opción `--metricas`.
+Las métricas se exportan en el formato de texto de Prometheus
+(<https://prometheus.io/docs/instrumenting/exposition_formats/>).
+"""
+
+# Standard library
+import atexit
+import glob
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+# Third-party
+from annoying.functions import get_config
+
+# Límites superiores (en segundos) de los intervalos del histograma de duración.
+LIMITES_DURACION = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIJO = 'geoda_moodle'
+
+logger = logging.getLogger(__name__)
+
+
+class MetricasMoodle:
+    """Contadores e histogramas de las llamadas a Moodle de este proceso."""
+
+    def __init__(self, directorio=None, intervalo=10):
+        self.directorio = directorio
+        self.intervalo = intervalo  # Segundos mínimos entre volcados al fichero
+        self.compartidas = False  # Si se vuelcan al fichero del proceso
+        self._lock = threading.Lock()
+        self._ultimo_volcado = 0
+        self.reiniciar()
+
+    def compartir(self):
+        """Hace que las métricas de este proceso se vuelquen en su fichero, para la vista.
+
+        Se llama en los procesos de larga duración.  El fichero se borra al terminar el proceso.
+        """
+        if self.directorio and not self.compartidas:
+            self.compartidas = True
+            atexit.register(self.borrar)
+
+    def reiniciar(self):
+        with self._lock:
+            # Cada wsfunction tiene: llamadas, errores por clase, recuento de cada intervalo
+            # del histograma, suma de duraciones, y bytes enviados y recibidos.
+            self.funciones = {}
+
+    def registrar(self, wsfunction, duracion, datos=None, respuesta=None, error=None):
+        """Anota una petición HTTP a Moodle, con su duración en segundos."""
+        enviados = len(urlencode(datos, doseq=True)) if datos else 0
+        recibidos = len(respuesta.content) if respuesta is not None else 0
+        with self._lock:
+            funcion = self._funcion(wsfunction)
+            funcion['llamadas'] += 1
+            funcion['duracion_suma'] += duracion
+            for i, limite in enumerate(LIMITES_DURACION):
+                if duracion <= limite:
+                    funcion['duracion_intervalos'][i] += 1
+            funcion['bytes_enviados'] += enviados
+            funcion['bytes_recibidos'] += recibidos
+            if error is not None:
+                self._anotar_error(funcion, error)
+        self._volcar_si_toca()
+
+    def registrar_error(self, wsfunction, error):
+        """Anota un error que no procede de la petición HTTP (p. ej. una excepción de Moodle)."""
+        with self._lock:
+            self._anotar_error(self._funcion(wsfunction), error)
+        self._volcar_si_toca()
+
+    def instantanea(self):
+        """Devuelve una copia de las métricas del proceso, serializable en JSON."""
+        with self._lock:
+            return json.loads(json.dumps(self.funciones))
+
+    def volcar(self):
+        """Guarda las métricas del proceso en su fichero del directorio de métricas."""
+        if not self.compartidas:
+            return
+        os.makedirs(self.directorio, exist_ok=True)
+        datos = self.instantanea()
+        # Escribimos en un fichero temporal y lo renombramos, para no leer nunca uno a medias.
+        descriptor, temporal = tempfile.mkstemp(dir=self.directorio, suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as fichero:
+            json.dump(datos, fichero)
+        os.replace(temporal, self._ruta(socket.gethostname(), os.getpid()))
+        self._ultimo_volcado = time.monotonic()
+
+    def borrar(self):
+        """Borra el fichero de métricas del proceso (al terminar)."""
+        self._borrar_fichero(self._ruta(socket.gethostname(), os.getpid()))
+
+    def texto(self):
+        """Devuelve las métricas de todos los procesos, en el formato de texto de Prometheus."""
+        instantaneas = [self.instantanea()]
+        for ruta, host, pid in self._ficheros():
+            if (host, pid) == (socket.gethostname(), os.getpid()):
+                continue
+            if host == socket.gethostname() and not proceso_vivo(pid):
+                # El proceso murió sin borrar su fichero, y su PID se puede reutilizar.
+                self._borrar_fichero(ruta)
+                continue
+            try:
+                with open(ruta) as fichero:
+                    instantaneas.append(json.load(fichero))
+            except (OSError, ValueError):
+                continue  # El proceso puede estar sobrescribiéndolo
+        return formatear(combinar(instantaneas))
+
+    def escribir_textfile(self, ruta):
+        """Escribe las métricas de este proceso en un fichero para el textfile collector.
+
+        Es el formato que lee `node_exporter` con `--collector.textfile.directory`.
+        """
+        temporal = f'{ruta}.{os.getpid()}.tmp'
+        with open(temporal, 'w') as fichero:
+            fichero.write(formatear(self.instantanea()))
+        os.replace(temporal, ruta)
+
+    def _ruta(self, host, pid):
+        # Los contenedores `web` y `tareas` comparten el directorio, pero no los PIDs.
+        return os.path.join(self.directorio, f'metricas_{host}_{pid}.json')
+
+    def _ficheros(self):
+        """Devuelve la ruta, el host y el PID de cada fichero de métricas del directorio."""
+        if not self.directorio:
+            return []
+        ficheros = []
+        for ruta in glob.glob(os.path.join(self.directorio, 'metricas_*_*.json')):
+            host, _, pid = os.path.basename(ruta)[len('metricas_') : -len('.json')].rpartition('_')
+            if pid.isdigit():
+                ficheros.append((ruta, host, int(pid)))
+        return ficheros
+
+    @staticmethod
+    def _borrar_fichero(ruta):
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+
+    def _funcion(self, wsfunction):
+        if wsfunction not in self.funciones:
+            self.funciones[wsfunction] = {
+                'llamadas': 0,
+                'errores': {},
+                'duracion_intervalos': [0] * len(LIMITES_DURACION),
+                'duracion_suma': 0.0,
+                'bytes_enviados': 0,
+                'bytes_recibidos': 0,
+            }
+        return self.funciones[wsfunction]
+
+    @staticmethod
+    def _anotar_error(funcion, error):
+        clase = clase_error(error)
+        funcion['errores'][clase] = funcion['errores'].get(clase, 0) + 1
+
+    def _volcar_si_toca(self):
+        if self.compartidas and time.monotonic() - self._ultimo_volcado >= self.intervalo:
+            try:
+                self.volcar()
+            except OSError as ex:
+                logger.error('Error al guardar las métricas de Moodle: %s', ex)
+                self._ultimo_volcado = time.monotonic()
+
+
+def proceso_vivo(pid):
+    """Indica si existe un proceso con ese PID en esta máquina (o contenedor)."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Existe, pero es de otro usuario
+    return True
+
+
+def clase_error(error):
+    """Devuelve el nombre con el que se agrupa un error en las métricas."""
+    if isinstance(error, str):
+        return error
+    respuesta = getattr(error, 'response', None)
+    if respuesta is not None and getattr(respuesta, 'status_code', None):
+        return f'HTTP{respuesta.status_code}'
+    return type(error).__name__
+
+
+def combinar(instantaneas):
+    """Suma las métricas de varios procesos."""
+    total = {}
+    for instantanea in instantaneas:
+        for wsfunction, datos in instantanea.items():
+            if wsfunction not in total:
+                total[wsfunction] = json.loads(json.dumps(datos))
+                continue
+            acumulado = total[wsfunction]
+            for clave in ('llamadas', 'duracion_suma', 'bytes_enviados', 'bytes_recibidos'):
+                acumulado[clave] += datos[clave]
+            for i, valor in enumerate(datos['duracion_intervalos']):
+                acumulado['duracion_intervalos'][i] += valor
+            for clase, valor in datos['errores'].items():
+                acumulado['errores'][clase] = acumulado['errores'].get(clase, 0) + valor
+    return total
+
+
+def formatear(funciones):
+    """Devuelve las métricas en el formato de texto de Prometheus."""
+    lineas = [
+        f'# HELP {PREFIJO}_llamadas_total Peticiones HTTP enviadas a Moodle.',
+        f'# TYPE {PREFIJO}_llamadas_total counter',
+    ]
+    for wsfunction, datos in sorted(funciones.items()):
+        lineas.append(f'{PREFIJO}_llamadas_total{{wsfunction="{wsfunction}"}} {datos["llamadas"]}')
+
+    lineas += [
+        f'# HELP {PREFIJO}_errores_total Errores en las llamadas a Moodle, por clase.',
+        f'# TYPE {PREFIJO}_errores_total counter',
+    ]
+    for wsfunction, datos in sorted(funciones.items()):
+        for clase, valor in sorted(datos['errores'].items()):
+            lineas.append(
+                f'{PREFIJO}_errores_total{{wsfunction="{wsfunction}",clase="{clase}"}} {valor}'
+            )
+
+    lineas += [
+        f'# HELP {PREFIJO}_duracion_segundos Duración de las peticiones HTTP a Moodle.',
+        f'# TYPE {PREFIJO}_duracion_segundos histogram',
+    ]
+    for wsfunction, datos in sorted(funciones.items()):
+        etiqueta = f'wsfunction="{wsfunction}"'
+        for limite, valor in zip(LIMITES_DURACION, datos['duracion_intervalos']):
+            lineas.append(
+                f'{PREFIJO}_duracion_segundos_bucket{{{etiqueta},le="{limite}"}} {valor}'
+            )
+        lineas += [
+            f'{PREFIJO}_duracion_segundos_bucket{{{etiqueta},le="+Inf"}} {datos["llamadas"]}',
+            f'{PREFIJO}_duracion_segundos_sum{{{etiqueta}}} {datos["duracion_suma"]:.6f}',
+            f'{PREFIJO}_duracion_segundos_count{{{etiqueta}}} {datos["llamadas"]}',
+        ]
+
+    for clave, descripcion in (
+        ('bytes_enviados', 'Bytes enviados a Moodle en los parámetros de las peticiones.'),
+        ('bytes_recibidos', 'Bytes recibidos de Moodle en el cuerpo de las respuestas.'),
+    ):
+        lineas += [
+            f'# HELP {PREFIJO}_{clave}_total {descripcion}',
+            f'# TYPE {PREFIJO}_{clave}_total counter',
+        ]
+        for wsfunction, datos in sorted(funciones.items()):
+            lineas.append(f'{PREFIJO}_{clave}_total{{wsfunction="{wsfunction}"}} {datos[clave]}')
+
+    return '\n'.join(lineas) + '\n'
+
+
+metricas = MetricasMoodle(
+    directorio=get_config('METRICAS_MOODLE_DIR', None),
+    intervalo=get_config('METRICAS_MOODLE_INTERVALO', 10),
+)
@@ -0,0 +1,90 @@
+# Generated by Django 5.0.7 on 2026-10-18 11:27
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("geo", "0035_matriculaautomatica_curso"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OperacionMoodle",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "tipo",
+                    models.CharField(
+                        choices=[
+                            ("crear_categoria", "Crear categoría"),
+                            ("matricular_profesor", "Matricular profesor"),
+                            ("desmatricular", "Desmatricular"),
+                        ],
+                        max_length=30,
+                        verbose_name="Tipo",
+                    ),
+                ),
+                ("datos", models.JSONField(verbose_name="Datos")),
+                (
+                    "grupo",
+                    models.CharField(
+                        blank=True, db_index=True, max_length=50, verbose_name="Grupo"
+                    ),
+                ),
+                (
+                    "estado",
+                    models.IntegerField(
+                        choices=[(1, "Pendiente"), (2, "Enviada"), (3, "Fallida")],
+                        default=1,
+                        verbose_name="Estado",
+                    ),
+                ),
+                (
+                    "intentos",
+                    models.PositiveSmallIntegerField(default=0, verbose_name="Intentos"),
+                ),
+                (
+                    "error",
+                    models.TextField(blank=True, null=True, verbose_name="Último error"),
+                ),
+                (
+                    "fecha_creacion",
+                    models.DateTimeField(auto_now_add=True, verbose_name="Fecha de creación"),
+                ),
+                (
+                    "fecha_envio",
+                    models.DateTimeField(blank=True, null=True, verbose_name="Fecha de envío"),
+                ),
+                (
+                    "proximo_intento",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now,
+                        verbose_name="Próximo intento",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "operación en Moodle",
+                "verbose_name_plural": "operaciones en Moodle",
+                "db_table": "operacion_moodle",
+                "ordering": ("id",),
+                "indexes": [
+                    models.Index(
+                        fields=["estado", "proximo_intento"],
+                        name="operacion_m_estado_c8db58_idx",
+                    )
+                ],
+            },
+        ),
+    ]
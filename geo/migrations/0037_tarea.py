@@ -0,0 +1,123 @@
+# Generated by Django 5.0.7 on 2026-10-18 11:30
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("geo", "0036_operacionmoodle"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Tarea",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("nombre", models.CharField(max_length=100, verbose_name="Nombre")),
+                (
+                    "parametros",
+                    models.JSONField(default=dict, verbose_name="Parámetros"),
+                ),
+                (
+                    "prioridad",
+                    models.SmallIntegerField(
+                        choices=[(10, "Alta"), (20, "Normal"), (30, "Baja")],
+                        default=20,
+                        verbose_name="Prioridad",
+                    ),
+                ),
+                (
+                    "estado",
+                    models.IntegerField(
+                        choices=[
+                            (1, "Pendiente"),
+                            (2, "En curso"),
+                            (3, "Terminada"),
+                            (4, "Fallida"),
+                        ],
+                        default=1,
+                        verbose_name="Estado",
+                    ),
+                ),
+                (
+                    "intentos",
+                    models.PositiveSmallIntegerField(default=0, verbose_name="Intentos"),
+                ),
+                (
+                    "max_intentos",
+                    models.PositiveSmallIntegerField(default=3, verbose_name="Máx. intentos"),
+                ),
+                (
+                    "disponible_desde",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now,
+                        verbose_name="Disponible desde",
+                    ),
+                ),
+                (
+                    "trabajador",
+                    models.CharField(blank=True, max_length=100, verbose_name="Trabajador"),
+                ),
+                (
+                    "progreso",
+                    models.CharField(blank=True, max_length=255, verbose_name="Progreso"),
+                ),
+                (
+                    "resultado",
+                    models.JSONField(blank=True, null=True, verbose_name="Resultado"),
+                ),
+                (
+                    "error",
+                    models.TextField(blank=True, null=True, verbose_name="Último error"),
+                ),
+                (
+                    "fecha_creacion",
+                    models.DateTimeField(auto_now_add=True, verbose_name="Fecha de creación"),
+                ),
+                (
+                    "fecha_inicio",
+                    models.DateTimeField(blank=True, null=True, verbose_name="Fecha de inicio"),
+                ),
+                (
+                    "fecha_fin",
+                    models.DateTimeField(blank=True, null=True, verbose_name="Fecha de fin"),
+                ),
+                (
+                    "usuario",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="tareas",
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="Solicitada por",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "tarea",
+                "verbose_name_plural": "tareas",
+                "db_table": "tarea",
+                "ordering": ("-id",),
+                "indexes": [
+                    models.Index(
+                        fields=["estado", "prioridad", "disponible_desde"],
+                        name="tarea_estado_8a3ba6_idx",
+                    )
+                ],
+            },
+        ),
+    ]
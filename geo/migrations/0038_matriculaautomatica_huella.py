@@ -0,0 +1,34 @@
+# Generated by Django 5.0.7 on 2026-10-18 11:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("geo", "0037_tarea"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="matriculaautomatica",
+            name="fecha_sincronizacion",
+            field=models.DateTimeField(
+                null=True, verbose_name="Fecha de sincronización"
+            ),
+        ),
+        migrations.AddField(
+            model_name="matriculaautomatica",
+            name="huella_sigma",
+            field=models.CharField(
+                max_length=64, null=True, verbose_name="Huella de los NIPs de Sigma"
+            ),
+        ),
+        migrations.AddField(
+            model_name="matriculaautomatica",
+            name="num_sincronizados",
+            field=models.PositiveIntegerField(
+                null=True, verbose_name="NIPs sincronizados"
+            ),
+        ),
+    ]
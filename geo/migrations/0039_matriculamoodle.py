@@ -0,0 +1,69 @@
+# Generated by Django 5.0.7 on 2026-10-18 11:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def verificar_todos(apps, schema_editor):
+    """Hace que la próxima matriculación nocturna verifique todos los cursos en Moodle,
+    para llenar la copia local de las matrículas."""
+    MatriculaAutomatica = apps.get_model('geo', 'MatriculaAutomatica')
+    MatriculaAutomatica.objects.update(fecha_sincronizacion=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("geo", "0038_matriculaautomatica_huella"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MatriculaMoodle",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                (
+                    "nip",
+                    models.CharField(
+                        help_text="Nombre de usuario en Moodle.",
+                        max_length=100,
+                        verbose_name="NIP",
+                    ),
+                ),
+                (
+                    "rol",
+                    models.PositiveSmallIntegerField(
+                        blank=True, null=True, verbose_name="Rol en Moodle"
+                    ),
+                ),
+                (
+                    "origen",
+                    models.CharField(
+                        choices=[
+                            ("sigma", "Matrícula automática de Sigma"),
+                            ("geoda", "Matriculado desde Geoda"),
+                            ("moodle", "Encontrado al verificar Moodle"),
+                        ],
+                        max_length=10,
+                        verbose_name="Origen",
+                    ),
+                ),
+                ("fecha", models.DateTimeField(auto_now=True, verbose_name="Fecha")),
+                (
+                    "curso",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="matriculas_moodle",
+                        to="geo.curso",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "matrícula en Moodle",
+                "verbose_name_plural": "matrículas en Moodle",
+                "db_table": "matricula_moodle",
+                "unique_together": {("curso", "nip")},
+            },
+        ),
+        migrations.RunPython(verificar_todos, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,5 @@
 # Standard library
+from contextlib import contextmanager
 from time import time
 
 # Third-party
@@ -7,7 +8,7 @@ from annoying.functions import get_config, get_object_or_None
 # Django
 from django.contrib.auth import get_user_model
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import connection, models, transaction
 from django.db.models import Q
 from django.urls import reverse
 from django.utils import timezone
@@ -16,6 +17,33 @@ from django.utils.translation import gettext_lazy as _
 # Local Django
 from .wsclient import WSClient
 
+# Segundos que se espera a que otro proceso acabe de crear las categorías de un año.
+ESPERA_BLOQUEO_CATEGORIAS = get_config('ESPERA_BLOQUEO_CATEGORIAS', 600)
+
+
+@contextmanager
+def bloqueo_categorias(anyo):
+    """Impide que dos procesos creen a la vez las categorías de un mismo año.
+
+    Usa un bloqueo con nombre de MariaDB (`GET_LOCK`), que no necesita una transacción,
+    de modo que se mantiene también mientras se crean las categorías en Moodle.
+    Con otras bases de datos (SQLite en las pruebas) no se bloquea.
+    """
+    if connection.vendor != 'mysql':
+        yield
+        return
+
+    nombre = f'geoda_categorias_{anyo}'
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT GET_LOCK(%s, %s)', [nombre, ESPERA_BLOQUEO_CATEGORIAS])
+        if cursor.fetchone()[0] != 1:
+            raise TimeoutError(f'Otro proceso está creando las categorías de {anyo}.')
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', [nombre])
+
 
 class Asignatura(models.Model):
     """Este modelo representa un grupo de una asignatura Sigma, de un estudio reglado.
@@ -175,22 +203,34 @@ class Categoria(models.Model):
 
     @classmethod
     def crear_desde_asignatura(cls, asignatura):
-        """Crea una categoría de plan de estudios para la asignatura indicada."""
-        supercategoria = get_object_or_None(
-            Categoria,
-            anyo_academico=asignatura.anyo_academico,
-            centro_id=asignatura.centro_id,
-            plan_id_nk=None,
-        )
-        if not supercategoria:
-            supercategoria = Categoria.crear_de_centro(asignatura)
-        return cls.crear(
-            asignatura.anyo_academico,
-            asignatura.nombre_estudio,
-            supercategoria.id,
-            asignatura.centro_id,
-            asignatura.plan_id_nk,
-        )
+        """Crea una categoría de plan de estudios para la asignatura indicada.
+
+        Si mientras tanto otro proceso la ha creado (p. ej. con `crear_arbol`), devuelve esa.
+        """
+        with bloqueo_categorias(asignatura.anyo_academico):
+            categoria = get_object_or_None(
+                Categoria,
+                anyo_academico=asignatura.anyo_academico,
+                centro_id=asignatura.centro_id,
+                plan_id_nk=asignatura.plan_id_nk,
+            )
+            if categoria:
+                return categoria
+            supercategoria = get_object_or_None(
+                Categoria,
+                anyo_academico=asignatura.anyo_academico,
+                centro_id=asignatura.centro_id,
+                plan_id_nk=None,
+            )
+            if not supercategoria:
+                supercategoria = Categoria.crear_de_centro(asignatura)
+            return cls.crear(
+                asignatura.anyo_academico,
+                asignatura.nombre_estudio,
+                supercategoria.id,
+                asignatura.centro_id,
+                asignatura.plan_id_nk,
+            )
 
     @classmethod
     def crear_de_centro(cls, asignatura):
@@ -226,16 +266,116 @@ class Categoria(models.Model):
             anyo_academico=anyo_academico,
         )
         nueva_categoria.save()
-        nueva_categoria.crear_en_plataforma()
+        try:
+            nueva_categoria.crear_en_plataforma()
+        except Exception:
+            nueva_categoria.delete()  # Moodle la ha rechazado
+            raise
         return nueva_categoria
 
     def crear_en_plataforma(self):
-        """Crea la categoría en la plataforma."""
-        cliente = WSClient()
-        datos_categoria = self.get_datos()
-        datos_recibidos = cliente.crear_categoria(datos_categoria)
-        self.id_nk = datos_recibidos['id']
-        self.save()
+        """Crea la categoría en la plataforma.
+
+        Si Moodle no está disponible, la creación queda pendiente y se envía más tarde,
+        y la categoría no tendrá `id_nk` hasta entonces.
+        """
+        (error,) = Categoria.crear_varias_en_plataforma([self])
+        if error:
+            raise error
+
+    @classmethod
+    def crear_varias_en_plataforma(cls, categorias):
+        """Crea varias categorías en la plataforma, por niveles y en lotes.
+
+        Se omiten las que ya existen en la plataforma o ya estaban pendientes de crear.
+        Devuelve, para cada categoría, `None` si se ha creado o ha quedado pendiente,
+        o la excepción con la que Moodle rechazó su creación.
+        """
+        from .operaciones import encolar_varias, rechazo
+
+        ya_pendientes = set(
+            OperacionMoodle.objects.filter(
+                tipo=OperacionMoodle.Tipo.CREAR_CATEGORIA,
+                datos__categoria_id__in=[categoria.id for categoria in categorias],
+                estado=OperacionMoodle.Estado.PENDIENTE,
+            ).values_list('datos__categoria_id', flat=True)
+        )
+        nuevas = [c for c in categorias if not c.id_nk and c.id not in ya_pendientes]
+        with transaction.atomic(durable=True):
+            operaciones = encolar_varias(
+                OperacionMoodle.Tipo.CREAR_CATEGORIA,
+                [{'categoria_id': categoria.id} for categoria in nuevas],
+            )
+        errores = [rechazo(operacion) for operacion in operaciones]
+
+        id_nk = dict(cls.objects.filter(pk__in=[c.id for c in nuevas]).values_list('id', 'id_nk'))
+        error_de_id = {}
+        for categoria, error in zip(nuevas, errores):
+            categoria.id_nk = id_nk[categoria.id]
+            error_de_id[categoria.id] = error
+        return [error_de_id.get(categoria.id) for categoria in categorias]
+
+    @classmethod
+    def crear_arbol(cls, anyo):
+        """Crea las categorías de año, centro y plan que necesitan las asignaturas del año.
+
+        Las categorías que faltan se crean por niveles, primero en Geoda con una consulta
+        por nivel, y luego en la plataforma con una petición por nivel.
+        Devuelve un índice {(centro_id, plan_id_nk): categoria} con todo el árbol del año
+        (la categoría del año tiene la clave `(None, None)`), y la lista de errores.
+        """
+        estudios = (
+            Asignatura.objects.filter(anyo_academico=anyo)
+            .values_list('centro_id', 'nombre_centro', 'plan_id_nk', 'nombre_estudio')
+            .order_by('centro_id', 'plan_id_nk')
+            .distinct()
+        )
+        # Los nodos que hacen falta, por niveles: {clave: (nombre, clave de la superior)}
+        niveles = [{(None, None): (f'Cursos {anyo}-{anyo + 1}', None)}, {}, {}]
+        for centro_id, nombre_centro, plan_id_nk, nombre_estudio in estudios:
+            niveles[1].setdefault((centro_id, None), (nombre_centro, (None, None)))
+            niveles[2].setdefault((centro_id, plan_id_nk), (nombre_estudio, (centro_id, None)))
+
+        # Se crean con el bloqueo de categorías del año, hasta crearlas en la plataforma,
+        # de modo que otra tarea que esté creando el mismo árbol espere a que acabemos,
+        # y vea luego las categorías que hemos creado.  Las de año y centro no se pueden
+        # proteger con la restricción única, porque sus `plan_id_nk` y `centro_id` son NULL.
+        with bloqueo_categorias(anyo):
+            indice = cls._indice_arbol(anyo)
+            for nivel in niveles:
+                faltan = [
+                    cls(
+                        plataforma_id=1,
+                        nombre=nombre,
+                        supercategoria=indice[superior] if superior else None,
+                        centro_id=centro_id,
+                        plan_id_nk=plan_id_nk,
+                        anyo_academico=anyo,
+                    )
+                    for (centro_id, plan_id_nk), (nombre, superior) in nivel.items()
+                    if (centro_id, plan_id_nk) not in indice
+                ]
+                if faltan:
+                    cls.objects.bulk_create(faltan)
+                    indice = cls._indice_arbol(anyo)
+
+            sin_crear = [categoria for categoria in indice.values() if not categoria.id_nk]
+            errores = [
+                f'{categoria}: {error}'
+                for categoria, error in zip(sin_crear, cls.crear_varias_en_plataforma(sin_crear))
+                if error
+            ]
+        return indice, errores
+
+    @classmethod
+    def _indice_arbol(cls, anyo):
+        """Devuelve las categorías de año, centro y plan del año, por (centro_id, plan_id_nk)."""
+        return {
+            (categoria.centro_id, categoria.plan_id_nk): categoria
+            for categoria in cls.objects.filter(anyo_academico=anyo).filter(
+                Q(supercategoria=None) | Q(centro_id__isnull=False)
+            )
+        }
 
     def get_datos(self):
         """Devuelve los datos necesarios para crear la categoría en Moodle usando WS.
@@ -372,7 +512,7 @@ class Curso(models.Model):
     def get_absolute_url(self):
         return reverse('curso_detail', args=[self.id])
 
-    def actualizar_tras_creacion(self, datos_recibidos):
+    def actualizar_tras_creacion(self, datos_recibidos, guardar=True):
         """Actualiza el modelo con los datos recibidos de Moodle al crear el curso."""
 
         self.id_nk = datos_recibidos['id']
@@ -380,15 +520,47 @@ class Curso(models.Model):
         url_plataforma = get_config('URL_PLATAFORMA')
         self.url = f'{url_plataforma}/course/view.php?id={self.id_nk}'
         self.estado = Curso.Estado.CREADO
-        self.save()
+        if guardar:
+            self.save()
 
     def anyadir_profesor(self, usuario):
-        """Añade al usuario a la lista de profesores del curso en GEO, y lo matricula en Moodle."""
-        cliente = WSClient()
-        cliente.matricular_profesor(usuario, self)
-        pc = ProfesorCurso.objects.create(curso=self, profesor=usuario, fecha_alta=timezone.now())
+        """Añade al usuario a la lista de profesores del curso en GEO, y lo matricula en Moodle.
+
+        Si Moodle no está disponible, la matrícula queda pendiente y se envía más tarde.
+        """
+        ((pc, error),) = self.anyadir_profesores([usuario])
+        if error:
+            raise error
         return pc
 
+    def anyadir_profesores(self, usuarios):
+        """Añade a los usuarios como profesores del curso en GEO, y los matricula en Moodle.
+
+        Todos se buscan en Moodle y se matriculan a la vez, en el orden indicado.
+        Devuelve, para cada usuario, la asignación `ProfesorCurso` creada y `None`,
+        o `None` y la excepción por la que no se pudo matricular.
+        Si Moodle no está disponible, las matrículas quedan pendientes y se envían más tarde.
+        """
+        from .operaciones import encolar_varias, rechazo
+
+        ahora = timezone.now()
+        with transaction.atomic(durable=True):
+            asignaciones = ProfesorCurso.objects.bulk_create(
+                ProfesorCurso(curso=self, profesor=usuario, fecha_alta=ahora)
+                for usuario in usuarios
+            )
+            operaciones = encolar_varias(
+                OperacionMoodle.Tipo.MATRICULAR_PROFESOR,
+                [{'usuario_id': usuario.id, 'curso_id': self.id} for usuario in usuarios],
+                grupo=f'curso:{self.id}',
+            )
+        # Los profesores que Moodle ha rechazado no quedan asignados al curso.
+        errores = [rechazo(operacion) for operacion in operaciones]
+        ProfesorCurso.objects.filter(
+            pk__in=[pc.pk for pc, error in zip(asignaciones, errores) if error]
+        ).delete()
+        return [(None, error) if error else (pc, None) for pc, error in zip(asignaciones, errores)]
+
     def borrar_en_plataforma(self):
         """Borra el curso en Moodle."""
         cliente = WSClient()
@@ -574,6 +746,10 @@ class MatriculaAutomatica(models.Model):
             ' se puede impartir en varios centros.'
         ),
     )
+    # Resultado de la última sincronización nocturna completa con Moodle (véase `sincronizacion`).
+    huella_sigma = models.CharField(_('Huella de los NIPs de Sigma'), max_length=64, null=True)
+    fecha_sincronizacion = models.DateTimeField(_('Fecha de sincronización'), null=True)
+    num_sincronizados = models.PositiveIntegerField(_('NIPs sincronizados'), null=True)
 
     class Meta:
         db_table = 'matricula_automatica'
@@ -611,6 +787,80 @@ class Matriculacion(models.Model):
         db_table = 'matriculacion'
 
 
+class MatriculaMoodle(models.Model):
+    """Copia local de una matrícula de un usuario en un curso de Moodle.
+
+    Se anota cada vez que Geoda matricula o desmatricula a alguien, y se corrige
+    con lo que hay en Moodle cuando la matriculación nocturna verifica el curso,
+    de modo que para saber a quién falta matricular no hay que descargar cada día
+    la lista de matriculados de todos los cursos.  Véase `geo/sincronizacion.py`.
+    """
+
+    class Origen(models.TextChoices):
+        SIGMA = 'sigma', _('Matrícula automática de Sigma')
+        GEODA = 'geoda', _('Matriculado desde Geoda')
+        MOODLE = 'moodle', _('Encontrado al verificar Moodle')
+
+    id = models.BigAutoField(primary_key=True)
+    curso = models.ForeignKey('Curso', on_delete=models.CASCADE, related_name='matriculas_moodle')
+    nip = models.CharField(_('NIP'), max_length=100, help_text=_('Nombre de usuario en Moodle.'))
+    rol = models.PositiveSmallIntegerField(_('Rol en Moodle'), blank=True, null=True)
+    origen = models.CharField(_('Origen'), max_length=10, choices=Origen)
+    fecha = models.DateTimeField(_('Fecha'), auto_now=True)
+
+    class Meta:
+        db_table = 'matricula_moodle'
+        unique_together = (('curso', 'nip'),)
+        verbose_name = _('matrícula en Moodle')
+        verbose_name_plural = _('matrículas en Moodle')
+
+    def __str__(self):
+        return f'{self.nip} @ {self.curso_id}'
+
+
+class OperacionMoodle(models.Model):
+    """Operación que modifica Moodle, pendiente de enviar o ya enviada.
+
+    Se guarda en la misma transacción que el cambio local correspondiente,
+    de modo que si Moodle no está disponible la operación no se pierde,
+    y la orden `enviar_operaciones_moodle` la reintenta más tarde.
+    Véase `geo/operaciones.py`.
+    """
+
+    class Tipo(models.TextChoices):
+        CREAR_CATEGORIA = 'crear_categoria', _('Crear categoría')
+        MATRICULAR_PROFESOR = 'matricular_profesor', _('Matricular profesor')
+        DESMATRICULAR = 'desmatricular', _('Desmatricular')
+
+    class Estado(models.IntegerChoices):
+        PENDIENTE = 1, _('Pendiente')
+        ENVIADA = 2, _('Enviada')
+        FALLIDA = 3, _('Fallida')
+
+    tipo = models.CharField(max_length=30, choices=Tipo, verbose_name=_('Tipo'))
+    datos = models.JSONField(verbose_name=_('Datos'))
+    # Las operaciones de un mismo grupo (p. ej. de un curso) se envían en orden.
+    grupo = models.CharField(max_length=50, blank=True, db_index=True, verbose_name=_('Grupo'))
+    estado = models.IntegerField(
+        choices=Estado, default=Estado.PENDIENTE, verbose_name=_('Estado')
+    )
+    intentos = models.PositiveSmallIntegerField(default=0, verbose_name=_('Intentos'))
+    error = models.TextField(blank=True, null=True, verbose_name=_('Último error'))
+    fecha_creacion = models.DateTimeField(auto_now_add=True, verbose_name=_('Fecha de creación'))
+    fecha_envio = models.DateTimeField(blank=True, null=True, verbose_name=_('Fecha de envío'))
+    proximo_intento = models.DateTimeField(default=timezone.now, verbose_name=_('Próximo intento'))
+
+    class Meta:
+        db_table = 'operacion_moodle'
+        ordering = ('id',)
+        indexes = [models.Index(fields=['estado', 'proximo_intento'])]
+        verbose_name = _('operación en Moodle')
+        verbose_name_plural = _('operaciones en Moodle')
+
+    def __str__(self):
+        return f'{self.get_tipo_display()} {self.datos} ({self.get_estado_display()})'
+
+
 class Plan(models.Model):
     """
     Modelo para representar un plan de estudios.
@@ -727,3 +977,67 @@ class RightsSupport(models.Model):
             ('matricular_plan', _('Puede matricular en un curso a todos los alumnos de un plan')),
             ('anyadir_alumnos', _('Puede matricular alumnos en un curso')),
         )
+
+
+class Tarea(models.Model):
+    """Trabajo que se ejecuta en segundo plano, fuera del ciclo petición/respuesta.
+
+    La orden `procesar_tareas` las va tomando de la cola por orden de prioridad.
+    Véase `geo/tareas.py`.
+    """
+
+    class Estado(models.IntegerChoices):
+        PENDIENTE = 1, _('Pendiente')
+        EN_CURSO = 2, _('En curso')
+        TERMINADA = 3, _('Terminada')
+        FALLIDA = 4, _('Fallida')
+
+    class Prioridad(models.IntegerChoices):
+        ALTA = 10, _('Alta')
+        NORMAL = 20, _('Normal')
+        BAJA = 30, _('Baja')
+
+    nombre = models.CharField(max_length=100, verbose_name=_('Nombre'))
+    parametros = models.JSONField(default=dict, verbose_name=_('Parámetros'))
+    prioridad = models.SmallIntegerField(
+        choices=Prioridad, default=Prioridad.NORMAL, verbose_name=_('Prioridad')
+    )
+    estado = models.IntegerField(
+        choices=Estado, default=Estado.PENDIENTE, verbose_name=_('Estado')
+    )
+    intentos = models.PositiveSmallIntegerField(default=0, verbose_name=_('Intentos'))
+    max_intentos = models.PositiveSmallIntegerField(default=3, verbose_name=_('Máx. intentos'))
+    # Una tarea pendiente no se ejecuta antes de esta fecha, y una tarea en curso
+    # se considera abandonada (p. ej. porque el proceso murió) a partir de ella.
+    disponible_desde = models.DateTimeField(
+        default=timezone.now, verbose_name=_('Disponible desde')
+    )
+    trabajador = models.CharField(max_length=100, blank=True, verbose_name=_('Trabajador'))
+    progreso = models.CharField(max_length=255, blank=True, verbose_name=_('Progreso'))
+    resultado = models.JSONField(blank=True, null=True, verbose_name=_('Resultado'))
+    error = models.TextField(blank=True, null=True, verbose_name=_('Último error'))
+    usuario = models.ForeignKey(
+        'accounts.CustomUser',
+        models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name='tareas',
+        verbose_name=_('Solicitada por'),
+    )
+    fecha_creacion = models.DateTimeField(auto_now_add=True, verbose_name=_('Fecha de creación'))
+    fecha_inicio = models.DateTimeField(blank=True, null=True, verbose_name=_('Fecha de inicio'))
+    fecha_fin = models.DateTimeField(blank=True, null=True, verbose_name=_('Fecha de fin'))
+
+    class Meta:
+        db_table = 'tarea'
+        ordering = ('-id',)
+        indexes = [models.Index(fields=['estado', 'prioridad', 'disponible_desde'])]
+        verbose_name = _('tarea')
+        verbose_name_plural = _('tareas')
+
+    def __str__(self):
+        return f'{self.nombre} #{self.id} ({self.get_estado_display()})'
+
+    @property
+    def esta_acabada(self):
+        return self.estado in (self.Estado.TERMINADA, self.Estado.FALLIDA)
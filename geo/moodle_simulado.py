@@ -0,0 +1,461 @@
+"""Imitación del Web Service REST de Moodle (`webservice/rest/server.php`), para pruebas.
+
+Implementa, sobre datos en memoria, las funciones del Web Service que usa Geoda,
+con una latencia, una tasa de errores y un tamaño de respuesta configurables,
+de modo que se puede medir el rendimiento de `WSClient` y de las sincronizaciones
+sin necesidad de un Moodle real.
+
+Se puede usar dentro del propio proceso, montándolo en una sesión de `requests`:
+
+    moodle = MoodleSimulado(latencia=0.05)
+    cliente = WSClient(sesion=moodle.sesion())
+    cliente.api_url = moodle.api_url
+
+o como servidor HTTP local, con la orden `manage.py moodle_simulado`.
+"""
+
+# Standard library
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# Third-party
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+URL_SIMULADA = 'http://moodle.simulado'
+RUTA_SERVICIO = '/webservice/rest/server.php'
+
+
+class ExcepcionMoodle(Exception):
+    """Error que Moodle devuelve como un JSON con la clave `exception`."""
+
+    def __init__(self, errorcode, message, exception='moodle_exception'):
+        super().__init__(message)
+        self.errorcode = errorcode
+        self.exception = exception
+
+    def como_json(self):
+        return {'exception': self.exception, 'errorcode': self.errorcode, 'message': str(self)}
+
+
+def separar_llamada(parametros):
+    """Separa la `wsfunction` de los parámetros propios de la función."""
+    wsfunction = dict(parametros).get('wsfunction', '')
+    generales = ('wstoken', 'wsfunction', 'moodlewsrestformat')
+    return wsfunction, [(clave, valor) for clave, valor in parametros if clave not in generales]
+
+
+def desanidar(parametros):
+    """Convierte los parámetros de PHP (`enrolments[0][userid]=…`) en listas y diccionarios."""
+    raiz = {}
+    for clave, valor in parametros:
+        partes = re.findall(r'[^\[\]]+', clave)
+        nodo = raiz
+        for parte in partes[:-1]:
+            nodo = nodo.setdefault(parte, {})
+        nodo[partes[-1]] = valor
+    return _listas(raiz)
+
+
+def _listas(nodo):
+    if not isinstance(nodo, dict):
+        return nodo
+    if nodo and all(clave.isdigit() for clave in nodo):
+        return [_listas(nodo[clave]) for clave in sorted(nodo, key=int)]
+    return {clave: _listas(valor) for clave, valor in nodo.items()}
+
+
+class MoodleSimulado:
+    """Moodle en memoria.
+
+    - `latencia`: segundos que tarda cada llamada, más un valor aleatorio entre 0 y `dispersion`.
+    - `tasa_errores`: proporción de llamadas que fallan con un error HTTP 503.
+    - `relleno`: nº de caracteres de la descripción de cada usuario, para simular perfiles
+      completos en las respuestas que no limitan los campos de usuario.
+    - `usuarios_automaticos`: si es `True`, cualquier NIP se considera existente en Moodle,
+      salvo una proporción `tasa_desconocidos` de ellos (siempre los mismos para una semilla).
+    """
+
+    def __init__(
+        self,
+        latencia=0.0,
+        dispersion=0.0,
+        tasa_errores=0.0,
+        relleno=0,
+        usuarios_automaticos=True,
+        tasa_desconocidos=0.0,
+        semilla=0,
+    ):
+        self.latencia = latencia
+        self.dispersion = dispersion
+        self.tasa_errores = tasa_errores
+        self.relleno = relleno
+        self.usuarios_automaticos = usuarios_automaticos
+        self.tasa_desconocidos = tasa_desconocidos
+        self.semilla = semilla
+        self.api_url = URL_SIMULADA + RUTA_SERVICIO
+        self._azar = random.Random(semilla)
+        self._lock = threading.RLock()
+        self.reiniciar()
+
+    def reiniciar(self):
+        """Borra todos los datos."""
+        with self._lock:
+            self.usuarios = {}  # id → usuario
+            self.categorias = {}  # id → categoría
+            self.cursos = {}  # id → curso
+            self.matriculas = {}  # ueid → {'userid', 'courseid', 'roleid', 'timestart'}
+            self.sigma = []  # registros creados con `local_geodaws_matricula`
+            self.llamadas = {}  # wsfunction → nº de llamadas recibidas
+            self._ultimo_id = 0
+
+    # Datos de ejemplo
+
+    def crear_usuario(self, username, idnumber=None, email=None, id=None):
+        """Añade un usuario a Moodle, y lo devuelve."""
+        with self._lock:
+            if id is None:
+                id = int(username) if str(username).isdigit() else self._nuevo_id()
+            usuario = {
+                'id': id,
+                'username': str(username),
+                'idnumber': str(idnumber if idnumber is not None else username),
+                'email': email or f'{username}@unizar.es',
+                'firstname': f'Nombre {username}',
+                'lastname': f'Apellidos {username}',
+                'fullname': f'Nombre {username} Apellidos {username}',
+            }
+            self.usuarios[id] = usuario
+            return usuario
+
+    def matricular(self, userid, courseid, roleid=5):
+        """Matricula directamente a un usuario en un curso, y devuelve el `ueid`."""
+        with self._lock:
+            for ueid, matricula in self.matriculas.items():
+                if matricula['userid'] == userid and matricula['courseid'] == courseid:
+                    matricula['roleid'] = roleid
+                    return ueid
+            ueid = self._nuevo_id()
+            self.matriculas[ueid] = {
+                'userid': userid,
+                'courseid': courseid,
+                'roleid': roleid,
+                'timestart': int(time.time()),
+            }
+            return ueid
+
+    # Atención de las peticiones
+
+    def responder(self, wsfunction, parametros):
+        """Atiende una llamada al Web Service.
+
+        `parametros` es una lista de pares (clave, valor) tal como llegan en la petición.
+        Devuelve el código de estado HTTP y el cuerpo de la respuesta.
+        """
+        with self._lock:
+            self.llamadas[wsfunction] = self.llamadas.get(wsfunction, 0) + 1
+            espera = self.latencia + self._azar.uniform(0, self.dispersion)
+            falla = self._azar.random() < self.tasa_errores
+        if espera:
+            time.sleep(espera)
+        if falla:
+            return 503, b'Service Unavailable'
+
+        metodo = getattr(self, f'ws_{wsfunction}', None)
+        try:
+            if metodo is None:
+                raise ExcepcionMoodle(
+                    'accessexception',
+                    'Excepción al control de acceso',
+                    'webservice_access_exception',
+                )
+            with self._lock:
+                datos = metodo(**desanidar(parametros))
+        except ExcepcionMoodle as ex:
+            datos = ex.como_json()
+        except (KeyError, TypeError, ValueError) as ex:
+            datos = ExcepcionMoodle(
+                'invalidparameter',
+                f'Detectado valor de parámetro no válido ({ex})',
+                'invalid_parameter_exception',
+            ).como_json()
+        return 200, json.dumps(datos).encode('utf-8')
+
+    def sesion(self):
+        """Devuelve una sesión de `requests` que envía a este Moodle las peticiones a `api_url`."""
+        sesion = requests.Session()
+        sesion.mount(URL_SIMULADA, AdaptadorMoodleSimulado(self))
+        return sesion
+
+    def servir(self, host='127.0.0.1', puerto=0):
+        """Crea un servidor HTTP para este Moodle (sin arrancarlo) y actualiza `api_url`."""
+        servidor = ThreadingHTTPServer((host, puerto), ManejadorMoodleSimulado)
+        servidor.daemon_threads = True
+        servidor.moodle = self
+        self.api_url = f'http://{host}:{servidor.server_port}{RUTA_SERVICIO}'
+        return servidor
+
+    # Funciones del Web Service
+
+    def ws_core_course_create_categories(self, categories):
+        respuesta = []
+        for datos in categories:
+            id = self._nuevo_id()
+            self.categorias[id] = {
+                'id': id,
+                'name': datos['name'],
+                'parent': int(datos.get('parent') or 0),
+                'idnumber': datos.get('idnumber', ''),
+            }
+            respuesta.append({'id': id, 'name': datos['name']})
+        return respuesta
+
+    def ws_core_course_get_categories(self, criteria=(), addsubcategories=1):
+        categorias = list(self.categorias.values())
+        for criterio in criteria:
+            clave, valor = criterio['key'], criterio['value']
+            if clave in ('id', 'parent'):
+                valor = int(valor)
+            categorias = [c for c in categorias if c.get(clave) == valor]
+        return categorias
+
+    def ws_core_course_update_categories(self, categories):
+        for datos in categories:
+            categoria = self._obtener(self.categorias, datos['id'], 'categorías')
+            for clave in ('name', 'idnumber'):
+                if clave in datos:
+                    categoria[clave] = datos[clave]
+            if 'parent' in datos:
+                categoria['parent'] = int(datos['parent'])
+        return None
+
+    def ws_core_course_create_courses(self, courses):
+        # Como Moodle, si falla algún curso no se crea ninguno.
+        nombres = {curso['shortname'] for curso in self.cursos.values()}
+        for datos in courses:
+            if datos['shortname'] in nombres:
+                raise ExcepcionMoodle(
+                    'shortnametaken',
+                    f'El nombre corto ya se usa en otro curso ({datos["shortname"]})',
+                )
+            self._obtener(self.categorias, datos['categoryid'], 'categorías')
+            nombres.add(datos['shortname'])
+
+        respuesta = []
+        for datos in courses:
+            id = self._nuevo_id()
+            self.cursos[id] = {
+                'id': id,
+                'fullname': datos['fullname'],
+                'shortname': datos['shortname'],
+                'categoryid': int(datos['categoryid']),
+                'idnumber': datos.get('idnumber', ''),
+            }
+            respuesta.append({'id': id, 'shortname': datos['shortname']})
+        return respuesta
+
+    def ws_core_course_get_courses_by_field(self, field='', value=''):
+        cursos = list(self.cursos.values())
+        if field:
+            # El campo `category` de la consulta corresponde a `categoryid` en la respuesta.
+            clave = 'categoryid' if field == 'category' else field
+            cursos = [c for c in cursos if str(c.get(clave, '')) == str(value)]
+        return {'courses': cursos, 'warnings': []}
+
+    def ws_core_course_delete_courses(self, courseids):
+        warnings = []
+        for courseid in map(int, courseids):
+            if self.cursos.pop(courseid, None) is None:
+                warnings.append(
+                    {'item': 'course', 'itemid': courseid, 'warningcode': 'unknowncourseidnumber'}
+                )
+                continue
+            for ueid in [u for u, m in self.matriculas.items() if m['courseid'] == courseid]:
+                del self.matriculas[ueid]
+        return {'warnings': warnings}
+
+    def ws_core_enrol_get_enrolled_users(self, courseid, options=()):
+        curso = self._obtener(self.cursos, courseid, 'cursos')
+        opciones = {opcion['name']: opcion['value'] for opcion in options}
+        usuarios = [
+            self.usuarios[matricula['userid']]
+            for matricula in self.matriculas.values()
+            if matricula['courseid'] == curso['id']
+        ]
+        usuarios.sort(key=lambda usuario: usuario[opciones.get('sortby', 'id')])
+        inicio = int(opciones.get('limitfrom', 0))
+        limite = int(opciones.get('limitnumber', 0)) or len(usuarios)
+        usuarios = usuarios[inicio : inicio + limite]
+        if 'userfields' in opciones:
+            campos = set(opciones['userfields'].split(',')) | {'id'}
+            return [{k: v for k, v in u.items() if k in campos} for u in usuarios]
+        return [self._perfil(usuario) for usuario in usuarios]
+
+    def ws_core_enrol_unenrol_user_enrolment(self, ueid):
+        if self.matriculas.pop(int(ueid), None) is None:
+            return {'result': False, 'errors': [{'key': 'ueid', 'message': 'Matrícula no válida'}]}
+        return {'result': True, 'errors': []}
+
+    def ws_enrol_manual_enrol_users(self, enrolments):
+        for datos in enrolments:
+            self._obtener(self.usuarios, datos['userid'], 'usuarios')
+            self._obtener(self.cursos, datos['courseid'], 'cursos')
+        for datos in enrolments:
+            self.matricular(int(datos['userid']), int(datos['courseid']), int(datos['roleid']))
+        return None
+
+    def ws_enrol_manual_unenrol_users(self, enrolments):
+        for datos in enrolments:
+            for ueid, matricula in list(self.matriculas.items()):
+                if (matricula['userid'], matricula['courseid']) == (
+                    int(datos['userid']),
+                    int(datos['courseid']),
+                ):
+                    del self.matriculas[ueid]
+        return None
+
+    def ws_core_user_get_users(self, criteria):
+        usuarios = None
+        for criterio in criteria:
+            encontrados = self._buscar_usuarios(criterio['key'], criterio['value'])
+            usuarios = (
+                encontrados
+                if usuarios is None
+                else [u for u in usuarios if u['id'] in {e['id'] for e in encontrados}]
+            )
+        return {'users': [self._perfil(u) for u in usuarios or []], 'warnings': []}
+
+    def ws_core_user_get_users_by_field(self, field, values=()):
+        usuarios = {}
+        for valor in values:
+            for usuario in self._buscar_usuarios(field, valor):
+                usuarios[usuario['id']] = usuario
+        return [self._perfil(usuario) for usuario in usuarios.values()]
+
+    def ws_local_geodaws_get_user_enrolments(self, usuario_id_nk, curso_id_nk):
+        return [
+            {'id': ueid}
+            for ueid, matricula in self.matriculas.items()
+            if (matricula['userid'], matricula['courseid'])
+            == (int(usuario_id_nk), int(curso_id_nk))
+        ]
+
+    def ws_local_geodaws_matricula(self, **datos):
+        self.sigma.append(datos)
+        return 'Registro creado'
+
+    # Auxiliares
+
+    def _nuevo_id(self):
+        # Ids altos, para no coincidir con los de los usuarioNip (que son el NIP).
+        self._ultimo_id += 1
+        return 900_000_000 + self._ultimo_id
+
+    @staticmethod
+    def _obtener(tabla, id, nombre_tabla):
+        try:
+            return tabla[int(id)]
+        except KeyError:
+            raise ExcepcionMoodle(
+                'invalidrecord',
+                f'No se puede encontrar el registro en la tabla de {nombre_tabla}',
+                'dml_missing_record_exception',
+            )
+
+    def _buscar_usuarios(self, campo, valor):
+        valor = str(valor)
+        if campo in ('username', 'idnumber') and valor.isdigit():
+            self._crear_usuario_automatico(valor)
+        if campo == 'id':
+            return [self.usuarios[int(valor)]] if int(valor) in self.usuarios else []
+        return [u for u in self.usuarios.values() if u.get(campo) == valor]
+
+    def _crear_usuario_automatico(self, nip):
+        """Crea el usuarioNip y el usuarioCorreo de un NIP, si no se considera desconocido."""
+        if not self.usuarios_automaticos or int(nip) in self.usuarios:
+            return
+        if random.Random(f'{self.semilla}:{nip}').random() < self.tasa_desconocidos:
+            return
+        self.crear_usuario(nip)
+        self.crear_usuario(f'u{nip}@unizar.es', idnumber=nip, email=f'u{nip}@unizar.es')
+
+    def _perfil(self, usuario):
+        """Devuelve el usuario con todos sus campos, como los devuelve Moodle por omisión."""
+        perfil = dict(usuario)
+        if self.relleno:
+            perfil['description'] = 'x' * self.relleno
+        return perfil
+
+
+def parametros_peticion(request):
+    """Devuelve los parámetros de la URL y del cuerpo de una petición de `requests`."""
+    parametros = parse_qsl(urlsplit(request.url).query, keep_blank_values=True)
+    cuerpo = request.body or ''
+    if isinstance(cuerpo, bytes):
+        cuerpo = cuerpo.decode('utf-8')
+    return parametros + parse_qsl(cuerpo, keep_blank_values=True)
+
+
+def crear_respuesta(request, estado, contenido):
+    """Construye la respuesta de `requests` a una petición, sin pasar por la red."""
+    respuesta = requests.Response()
+    respuesta.status_code = estado
+    respuesta._content = contenido
+    respuesta.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+    respuesta.encoding = 'utf-8'
+    respuesta.url = request.url
+    respuesta.request = request
+    return respuesta
+
+
+class AdaptadorMoodleSimulado(BaseAdapter):
+    """Adaptador de transporte de `requests` que envía las peticiones a un `MoodleSimulado`."""
+
+    def __init__(self, moodle):
+        super().__init__()
+        self.moodle = moodle
+
+    def send(self, request, **kwargs):
+        estado, contenido = self.moodle.responder(*separar_llamada(parametros_peticion(request)))
+        return crear_respuesta(request, estado, contenido)
+
+    def close(self):
+        pass
+
+
+class ManejadorMoodleSimulado(BaseHTTPRequestHandler):
+    """Atiende las peticiones HTTP al `MoodleSimulado` del servidor."""
+
+    protocol_version = 'HTTP/1.1'  # Necesario para mantener abiertas las conexiones
+    disable_nagle_algorithm = True  # Evita esperar el ACK retardado entre cabeceras y cuerpo
+
+    def _responder(self):
+        url = urlsplit(self.path)
+        parametros = parse_qsl(url.query, keep_blank_values=True)
+        longitud = int(self.headers.get('Content-Length', 0))
+        if longitud:
+            cuerpo = self.rfile.read(longitud).decode('utf-8')
+            parametros += parse_qsl(cuerpo, keep_blank_values=True)
+
+        if url.path != RUTA_SERVICIO:
+            estado, contenido = 404, b'Not Found'
+        else:
+            estado, contenido = self.server.moodle.responder(*separar_llamada(parametros))
+
+        self.send_response(estado)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(contenido)))
+        self.end_headers()
+        self.wfile.write(contenido)
+
+    do_GET = _responder
+    do_POST = _responder
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,431 @@
+"""Envío a Moodle de las operaciones guardadas en `OperacionMoodle`.
+
+Los cambios que afectan a Moodle (crear categorías, matricular y desmatricular profesores)
+se guardan como una `OperacionMoodle` en la misma transacción que el cambio local,
+y se intentan enviar en cuanto se confirma la transacción, de modo que Moodle nunca recibe
+un cambio que luego se deshace, ni se bloquean filas mientras se espera a Moodle
+(las operaciones se reservan en una transacción corta, y se envían después):
+
+- si Moodle los acepta, la operación queda como enviada;
+- si Moodle no está disponible (error de conexión, timeout, error 5xx...),
+  la operación queda pendiente, y el cambio local se mantiene;
+- si Moodle los rechaza, la operación queda como fallida, y quien la encoló puede deshacer
+  el cambio local tras la transacción (véase `rechazo`), que por eso debe ser la más externa
+  (`transaction.atomic(durable=True)`).
+
+La orden `enviar_operaciones_moodle` reintenta periódicamente las operaciones pendientes,
+respetando el orden de las de un mismo grupo, y enviando juntas las del mismo tipo.
+"""
+
+# Standard library
+from collections import Counter
+from datetime import timedelta
+from itertools import groupby
+
+# Third-party
+import requests
+
+# Django
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+# Local Django
+from .models import Categoria, Curso, MatriculaMoodle, OperacionMoodle
+from .sincronizacion import ROL_PROFESOR, anotar_bajas, anotar_matriculas
+from .wsclient import WSClient
+
+# Espera inicial y máxima entre reintentos de una operación.
+ESPERA_REINTENTO = timedelta(seconds=30)
+ESPERA_REINTENTO_MAX = timedelta(hours=1)
+# Tiempo durante el que una operación queda reservada para quien la está enviando.
+# Si este muere antes de anotar el resultado, pasado ese tiempo se vuelve a intentar.
+PLAZO_ENVIO = timedelta(minutes=10)
+
+
+class OperacionAplazada(Exception):
+    """La operación todavía no se puede enviar (p. ej. porque el curso aún no existe en Moodle)."""
+
+
+def es_transitorio(ex):
+    """Indica si el error se debe a que Moodle no está disponible, y merece la pena reintentar."""
+    if isinstance(ex, requests.exceptions.HTTPError) and ex.response is not None:
+        return ex.response.status_code >= 500 or ex.response.status_code == 429
+    return isinstance(ex, (OperacionAplazada, requests.exceptions.RequestException))
+
+
+def grupo_curso(curso):
+    return f'curso:{curso.id}'
+
+
+def hay_pendientes(grupo):
+    """Indica si hay operaciones del grupo pendientes de enviar a Moodle."""
+    return OperacionMoodle.objects.filter(
+        grupo=grupo, estado=OperacionMoodle.Estado.PENDIENTE
+    ).exists()
+
+
+def encolar(tipo, datos, grupo=''):
+    """Guarda una operación para Moodle, que se envía en cuanto se confirme la transacción.
+
+    Se debe llamar dentro de la transacción del cambio local, para que ambos se guarden,
+    o se deshagan, a la vez.  Esa transacción debe ser `transaction.atomic(durable=True)`:
+    dentro de otra más externa, el envío se retrasaría hasta que esta se confirmara,
+    y `rechazo` no podría saber a tiempo si Moodle rechaza la operación.
+    """
+    return encolar_varias(tipo, [datos], grupo)[0]
+
+
+def encolar_varias(tipo, lista_datos, grupo=''):
+    """Guarda varias operaciones del mismo tipo para Moodle, que se envían juntas
+    en cuanto se confirme la transacción.
+
+    `grupo` es el grupo de todas las operaciones, o una lista con el de cada una.
+    Devuelve las operaciones.  Tras la transacción, que debe ser durable (véase `encolar`),
+    `rechazo(operacion)` indica si Moodle rechazó cada una.
+    """
+    grupos = grupo if isinstance(grupo, list) else [grupo] * len(lista_datos)
+    operaciones = OperacionMoodle.objects.bulk_create(
+        OperacionMoodle(tipo=tipo, datos=datos, grupo=grupo_op)
+        for datos, grupo_op in zip(lista_datos, grupos)
+    )
+    if operaciones:
+        # Si el envío falla, las operaciones quedan pendientes para `enviar_pendientes`.
+        transaction.on_commit(lambda: enviar_ahora(operaciones), robust=True)
+    return operaciones
+
+
+def rechazo(operacion):
+    """Devuelve la excepción con la que Moodle rechazó la operación, o `None`.
+
+    Sólo tiene sentido tras confirmar la transacción en la que se encoló.
+    """
+    if operacion.estado == OperacionMoodle.Estado.FALLIDA:
+        return Exception(operacion.error)
+    return None
+
+
+def enviar_ahora(operaciones, cliente=None):
+    """Envía a Moodle las operaciones recién guardadas, y anota en ellas el resultado.
+
+    Las operaciones de grupos con otras anteriores sin enviar deben esperar a que se envíen,
+    y se quedan pendientes.
+    """
+    ids = [operacion.id for operacion in operaciones]
+    with transaction.atomic():
+        bloqueadas = list(
+            OperacionMoodle.objects.select_for_update(skip_locked=True)
+            .filter(
+                pk__in=ids,
+                estado=OperacionMoodle.Estado.PENDIENTE,
+                proximo_intento__lte=timezone.now(),
+            )
+            .order_by('id')
+        )
+        grupos_en_espera = set(
+            OperacionMoodle.objects.filter(
+                grupo__in={operacion.grupo for operacion in bloqueadas if operacion.grupo},
+                estado=OperacionMoodle.Estado.PENDIENTE,
+                id__lt=min(ids),
+            ).values_list('grupo', flat=True)
+        )
+        listas = [operacion for operacion in bloqueadas if operacion.grupo not in grupos_en_espera]
+        _reservar(listas)
+    _entregar_por_tipo(listas, cliente or WSClient())
+
+    enviadas = {operacion.id: operacion for operacion in listas}
+    for operacion in operaciones:
+        if operacion.id in enviadas:
+            for campo in ('estado', 'intentos', 'error', 'fecha_envio', 'proximo_intento'):
+                setattr(operacion, campo, getattr(enviadas[operacion.id], campo))
+
+
+def _reservar(operaciones):
+    """Reserva las operaciones bloqueadas para enviarlas fuera de la transacción.
+
+    Siguen pendientes, de modo que las siguientes de su grupo esperan,
+    pero nadie más las envía hasta que pase `PLAZO_ENVIO`.
+    """
+    ahora = timezone.now()
+    for operacion in operaciones:
+        operacion.intentos += 1
+        operacion.proximo_intento = ahora + PLAZO_ENVIO
+    OperacionMoodle.objects.bulk_update(operaciones, ['intentos', 'proximo_intento'])
+
+
+def _entregar_por_tipo(operaciones, cliente, resumen=None):
+    """Envía las operaciones, juntando las del mismo tipo, y anota el resultado de cada una."""
+    resumen = Counter() if resumen is None else resumen
+    for _tipo, del_tipo in groupby(
+        sorted(operaciones, key=lambda op: (op.tipo, op.id)), key=lambda op: op.tipo
+    ):
+        del_tipo = list(del_tipo)
+        for operacion, resultado in zip(del_tipo, entregar(del_tipo, cliente)):
+            resumen[anotar(operacion, resultado)] += 1
+    return resumen
+
+
+def enviar_pendientes(cliente=None, tamanyo=500):
+    """Envía a Moodle las operaciones pendientes a las que les toca reintentarse.
+
+    Devuelve un `Counter` con el número de operaciones enviadas, aplazadas y fallidas.
+    """
+    cliente = cliente or WSClient()
+    resumen = Counter()
+    while True:
+        with transaction.atomic():
+            listas = list(
+                _listas_para_enviar(timezone.now())
+                .select_for_update(skip_locked=True)
+                .order_by('id')[:tamanyo]
+            )
+            _reservar(listas)
+        _entregar_por_tipo(listas, cliente, resumen)
+
+        # Cada operación enviada sale de la consulta, ya sea porque se ha enviado, ha fallado
+        # o se ha aplazado, y al enviar las primeras de un grupo pueden quedar listas otras.
+        if not listas:
+            return resumen
+
+
+def _listas_para_enviar(ahora):
+    """Devuelve las operaciones que se pueden enviar ya.
+
+    De cada grupo sólo se puede enviar la primera operación pendiente,
+    y sólo cuando ha llegado su momento de reintentarse.
+    """
+    anteriores = OperacionMoodle.objects.filter(
+        grupo=OuterRef('grupo'), estado=OperacionMoodle.Estado.PENDIENTE, id__lt=OuterRef('id')
+    ).exclude(grupo='')
+    return OperacionMoodle.objects.filter(
+        estado=OperacionMoodle.Estado.PENDIENTE, proximo_intento__lte=ahora
+    ).exclude(Exists(anteriores))
+
+
+def entregar(operaciones, cliente):
+    """Envía a Moodle varias operaciones del mismo tipo.
+
+    Devuelve, para cada operación, `None` si se ha realizado, o la excepción producida.
+    """
+    funcion = ENTREGAS[operaciones[0].tipo]
+    resultados = funcion(cliente, operaciones)
+    if len(operaciones) > 1:
+        # Si Moodle rechaza un lote, puede ser por una sola de sus operaciones:
+        # se reintentan una a una para no arrastrar a las demás.
+        for i, (operacion, resultado) in enumerate(zip(operaciones, resultados)):
+            if resultado is not None and not es_transitorio(resultado):
+                resultados[i] = funcion(cliente, [operacion])[0]
+    return resultados
+
+
+def anotar(operacion, resultado):
+    """Guarda el resultado de un intento de envío, y devuelve cómo ha quedado la operación."""
+    if resultado is None:
+        operacion.estado = OperacionMoodle.Estado.ENVIADA
+        operacion.fecha_envio = timezone.now()
+        operacion.error = None
+        estado = 'enviadas'
+    elif es_transitorio(resultado):
+        espera = min(ESPERA_REINTENTO * 2 ** (operacion.intentos - 1), ESPERA_REINTENTO_MAX)
+        operacion.proximo_intento = timezone.now() + espera
+        operacion.error = str(resultado)
+        estado = 'aplazadas'
+    else:
+        operacion.estado = OperacionMoodle.Estado.FALLIDA
+        operacion.error = str(resultado)
+        estado = 'fallidas'
+    operacion.save()
+    return estado
+
+
+def _crear_categorias(cliente, operaciones):
+    """Crea las categorías por niveles, con una petición a Moodle por nivel."""
+    categorias = Categoria.objects.in_bulk({op.datos['categoria_id'] for op in operaciones})
+    superiores = Categoria.objects.in_bulk(
+        {c.supercategoria_id for c in categorias.values() if c.supercategoria_id}
+        - categorias.keys()
+    )
+    for categoria in categorias.values():
+        if categoria.supercategoria_id:
+            # Así, al crear una categoría, sus subcategorías ven su `id_nk`.
+            categoria.supercategoria = categorias.get(
+                categoria.supercategoria_id
+            ) or superiores.get(categoria.supercategoria_id)
+
+    resultados, pendientes = {}, list(operaciones)
+    while pendientes:
+        nivel, esperan = [], []
+        for operacion in pendientes:
+            categoria = categorias.get(operacion.datos['categoria_id'])
+            if categoria is None:
+                resultados[operacion.id] = Exception('La categoría ya no existe en Geoda.')
+            elif categoria.id_nk:
+                resultados[operacion.id] = None
+            elif categoria.supercategoria and not categoria.supercategoria.id_nk:
+                esperan.append(operacion)
+            else:
+                nivel.append(operacion)
+        if not nivel:
+            for operacion in esperan:
+                resultados[operacion.id] = OperacionAplazada(
+                    'La categoría superior todavía no se ha creado en Moodle.'
+                )
+            break
+        resultados.update(_crear_nivel_categorias(cliente, nivel, categorias))
+        pendientes = esperan
+    return [resultados[operacion.id] for operacion in operaciones]
+
+
+def _crear_nivel_categorias(cliente, operaciones, categorias):
+    """Crea en Moodle categorías cuyas categorías superiores ya existen en Moodle.
+
+    Devuelve un diccionario con el resultado de cada operación.
+    """
+    resultados, nuevas = {}, []
+    existentes = _subcategorias_existentes(
+        cliente, [op for op in operaciones if op.intentos > 1], categorias
+    )
+    for operacion in operaciones:
+        categoria = categorias[operacion.datos['categoria_id']]
+        datos_categoria = categoria.get_datos()
+        hermanas = existentes.get(datos_categoria['parent'] or 0, {})
+        if isinstance(hermanas, Exception):
+            resultados[operacion.id] = hermanas
+        elif datos_categoria['idnumber'] in hermanas:
+            _guardar_id_nk(categoria, hermanas[datos_categoria['idnumber']]['id'])
+            resultados[operacion.id] = None
+        else:
+            nuevas.append((operacion, categoria))
+
+    if not nuevas:
+        return resultados
+    respuestas = cliente.crear_categorias([categoria.get_datos() for _op, categoria in nuevas])
+    for (operacion, categoria), respuesta in zip(nuevas, respuestas):
+        if isinstance(respuesta, Exception):
+            resultados[operacion.id] = respuesta
+        else:
+            _guardar_id_nk(categoria, respuesta['id'])
+            resultados[operacion.id] = None
+    return resultados
+
+
+def _subcategorias_existentes(cliente, operaciones, categorias):
+    """Consulta en Moodle las subcategorías de las categorías superiores de las operaciones.
+
+    Si un intento anterior llegó a crear una categoría pero no recibimos la respuesta,
+    así no se duplica.  Se consulta una sola vez cada categoría superior.
+    Devuelve un diccionario {id_nk de la superior: {idnumber: datos}, o la excepción}.
+    """
+    existentes = {}
+    for operacion in operaciones:
+        superior = categorias[operacion.datos['categoria_id']].get_datos()['parent'] or 0
+        if superior in existentes:
+            continue
+        try:
+            existentes[superior] = {
+                c['idnumber']: c for c in cliente.buscar_categorias('parent', superior)
+            }
+        except Exception as ex:
+            existentes[superior] = ex
+    return existentes
+
+
+def _guardar_id_nk(categoria, id_nk):
+    categoria.id_nk = id_nk
+    Categoria.objects.filter(pk=categoria.pk).update(id_nk=id_nk)
+
+
+def _pares_usuario_curso(operaciones):
+    """Devuelve el usuario y el curso de cada operación, o la excepción si no existen."""
+    usuarios = get_user_model().objects.in_bulk({op.datos['usuario_id'] for op in operaciones})
+    cursos = Curso.objects.in_bulk({op.datos['curso_id'] for op in operaciones})
+    pares = []
+    for operacion in operaciones:
+        usuario = usuarios.get(operacion.datos['usuario_id'])
+        curso = cursos.get(operacion.datos['curso_id'])
+        if not usuario or not curso:
+            pares.append(Exception('El usuario o el curso ya no existen en Geoda.'))
+        elif not curso.id_nk:
+            pares.append(OperacionAplazada('El curso todavía no se ha creado en Moodle.'))
+        else:
+            pares.append((usuario, curso))
+    return pares
+
+
+def _matricular_profesores(cliente, operaciones):
+    pares = _pares_usuario_curso(operaciones)
+    try:
+        usuarios_moodle, _no_encontrados = cliente.buscar_usuarios_nip(
+            par[0].username.strip() for par in pares if isinstance(par, tuple)
+        )
+    except Exception as ex:
+        return [ex] * len(operaciones)
+    id_de_nip = {usuario['username']: usuario['id'] for usuario in usuarios_moodle}
+
+    resultados, matriculas, indices = [], [], {}
+    for i, par in enumerate(pares):
+        if not isinstance(par, tuple):
+            resultados.append(par)
+            continue
+        usuario, curso = par
+        nip = usuario.username.strip()
+        if nip not in id_de_nip:
+            resultados.append(
+                Exception(f'Usuario {usuario.full_name} (NIP {nip}) no encontrado en Moodle.')
+            )
+            continue
+        resultados.append(None)
+        clave = (id_de_nip[nip], int(curso.id_nk))
+        if clave not in indices:
+            matriculas.append({'roleid': ROL_PROFESOR, 'userid': clave[0], 'courseid': clave[1]})
+        indices.setdefault(clave, []).append(i)
+
+    _num, errores = cliente.enviar_matriculas(matriculas)
+    for lote, excepcion in errores:
+        for matricula in lote:
+            for i in indices[(matricula['userid'], matricula['courseid'])]:
+                resultados[i] = excepcion
+    anotar_matriculas(
+        _pares_correctos(pares, resultados), ROL_PROFESOR, MatriculaMoodle.Origen.GEODA
+    )
+    return resultados
+
+
+def _desmatricular(cliente, operaciones):
+    pares = _pares_usuario_curso(operaciones)
+    validos = [par for par in pares if isinstance(par, tuple)]
+    try:
+        respuestas = iter(cliente.desmatricular_varios(validos))
+    except Exception as ex:
+        return [ex] * len(operaciones)
+
+    resultados = []
+    for par in pares:
+        if not isinstance(par, tuple):
+            resultados.append(par)
+            continue
+        respuesta = next(respuestas)
+        if isinstance(respuesta, Exception):
+            resultados.append(respuesta)
+            continue
+        errores = [e.get('message') for r in respuesta for e in (r or {}).get('errors', [])]
+        resultados.append(Exception('; '.join(errores)) if errores else None)
+    anotar_bajas(_pares_correctos(pares, resultados))
+    return resultados
+
+
+def _pares_correctos(pares, resultados):
+    """Devuelve los pares (curso, NIP) de las operaciones que no han fallado."""
+    return [
+        (par[1], par[0].username.strip())
+        for par, resultado in zip(pares, resultados)
+        if isinstance(par, tuple) and resultado is None
+    ]
+
+
+ENTREGAS = {
+    OperacionMoodle.Tipo.CREAR_CATEGORIA: _crear_categorias,
+    OperacionMoodle.Tipo.MATRICULAR_PROFESOR: _matricular_profesores,
+    OperacionMoodle.Tipo.DESMATRICULAR: _desmatricular,
+}
@@ -1,6 +1,6 @@
 from ninja import ModelSchema, Schema
 
-from .models import Asignatura, MatriculaAutomatica
+from .models import Asignatura, MatriculaAutomatica, Tarea
 
 
 class AsignaturaSchema(ModelSchema):
@@ -30,3 +30,28 @@ class NotFoundSchema(Schema):
     """Single field returned when no model object is found for the ID provided."""
 
     message: str
+
+
+class TareaSchema(ModelSchema):
+    """Estado de una tarea en segundo plano."""
+
+    acabada: bool
+
+    class Config:
+        model = Tarea
+        model_fields = [
+            'id',
+            'nombre',
+            'estado',
+            'intentos',
+            'progreso',
+            'resultado',
+            'error',
+            'fecha_creacion',
+            'fecha_inicio',
+            'fecha_fin',
+        ]
+
+    @staticmethod
+    def resolve_acabada(tarea):
+        return tarea.esta_acabada
@@ -0,0 +1,353 @@
+# Standard library
+import asyncio
+import hashlib
+import operator
+from collections import defaultdict
+from datetime import timedelta
+from functools import reduce
+from itertools import chain
+
+# Third-party
+from annoying.functions import get_config
+
+# Django
+from django.db.models import Q
+from django.utils import timezone
+
+# Local Django
+from .aiowsclient import AsyncWSClient
+from .models import Calendario, Curso, MatriculaAutomatica, Matriculacion, MatriculaMoodle
+from .wsclient import WSClient
+
+ROL_ESTUDIANTE = 5  # id del rol `Student` en Moodle
+ROL_PROFESOR = 3  # id del rol `editingteacher` en Moodle
+
+# Los registros de un plan incluyen también a los estudiantes de movilidad:
+# 107 (estudio 449): Movilidad para 1º y 2º ciclo y grado
+# 266 (estudio 634): Movilidad para máster
+PLANES_MOVILIDAD = (107, 266)
+
+# Cada cuántos días se verifican en Moodle los matriculados en el curso de un registro,
+# para corregir la copia local de las matrículas (p. ej. si se han borrado a mano en Moodle),
+# aunque sus NIPs de Sigma no cambien.
+RECONCILIAR_DIAS = get_config('MATRICULAS_RECONCILIAR_DIAS', 7)
+
+
+class AgrupadorMatriculas:
+    """Acumula las matrículas de alumnos de varios registros, y las envía juntas a Moodle.
+
+    `enrol_manual_enrol_users` admite matrículas de varios cursos en una misma llamada,
+    así que en vez de buscar y matricular los usuarios de cada registro por separado,
+    se buscan todos los NIPs distintos en unas pocas llamadas masivas,
+    y se envían las matrículas de todos los cursos en lotes mixtos.
+    """
+
+    def __init__(self, cliente=None):
+        self.cliente = cliente or WSClient()
+        self.pendientes = []  # (registro, curso, NIPs a matricular)
+
+    def anyadir(self, registro, curso, nips):
+        """Añade las matrículas en el curso de los NIPs indicados para un registro."""
+        if nips:
+            self.pendientes.append((registro, curso, set(nips)))
+
+    def enviar(self):
+        """Matricula en Moodle todos los NIPs acumulados.
+
+        Devuelve un diccionario con, para cada registro, el número de estudiantes matriculados,
+        la lista de NIPs no encontrados en Moodle, y la lista de excepciones de las matrículas
+        que Moodle no ha aceptado.  Los errores de un lote no impiden que se envíen los demás.
+        """
+        todos_los_nips = set().union(*(nips for _r, _c, nips in self.pendientes))
+        usuarios, no_encontrados = self.cliente.buscar_usuarios_nip(todos_los_nips)
+        id_de_nip = {usuario['username']: usuario['id'] for usuario in usuarios}
+
+        # Dos registros del mismo curso pueden compartir estudiantes: sólo se matriculan una vez.
+        matriculas = {}
+        for _registro, curso, nips in self.pendientes:
+            for nip in sorted(nips & id_de_nip.keys()):
+                matriculas[(id_de_nip[nip], curso.id_nk)] = {
+                    'roleid': ROL_ESTUDIANTE,
+                    'userid': id_de_nip[nip],
+                    'courseid': curso.id_nk,
+                }
+        _num, errores = self.cliente.enviar_matriculas(list(matriculas.values()))
+        fallidas = {(m['userid'], m['courseid']): ex for lote, ex in errores for m in lote}
+
+        resultados, anotadas = {}, []
+        for registro, curso, nips in self.pendientes:
+            matriculados, excepciones = [], []
+            for nip in nips & id_de_nip.keys():
+                if (id_de_nip[nip], curso.id_nk) in fallidas:
+                    excepciones.append(fallidas[(id_de_nip[nip], curso.id_nk)])
+                else:
+                    matriculados.append(nip)
+            resultados[registro] = (
+                len(matriculados),
+                sorted(nips & set(no_encontrados)),
+                excepciones,
+            )
+            anotadas.extend((curso, nip) for nip in matriculados)
+        anotar_matriculas(anotadas, ROL_ESTUDIANTE, MatriculaMoodle.Origen.SIGMA)
+        self.pendientes = []
+        return resultados
+
+
+def registros_activos():
+    """Devuelve los registros activos de matrícula automática de los cursos del año actual."""
+    return list(
+        MatriculaAutomatica.objects.filter(
+            active=True,
+            curso__anyo_academico__in=Calendario.objects.filter(slug='actual').values('anyo'),
+        ).order_by('courseid', 'asignatura_nk', 'id')
+    )
+
+
+def buscar_nips_sigma(registros):
+    """Devuelve, para cada registro, los NIPs matriculados en Sigma que cumplen sus filtros.
+
+    En vez de lanzar una consulta por registro, se leen de una sola vez las filas
+    de la tabla `matriculacion` que cumplen los filtros de alguno de los registros,
+    y se reparten entre los registros.
+    """
+    if not registros:
+        return {}
+    filtros = [_filtro_sigma(registro) for registro in registros]
+    filas = Matriculacion.objects.values_list(
+        'asignatura_id', 'cod_grupo_asignatura', 'centro_id', 'plan_id', 'nip'
+    )
+    if all(filtros):
+        filas = filas.filter(reduce(operator.or_, filtros))
+
+    por_asignatura = defaultdict(list)
+    for asignatura_id, *resto in filas.iterator(chunk_size=10_000):
+        por_asignatura[asignatura_id].append(resto)
+
+    nips = {}
+    for registro in registros:
+        if registro.asignatura_nk:
+            candidatas = por_asignatura.get(registro.asignatura_nk, [])
+        else:
+            candidatas = chain.from_iterable(por_asignatura.values())
+        planes = (registro.plan_id, *PLANES_MOVILIDAD) if registro.plan_id else None
+        nips[registro] = {
+            str(nip)
+            for grupo, centro_id, plan_id, nip in candidatas
+            if (not registro.cod_grupo_asignatura or grupo == registro.cod_grupo_asignatura)
+            and (not registro.centro_id or centro_id == registro.centro_id)
+            and (not planes or plan_id in planes)
+        }
+    return nips
+
+
+def _filtro_sigma(registro):
+    """Devuelve el filtro de las filas de `matriculacion` de un registro (vacío si no filtra)."""
+    filtro = Q()
+    if registro.asignatura_nk:
+        filtro &= Q(asignatura_id=registro.asignatura_nk)
+    if registro.cod_grupo_asignatura:
+        filtro &= Q(cod_grupo_asignatura=registro.cod_grupo_asignatura)
+    if registro.centro_id:
+        filtro &= Q(centro_id=registro.centro_id)
+    if registro.plan_id:
+        filtro &= Q(plan_id__in=(registro.plan_id, *PLANES_MOVILIDAD))
+    return filtro
+
+
+def matricular_registros(registros, cliente=None, completa=False):
+    """Matricula en Moodle a los estudiantes de Sigma de los registros de matrícula automática.
+
+    Los NIPs de Sigma de todos los registros se calculan de una vez, y los cursos se cargan
+    con una sola consulta.  Los registros cuyos NIPs de Sigma no han cambiado se omiten.
+    Para los demás, los que faltan por matricular se calculan con la copia local
+    de las matrículas de Moodle (`MatriculaMoodle`), salvo que toque verificar el curso:
+    en ese caso se piden a Moodle los matriculados, a la vez para varios cursos
+    (como mucho `WS_CONCURRENCIA`), y se corrige la copia local.
+    Toca verificar un curso si se pide una sincronización `completa`, o si hace más de
+    `MATRICULAS_RECONCILIAR_DIAS` días que no se verifica.
+    Las matrículas de todos los registros se envían juntas.
+
+    Devuelve, para cada registro, un diccionario con las cifras del resumen,
+    si se ha omitido por no tener cambios o se ha verificado en Moodle, y el error, si lo hubo.
+    """
+    cliente = cliente or WSClient()
+    nips_sigma = buscar_nips_sigma(registros)
+    huellas = {registro: calcular_huella(registro, nips) for registro, nips in nips_sigma.items()}
+    limite = None if completa else timezone.now() - timedelta(days=RECONCILIAR_DIAS)
+    cursos = {
+        int(curso.id_nk): curso
+        for curso in Curso.objects.filter(id_nk__in={str(r.courseid) for r in registros})
+    }
+
+    resultados = {
+        registro: {
+            'registro': registro,
+            'en_sigma': len(nips_sigma[registro]),
+            'ya_matriculados': 0,
+            'a_matricular': 0,
+            'matriculados': 0,
+            'no_encontrados': 0,
+            'verificado': _toca_verificar(registro, limite),
+            'sin_cambios': _sin_cambios(registro, huellas[registro], limite),
+            'error': None if registro.courseid in cursos else 'Curso no encontrado en Geoda',
+        }
+        for registro in registros
+    }
+    a_sincronizar = {
+        registro: resultado
+        for registro, resultado in resultados.items()
+        if not resultado['error'] and not resultado['sin_cambios']
+    }
+    for registro, resultado in a_sincronizar.items():
+        # Si no hay estudiantes en Sigma, no hay nada que comprobar en Moodle.
+        resultado['verificado'] = resultado['verificado'] and bool(nips_sigma[registro])
+    a_verificar = {
+        registro.courseid
+        for registro, resultado in a_sincronizar.items()
+        if resultado['verificado']
+    }
+    en_moodle = _buscar_matriculados([cursos[courseid] for courseid in a_verificar], cliente)
+    _corregir_copia_local({cursos[courseid]: nips for courseid, nips in en_moodle.items()})
+    en_copia_local = matriculados_segun_copia_local(
+        [cursos[r.courseid] for r in a_sincronizar if r.courseid not in a_verificar]
+    )
+
+    agrupador = AgrupadorMatriculas(cliente)
+    for registro, resultado in a_sincronizar.items():
+        curso = cursos[registro.courseid]
+        if registro.courseid in en_moodle:
+            ya_matriculados = en_moodle[registro.courseid]
+        else:
+            ya_matriculados = en_copia_local[curso.id]
+        if isinstance(ya_matriculados, Exception):
+            resultado['error'] = f'Error al consultar el curso Moodle: {ya_matriculados}'
+            continue
+        a_matricular = nips_sigma[registro] - ya_matriculados
+        resultado['ya_matriculados'] = resultado['en_sigma'] - len(a_matricular)
+        resultado['a_matricular'] = len(a_matricular)
+        agrupador.anyadir(registro, curso, a_matricular)
+
+    _enviar(agrupador, resultados)
+    _guardar_huellas(a_sincronizar, huellas)
+    return list(resultados.values())
+
+
+def anotar_matriculas(pares, rol, origen):
+    """Anota en la copia local las matrículas realizadas en Moodle, como pares (curso, NIP)."""
+    matriculas = {
+        (curso.id, str(nip)): MatriculaMoodle(curso=curso, nip=str(nip), rol=rol, origen=origen)
+        for curso, nip in pares
+    }
+    MatriculaMoodle.objects.bulk_create(
+        matriculas.values(),
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=['curso', 'nip'],
+        update_fields=['rol', 'origen', 'fecha'],
+    )
+
+
+def anotar_bajas(pares):
+    """Borra de la copia local las matrículas anuladas en Moodle, como pares (curso, NIP)."""
+    condicion = Q()
+    for curso, nip in pares:
+        condicion |= Q(curso=curso, nip=str(nip))
+    if condicion:
+        MatriculaMoodle.objects.filter(condicion).delete()
+
+
+def matriculados_segun_copia_local(cursos):
+    """Devuelve los NIPs matriculados en cada curso (por id) según la copia local."""
+    nips = defaultdict(set)
+    for curso_id, nip in MatriculaMoodle.objects.filter(curso__in=cursos).values_list(
+        'curso_id', 'nip'
+    ):
+        nips[curso_id].add(nip)
+    return nips
+
+
+def _corregir_copia_local(matriculados):
+    """Iguala la copia local de las matrículas de cada curso con los NIPs leídos de Moodle."""
+    for curso, nips in matriculados.items():
+        if isinstance(nips, Exception):
+            continue
+        anotados = set(curso.matriculas_moodle.values_list('nip', flat=True))
+        if anotados - nips:
+            curso.matriculas_moodle.filter(nip__in=anotados - nips).delete()
+        MatriculaMoodle.objects.bulk_create(
+            [
+                MatriculaMoodle(curso=curso, nip=nip, origen=MatriculaMoodle.Origen.MOODLE)
+                for nip in nips - anotados
+            ],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+
+
+def calcular_huella(registro, nips):
+    """Devuelve una huella del curso y el conjunto de NIPs de un registro."""
+    contenido = f'{registro.courseid}:' + ','.join(sorted(nips))
+    return hashlib.sha256(contenido.encode()).hexdigest()
+
+
+def _toca_verificar(registro, limite):
+    return (
+        not limite or not registro.fecha_sincronizacion or registro.fecha_sincronizacion < limite
+    )
+
+
+def _sin_cambios(registro, huella, limite):
+    return registro.huella_sigma == huella and not _toca_verificar(registro, limite)
+
+
+def _enviar(agrupador, resultados):
+    """Envía las matrículas acumuladas, y anota el resultado de cada registro."""
+    if not agrupador.pendientes:
+        return
+    pendientes = [registro for registro, _c, _n in agrupador.pendientes]
+    try:
+        enviados = agrupador.enviar()
+    except Exception as ex:
+        for registro in pendientes:
+            resultados[registro]['error'] = f'Error al matricular en Moodle: {ex}'
+        return
+    for registro, (num_matriculados, no_encontrados, excepciones) in enviados.items():
+        resultados[registro]['matriculados'] = num_matriculados
+        resultados[registro]['no_encontrados'] = len(no_encontrados)
+        if excepciones:
+            resultados[registro][
+                'error'
+            ] = f'Error al matricular en Moodle a {len(excepciones)} estudiantes: {excepciones[0]}'
+
+
+def _guardar_huellas(resultados, huellas):
+    """Guarda la huella de los registros cuyos estudiantes han quedado todos matriculados.
+
+    Si alguno no se ha podido matricular (p. ej. porque todavía no existe en Moodle),
+    no se guarda la huella, para volver a intentarlo en la siguiente sincronización.
+    La fecha de sincronización sólo se actualiza si se han comprobado en Moodle las matrículas.
+    """
+    ahora = timezone.now()
+    sincronizados = []
+    for registro, resultado in resultados.items():
+        if resultado['error'] or resultado['matriculados'] != resultado['a_matricular']:
+            continue
+        registro.huella_sigma = huellas[registro]
+        if resultado['verificado']:
+            registro.fecha_sincronizacion = ahora
+        registro.num_sincronizados = resultado['en_sigma']
+        sincronizados.append(registro)
+    MatriculaAutomatica.objects.bulk_update(
+        sincronizados,
+        ['huella_sigma', 'fecha_sincronizacion', 'num_sincronizados'],
+        batch_size=500,
+    )
+
+
+def _buscar_matriculados(cursos, cliente):
+    """Devuelve los NIPs matriculados en cada curso (o la excepción), pidiendo varios a la vez."""
+    if not cursos:
+        return {}
+    with AsyncWSClient(cliente=cliente) as cliente_asincrono:
+        matriculados = asyncio.run(cliente_asincrono.buscar_nips_matriculados_en_cursos(cursos))
+    return {int(courseid): nips for courseid, nips in matriculados.items()}
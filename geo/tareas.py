@@ -0,0 +1,203 @@
+"""Cola de tareas en segundo plano, guardada en la base de datos.
+
+Los trabajos lentos (crear cursos, matricular, enviar correos...) no se ejecutan
+durante la petición HTTP, sino que se guardan como una `Tarea` y la orden
+`procesar_tareas` los ejecuta después.  No hace falta Redis ni Celery:
+la cola es la tabla `tarea` de MariaDB.
+
+- Cada trabajador toma la siguiente tarea con `SELECT ... FOR UPDATE SKIP LOCKED`,
+  de modo que varios trabajadores pueden consultar la cola a la vez sin bloquearse
+  y sin ejecutar dos veces la misma tarea.
+- Las tareas se toman por orden de prioridad, y a igual prioridad por antigüedad.
+- Si una tarea lanza una excepción, se reintenta más tarde, hasta `max_intentos` veces.
+- Al tomar una tarea, ésta queda reservada durante `visibilidad` segundos.
+  Si el trabajador muere, pasado ese plazo otro trabajador la puede volver a tomar.
+  Las tareas largas amplían el plazo cada vez que informan de su progreso.
+
+Para definir una tarea:
+
+    @registrar_tarea(max_intentos=5)
+    def enviar_resumen(curso_id):
+        ...
+
+y para encolarla:
+
+    encolar_tarea('enviar_resumen', {'curso_id': curso.id}, usuario=request.user)
+
+La vista `api/tareas/{id}` devuelve el estado de una tarea.
+"""
+
+# Standard library
+import importlib
+import logging
+import os
+import socket
+import threading
+from collections import namedtuple
+from datetime import timedelta
+
+# Django
+from django.db import transaction
+from django.utils import timezone
+
+# Local Django
+from .models import Tarea
+
+# Espera inicial y máxima entre reintentos de una tarea.
+ESPERA_REINTENTO = timedelta(seconds=30)
+ESPERA_REINTENTO_MAX = timedelta(hours=1)
+
+TareaRegistrada = namedtuple('TareaRegistrada', 'funcion max_intentos visibilidad prioridad')
+
+# Módulos que definen tareas, y que el trabajador debe importar para registrarlas.
+MODULOS_TAREAS = ('geo.aprovisionamiento', 'geo.borrado', 'geo.cambio_anyo', 'geo.utils')
+
+REGISTRO = {}  # nombre → TareaRegistrada
+_actual = threading.local()
+logger = logging.getLogger(__name__)
+
+
+def registrar_tarea(nombre=None, max_intentos=3, visibilidad=15 * 60, prioridad=None):
+    """Decorador que registra una función para poder ejecutarla como tarea.
+
+    Los parámetros de la tarea se pasan a la función como argumentos con nombre,
+    y su valor de retorno (que debe ser serializable en JSON) se guarda como resultado.
+    """
+
+    def decorador(funcion):
+        REGISTRO[nombre or funcion.__name__] = TareaRegistrada(
+            funcion, max_intentos, visibilidad, prioridad or Tarea.Prioridad.NORMAL
+        )
+        return funcion
+
+    return decorador
+
+
+def cargar_tareas():
+    """Importa los módulos que definen tareas, para que queden registradas."""
+    for modulo in MODULOS_TAREAS:
+        importlib.import_module(modulo)
+
+
+def encolar_tarea(nombre, parametros=None, usuario=None, prioridad=None, retraso=None):
+    """Añade una tarea a la cola, y la devuelve.
+
+    Si se llama dentro de una transacción, los trabajadores no verán la tarea
+    hasta que ésta se confirme.
+    """
+    if nombre not in REGISTRO:
+        raise Exception(f'Tarea desconocida: {nombre}')
+    registrada = REGISTRO[nombre]
+    return Tarea.objects.create(
+        nombre=nombre,
+        parametros=parametros or {},
+        usuario=usuario if usuario and usuario.is_authenticated else None,
+        prioridad=prioridad or registrada.prioridad,
+        max_intentos=registrada.max_intentos,
+        disponible_desde=timezone.now() + (retraso or timedelta()),
+    )
+
+
+def nombre_trabajador():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def tomar_siguiente(trabajador=None):
+    """Reserva la siguiente tarea para este trabajador, y la devuelve (o `None` si no hay)."""
+    while True:
+        ahora = timezone.now()
+        with transaction.atomic():
+            tarea = (
+                Tarea.objects.select_for_update(skip_locked=True)
+                .filter(
+                    estado__in=(Tarea.Estado.PENDIENTE, Tarea.Estado.EN_CURSO),
+                    disponible_desde__lte=ahora,
+                    nombre__in=REGISTRO.keys(),
+                )
+                .order_by('prioridad', 'disponible_desde', 'id')
+                .first()
+            )
+            if tarea is None:
+                return None
+
+            if tarea.estado == Tarea.Estado.EN_CURSO and tarea.intentos >= tarea.max_intentos:
+                # El trabajador que la tenía murió o tardó más de lo previsto en el último intento.
+                tarea.estado = Tarea.Estado.FALLIDA
+                tarea.error = 'Se agotó el tiempo de ejecución de la tarea.'
+                tarea.fecha_fin = ahora
+                tarea.save()
+                continue
+
+            tarea.estado = Tarea.Estado.EN_CURSO
+            tarea.intentos += 1
+            tarea.trabajador = trabajador or nombre_trabajador()
+            tarea.fecha_inicio = ahora
+            tarea.disponible_desde = ahora + _visibilidad(tarea)
+            tarea.save()
+            return tarea
+
+
+def ejecutar(tarea):
+    """Ejecuta una tarea previamente reservada, y guarda su resultado.
+
+    Devuelve el estado en que queda la tarea.
+    """
+    _actual.tarea = tarea
+    try:
+        resultado = REGISTRO[tarea.nombre].funcion(**tarea.parametros)
+    except Exception as ex:
+        # La traza completa sólo va al registro: el error se muestra a quien encoló la tarea.
+        logger.exception(
+            'Error en la tarea %s (%s), intento %s', tarea.id, tarea.nombre, tarea.intentos
+        )
+        error = str(ex) or type(ex).__name__
+        if tarea.intentos < tarea.max_intentos:
+            espera = min(ESPERA_REINTENTO * 2 ** (tarea.intentos - 1), ESPERA_REINTENTO_MAX)
+            cambios = {
+                'estado': Tarea.Estado.PENDIENTE,
+                'disponible_desde': timezone.now() + espera,
+                'error': error,
+            }
+        else:
+            cambios = {'estado': Tarea.Estado.FALLIDA, 'fecha_fin': timezone.now(), 'error': error}
+    else:
+        cambios = {
+            'estado': Tarea.Estado.TERMINADA,
+            'fecha_fin': timezone.now(),
+            'resultado': resultado,
+            'error': None,
+        }
+    finally:
+        _actual.tarea = None
+
+    if _actualizar_si_es_nuestra(tarea, **cambios):
+        tarea.estado = cambios['estado']
+    return tarea.estado
+
+
+def tarea_en_curso():
+    """Devuelve la tarea que se está ejecutando en este hilo, o `None`."""
+    return getattr(_actual, 'tarea', None)
+
+
+def informar_progreso(texto):
+    """Anota el progreso de la tarea en curso, y amplía el plazo durante el que está reservada."""
+    tarea = tarea_en_curso()
+    if tarea is None:
+        return
+    tarea.progreso = texto[:255]
+    _actualizar_si_es_nuestra(
+        tarea, progreso=tarea.progreso, disponible_desde=timezone.now() + _visibilidad(tarea)
+    )
+
+
+def _visibilidad(tarea):
+    return timedelta(seconds=REGISTRO[tarea.nombre].visibilidad)
+
+
+def _actualizar_si_es_nuestra(tarea, **cambios):
+    # Si se agotó el plazo de la tarea, puede que otro trabajador la haya vuelto a tomar,
+    # y entonces el intento que vale es el suyo.
+    return Tarea.objects.filter(
+        pk=tarea.pk, estado=Tarea.Estado.EN_CURSO, intentos=tarea.intentos
+    ).update(**cambios)
@@ -1 +1,1130 @@
-# Create your tests here.
+import asyncio
+import io
+import json
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from datetime import timedelta
+from unittest import mock
+
+import requests
+from django.contrib import admin
+from django.contrib.auth.models import Group
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+
+from accounts.models import CustomUser
+from geo import aprovisionamiento, borrado, operaciones, sincronizacion, tareas, wsclient
+from geo.admin import ProfesorCursoAdmin
+from geo.aiowsclient import AsyncWSClient
+from geo.api import estado_tarea, toggle_matricula_automatica
+from geo.cambio_anyo import CambioAnyoEnCurso, iniciar_cambio_anyo
+from geo.grabacion import montar_casete
+from geo.limitador import LOTES, Limitador, MoodleSaturado
+from geo.metricas import MetricasMoodle
+from geo.models import (
+    Asignatura,
+    Calendario,
+    Categoria,
+    Centro,
+    Curso,
+    Estudio,
+    MatriculaAutomatica,
+    Matriculacion,
+    MatriculaMoodle,
+    OperacionMoodle,
+    Plan,
+    ProfesorCurso,
+    Tarea,
+)
+from geo.moodle_simulado import AdaptadorMoodleSimulado, MoodleSimulado
+from geo.utils import matricular_en_segundo_plano
+from geo.views import ProfesorCursoAnularView
+from geo.wscache import NO_ENCONTRADO, CacheUsuarios, SinCache
+from geo.wsclient import Cortacircuitos, MoodleNoDisponible, WSClient
+
+
+class ConMoodleSimulado:
+    """Hace que los `WSClient` de la prueba llamen a un `MoodleSimulado` en memoria."""
+
+    def setUp(self):
+        super().setUp()
+        self.moodle = MoodleSimulado(usuarios_automaticos=False)
+        # Caché de usuarios vacía en cada prueba, y sin recordar los NIPs no encontrados.
+        caches['default'].clear()
+        cache = CacheUsuarios(alias='default', tamanyo=1000, ttl=3600, ttl_negativo=0)
+        for parche in (
+            mock.patch.object(WSClient, 'cache', cache),
+            mock.patch.object(wsclient, 'get_sesion', return_value=self.moodle.sesion()),
+            mock.patch.object(WSClient, 'api_url', self.moodle.api_url),
+            mock.patch.object(wsclient, 'cortacircuitos', Cortacircuitos(umbral=100, espera=0)),
+        ):
+            parche.start()
+            self.addCleanup(parche.stop)
+
+
+def crear_curso(id_nk=901, cod_grupo=1):
+    """Crea un curso del año 2024, ya creado en Moodle, con su asignatura, centro y plan."""
+    centro, _ = Centro.objects.get_or_create(id=100, defaults={'nombre': 'Facultad'})
+    estudio, _ = Estudio.objects.get_or_create(id=1, defaults={'nombre': 'Grado'})
+    Plan.objects.get_or_create(id=10, defaults={'centro': centro, 'estudio': estudio})
+    asignatura = Asignatura.objects.create(
+        plan_id_nk=10,
+        asignatura_id=20000,
+        cod_grupo_asignatura=cod_grupo,
+        centro_id=100,
+        anyo_academico=2024,
+        nombre_asignatura='Asignatura',
+        nombre_centro='Facultad',
+        nombre_estudio='Grado',
+    )
+    return Curso.objects.create(
+        asignatura=asignatura,
+        nombre=f'Curso {id_nk}',
+        estado=Curso.Estado.CREADO,
+        id_nk=str(id_nk),
+        anyo_academico=2024,
+    )
+
+
+class CortacircuitosTests(SimpleTestCase):
+    """Circuito semiabierto: la petición de prueba siempre cierra o vuelve a abrir el circuito."""
+
+    def setUp(self):
+        self.moodle = MoodleSimulado()
+        self.cliente = WSClient(sesion=self.moodle.sesion())
+        self.cliente.api_url = self.moodle.api_url
+        self.cliente.reintentos = 0
+        self.circuito = Cortacircuitos(umbral=1, espera=0)
+        parche = mock.patch.object(wsclient, 'cortacircuitos', self.circuito)
+        parche.start()
+        self.addCleanup(parche.stop)
+
+    def buscar_categorias(self):
+        return self.cliente.buscar_categorias('id', 1)
+
+    def fallar(self, excepcion):
+        with mock.patch.object(WSClient, '_enviar', side_effect=excepcion):
+            with self.assertRaises(type(excepcion)):
+                self.buscar_categorias()
+
+    def test_la_prueba_correcta_cierra_el_circuito(self):
+        self.fallar(requests.exceptions.Timeout())
+        self.assertIsNotNone(self.circuito.abierto_desde)
+        self.buscar_categorias()
+        self.assertIsNone(self.circuito.abierto_desde)
+        self.assertFalse(self.circuito.probando)
+
+    def test_cualquier_error_de_requests_en_la_prueba_vuelve_a_abrir_el_circuito(self):
+        self.fallar(requests.exceptions.Timeout())
+        self.fallar(requests.exceptions.ChunkedEncodingError())
+        self.assertFalse(self.circuito.probando)
+        # Pasada la espera se admite otra prueba, que cierra el circuito.
+        self.buscar_categorias()
+        self.assertIsNone(self.circuito.abierto_desde)
+
+    def test_moodle_saturado_no_bloquea_el_circuito(self):
+        self.fallar(requests.exceptions.Timeout())
+        self.fallar(MoodleSaturado())
+        self.assertFalse(self.circuito.probando)
+        self.buscar_categorias()
+        self.assertIsNone(self.circuito.abierto_desde)
+
+    def test_circuito_abierto_rechaza_las_peticiones(self):
+        self.circuito.espera = 60
+        self.fallar(requests.exceptions.Timeout())
+        with self.assertRaises(MoodleNoDisponible):
+            self.buscar_categorias()
+
+
+class MoodleSimuladoTests(SimpleTestCase):
+    """El Moodle simulado responde como Moodle, con la latencia y los errores indicados."""
+
+    def cliente(self, moodle):
+        cliente = WSClient(sesion=moodle.sesion(), cache=SinCache())
+        cliente.api_url = moodle.api_url
+        cliente.reintentos = 0
+        return cliente
+
+    def setUp(self):
+        parche = mock.patch.object(
+            wsclient, 'cortacircuitos', Cortacircuitos(umbral=100, espera=0)
+        )
+        parche.start()
+        self.addCleanup(parche.stop)
+
+    def test_errores_y_latencia(self):
+        moodle = MoodleSimulado(latencia=0.5, tasa_errores=1.0)
+        with (
+            mock.patch('geo.moodle_simulado.time.sleep') as esperar,
+            self.assertLogs('geo.wsclient', 'WARNING'),
+            self.assertRaises(requests.exceptions.HTTPError) as contexto,
+        ):
+            self.cliente(moodle).buscar_usuarios_nip(['1001'])
+        esperar.assert_called_once_with(0.5)
+        self.assertEqual(contexto.exception.response.status_code, 503)
+        self.assertTrue(operaciones.es_transitorio(contexto.exception))
+
+    def test_funcion_desconocida(self):
+        moodle = MoodleSimulado()
+        with (
+            self.assertLogs('geo.wsclient', 'WARNING'),
+            self.assertRaisesMessage(Exception, 'Excepción al control de acceso'),
+        ):
+            self.cliente(moodle)._request_url('POST', 'no_existe', 'token', {})
+
+    def test_usuarios_automaticos(self):
+        nips = [str(nip) for nip in range(100_001, 100_101)]
+        no_encontrados = [
+            self.cliente(MoodleSimulado(tasa_desconocidos=0.2, semilla=1)).buscar_usuarios_nip(
+                nips
+            )[1]
+            for _ in range(2)
+        ]
+        # Siempre son los mismos para la misma semilla.
+        self.assertEqual(no_encontrados[0], no_encontrados[1])
+        self.assertTrue(0 < len(no_encontrados[0]) < 50)
+
+
+class CaseteTests(SimpleTestCase):
+    """Las llamadas grabadas en un casete se reproducen después sin conectar con Moodle."""
+
+    def setUp(self):
+        directorio = tempfile.TemporaryDirectory()
+        self.addCleanup(directorio.cleanup)
+        self.ruta = os.path.join(directorio.name, 'casete.jsonl.gz')
+        self.moodle = MoodleSimulado(usuarios_automaticos=False)
+        self.moodle.cursos[901] = {'id': 901, 'shortname': 'C'}
+        for nip in ('1001', '1002'):
+            self.moodle.crear_usuario(nip)
+        parche = mock.patch.object(
+            wsclient, 'cortacircuitos', Cortacircuitos(umbral=100, espera=0)
+        )
+        parche.start()
+        self.addCleanup(parche.stop)
+
+    def cliente(self, modo):
+        sesion = requests.Session()
+        montar_casete(sesion, self.ruta, modo, AdaptadorMoodleSimulado(self.moodle))
+        self.addCleanup(sesion.close)
+        cliente = WSClient(sesion=sesion, cache=SinCache())
+        cliente.api_url = self.moodle.api_url
+        return cliente, sesion
+
+    def test_grabar_y_reproducir(self):
+        cliente, sesion = self.cliente('grabar')
+        usuarios, _ = cliente.buscar_usuarios_nip(['1001', '1002', '9999'])
+        matriculas = [{'roleid': 5, 'userid': u['id'], 'courseid': 901} for u in usuarios]
+        self.assertEqual(cliente.enviar_matriculas(matriculas), (2, []))
+        sesion.close()
+        llamadas = dict(self.moodle.llamadas)
+
+        # Se reproduce sin llamar a Moodle, aunque cambien el orden de los NIPs y la fecha.
+        cliente, _sesion = self.cliente('reproducir')
+        with mock.patch.object(
+            wsclient.timezone, 'now', return_value=timezone.now() + timedelta(1)
+        ):
+            self.assertEqual(
+                cliente.buscar_usuarios_nip(['9999', '1002', '1001']),
+                (sorted(usuarios, key=lambda u: u['id'], reverse=True), ['9999']),
+            )
+            self.assertEqual(cliente.enviar_matriculas(matriculas[::-1]), (2, []))
+        self.assertEqual(self.moodle.llamadas, llamadas)
+
+        # Las llamadas que no están en el casete no se envían a Moodle.
+        with self.assertRaisesMessage(requests.exceptions.RequestException, 'PeticionNoGrabada'):
+            cliente.buscar_nips_matriculados(Curso(id_nk='901'))
+
+
+class SesionPersistenteTests(SimpleTestCase):
+    """Las llamadas a Moodle de un proceso reutilizan la misma conexión."""
+
+    def setUp(self):
+        for parche in (
+            mock.patch.object(wsclient, '_sesion', None),
+            mock.patch.object(wsclient, '_sesion_pid', None),
+            mock.patch.object(wsclient, 'cortacircuitos', Cortacircuitos(umbral=100, espera=0)),
+        ):
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def test_una_sesion_por_proceso(self):
+        sesion = wsclient.get_sesion()
+        self.assertIs(WSClient().sesion, sesion)
+        # Tras un `fork()`, el proceso hijo crea su propia sesión.
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertIsNot(wsclient.get_sesion(), sesion)
+
+    def test_las_llamadas_reutilizan_la_conexion(self):
+        moodle = MoodleSimulado(usuarios_automaticos=False)
+        moodle.cursos[901] = {'id': 901, 'fullname': 'Curso', 'shortname': 'C'}
+        servidor = moodle.servir()
+        conexiones = []
+        aceptar = servidor.get_request
+
+        def contar_conexion():
+            conexiones.append(1)
+            return aceptar()
+
+        servidor.get_request = contar_conexion
+        hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+        hilo.start()
+        self.addCleanup(servidor.server_close)
+        self.addCleanup(servidor.shutdown)
+
+        cliente = WSClient()
+        with mock.patch.object(cliente, 'api_url', moodle.api_url):
+            for _ in range(5):
+                cliente.buscar_nips_matriculados(Curso(id_nk='901'))
+
+        self.assertEqual(moodle.llamadas['core_enrol_get_enrolled_users'], 5)
+        self.assertEqual(len(conexiones), 1)
+
+
+class OperacionesMoodleTests(ConMoodleSimulado, TransactionTestCase):
+    """Las operaciones se envían a Moodle sólo cuando se confirma la transacción del cambio.
+
+    Es un `TransactionTestCase` para que las transacciones se confirmen de verdad.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.curso = crear_curso()
+        self.moodle.cursos[901] = {'id': 901, 'fullname': 'Curso', 'shortname': 'C'}
+        self.profesor = CustomUser.objects.create(username='545454', email='p@unizar.es')
+
+    def encolar_matricula(self):
+        return operaciones.encolar(
+            OperacionMoodle.Tipo.MATRICULAR_PROFESOR,
+            {'usuario_id': self.profesor.id, 'curso_id': self.curso.id},
+            grupo=operaciones.grupo_curso(self.curso),
+        )
+
+    def test_se_envia_al_confirmar_la_transaccion(self):
+        self.moodle.crear_usuario('545454')
+        with transaction.atomic():
+            operacion = self.encolar_matricula()
+            self.assertEqual(self.moodle.matriculas, {})
+        self.assertEqual(operacion.estado, OperacionMoodle.Estado.ENVIADA)
+        self.assertEqual(len(self.moodle.matriculas), 1)
+
+    def test_si_se_deshace_la_transaccion_no_se_envia(self):
+        self.moodle.crear_usuario('545454')
+        with self.assertRaises(ZeroDivisionError):
+            with transaction.atomic():
+                self.encolar_matricula()
+                1 / 0
+        self.assertFalse(OperacionMoodle.objects.exists())
+        self.assertEqual(self.moodle.llamadas, {})
+
+    def test_si_moodle_la_rechaza_se_deshace_el_cambio_local(self):
+        # El profesor no existe en Moodle.
+        with self.assertRaises(Exception):
+            self.curso.anyadir_profesor(self.profesor)
+        self.assertFalse(ProfesorCurso.objects.exists())
+        self.assertEqual(OperacionMoodle.objects.get().estado, OperacionMoodle.Estado.FALLIDA)
+
+    def test_no_se_puede_encolar_dentro_de_otra_transaccion(self):
+        # Moodle no recibiría la operación hasta confirmar la transacción externa,
+        # y ya no se podría deshacer el cambio local si la rechaza.
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.curso.anyadir_profesor(self.profesor)
+        self.assertFalse(ProfesorCurso.objects.exists())
+        self.assertFalse(OperacionMoodle.objects.exists())
+
+    def test_reintento_de_pendientes(self):
+        self.moodle.crear_usuario('545454')
+        futuro = timezone.now() + timedelta(hours=1)
+        matricula = {'usuario_id': self.profesor.id, 'curso_id': self.curso.id}
+        tipo = OperacionMoodle.Tipo.MATRICULAR_PROFESOR
+        aplazadas = OperacionMoodle.objects.bulk_create(
+            OperacionMoodle(tipo=tipo, datos=matricula, proximo_intento=futuro) for _ in range(3)
+        )
+        primera, segunda, suelta, siguiente = OperacionMoodle.objects.bulk_create(
+            [
+                OperacionMoodle(tipo=tipo, datos=matricula, grupo='a', proximo_intento=futuro),
+                OperacionMoodle(tipo=tipo, datos=matricula, grupo='a'),
+                OperacionMoodle(tipo=tipo, datos=matricula),
+                OperacionMoodle(tipo=tipo, datos=matricula, grupo='b'),
+            ]
+        )
+        OperacionMoodle.objects.create(tipo=tipo, datos=matricula, grupo='b')
+
+        # Las operaciones aplazadas no impiden enviar las que están listas detrás de ellas,
+        # pero sí las siguientes de su grupo.
+        resumen = operaciones.enviar_pendientes(tamanyo=2)
+
+        self.assertEqual(resumen, {'enviadas': 3})
+        estados = dict(OperacionMoodle.objects.values_list('id', 'estado'))
+        for operacion in [*aplazadas, primera, segunda]:
+            self.assertEqual(estados.pop(operacion.id), OperacionMoodle.Estado.PENDIENTE)
+        self.assertEqual(set(estados.values()), {OperacionMoodle.Estado.ENVIADA})
+
+    def test_matricula_a_todos_los_profesores_a_la_vez(self):
+        otros = [
+            CustomUser.objects.create(username=nip, email=f'{nip}@unizar.es')
+            for nip in ('545455', '545456')
+        ]
+        for nip in ('545454', '545456'):
+            self.moodle.crear_usuario(nip)  # El 545455 no existe en Moodle
+
+        resultados = self.curso.anyadir_profesores([self.profesor, *otros])
+
+        self.assertEqual([error is None for _pc, error in resultados], [True, False, True])
+        self.assertEqual(self.moodle.llamadas['enrol_manual_enrol_users'], 1)
+        # En el orden indicado: primero, el solicitante.
+        self.assertEqual([m['userid'] for m in self.moodle.matriculas.values()], [545454, 545456])
+        self.assertEqual(
+            set(ProfesorCurso.objects.values_list('profesor__username', flat=True)),
+            {'545454', '545456'},
+        )
+
+    def test_se_envia_fuera_de_la_transaccion(self):
+        self.moodle.crear_usuario('545454')
+        durante_el_envio = []
+
+        def entregar(cliente, operaciones_enviadas):
+            operacion = OperacionMoodle.objects.get()
+            durante_el_envio.append(
+                (
+                    transaction.get_connection().in_atomic_block,
+                    operacion.estado,
+                    operacion.proximo_intento > timezone.now(),
+                )
+            )
+            return [None] * len(operaciones_enviadas)
+
+        tipo = OperacionMoodle.Tipo.MATRICULAR_PROFESOR
+        with mock.patch.dict(operaciones.ENTREGAS, {tipo: entregar}):
+            with transaction.atomic():
+                operacion = self.encolar_matricula()
+
+        # La operación ya estaba reservada, y nadie más podía enviarla.
+        self.assertEqual(durante_el_envio, [(False, OperacionMoodle.Estado.PENDIENTE, True)])
+        self.assertEqual(operaciones.enviar_pendientes(), {})
+        operacion.refresh_from_db()
+        self.assertEqual(
+            (operacion.estado, operacion.intentos), (OperacionMoodle.Estado.ENVIADA, 1)
+        )
+
+    def test_nip_con_espacios(self):
+        self.moodle.crear_usuario('545454')
+        self.profesor.username = '545454 '
+        self.profesor.save()
+        self.curso.anyadir_profesor(self.profesor)
+        self.assertEqual(len(self.moodle.matriculas), 1)
+        self.assertEqual(
+            list(self.curso.matriculas_moodle.values_list('nip', flat=True)), ['545454']
+        )
+
+    def test_baja_rechazada_por_moodle(self):
+        # El profesor no existe en Moodle.
+        pc = ProfesorCurso.objects.create(
+            curso=self.curso, profesor=self.profesor, fecha_alta=timezone.now()
+        )
+        gestor = CustomUser.objects.create(
+            username='gestor', email='g@unizar.es', is_superuser=True
+        )
+        peticion = RequestFactory().post('/', {'fecha_baja': '2024-10-01 00:00'})
+        peticion.user = gestor
+        peticion.session = {}
+        peticion._messages = FallbackStorage(peticion)
+
+        respuesta = ProfesorCursoAnularView.as_view()(peticion, pk=pc.pk)
+
+        self.assertEqual(respuesta.status_code, 302)
+        pc.refresh_from_db()
+        self.assertIsNone(pc.fecha_baja)
+        avisos = [(m.level_tag, str(m)) for m in peticion._messages]
+        self.assertEqual([nivel for nivel, _texto in avisos], ['error'], avisos)
+
+    def test_bajas_desde_el_admin(self):
+        moodle_id = self.moodle.crear_usuario('545454')['id']
+        self.moodle.matricular(moodle_id, 901, roleid=3)
+        otro = CustomUser.objects.create(username='767676', email='o@unizar.es')
+        ProfesorCurso.objects.bulk_create(
+            ProfesorCurso(curso=self.curso, profesor=profesor, fecha_alta=timezone.now())
+            for profesor in (self.profesor, otro)
+        )
+        modelo_admin = ProfesorCursoAdmin(ProfesorCurso, admin.site)
+
+        with mock.patch.object(modelo_admin, 'message_user') as avisar:
+            modelo_admin.dar_de_baja(RequestFactory().post('/'), ProfesorCurso.objects.all())
+
+        # El otro profesor no existe en Moodle: se le mantiene de alta.
+        self.assertEqual(self.moodle.matriculas, {})
+        self.assertEqual(
+            list(ProfesorCurso.objects.filter(fecha_baja=None).values_list('profesor', flat=True)),
+            [otro.id],
+        )
+        self.assertEqual(avisar.call_count, 2)
+
+
+class SincronizacionSigmaTests(ConMoodleSimulado, TestCase):
+    """Los registros de matrícula automática sin cambios en Sigma no se envían a Moodle."""
+
+    def setUp(self):
+        super().setUp()
+        Calendario.objects.update_or_create(slug='actual', defaults={'anyo': 2024})
+        curso = crear_curso()
+        self.moodle.cursos[901] = {'id': 901, 'fullname': 'Curso', 'shortname': 'C'}
+        self.registro = MatriculaAutomatica.objects.create(
+            curso=curso,
+            courseid=901,
+            asignatura_nk=20000,
+            cod_grupo_asignatura=1,
+            centro_id=100,
+            plan_id=10,
+            active=True,
+        )
+
+    def matricular_en_sigma(self, *nips, **campos):
+        Matriculacion.objects.bulk_create(
+            Matriculacion(
+                **{
+                    'anyo_academico': 2024,
+                    'nip': nip,
+                    'centro_id': 100,
+                    'plan_id': 10,
+                    'asignatura_id': 20000,
+                    'tipo_asignatura': 'OB',
+                    'cod_grupo_asignatura': 1,
+                    **campos,
+                }
+            )
+            for nip in nips
+        )
+
+    def sincronizar(self):
+        (resultado,) = sincronizacion.matricular_registros(sincronizacion.registros_activos())
+        self.registro.refresh_from_db()
+        return resultado
+
+    def test_nips_de_sigma_de_cada_registro(self):
+        otro_centro = Centro.objects.create(id=200, nombre='Escuela')
+        for plan_id in (20, 107):
+            Plan.objects.create(id=plan_id, centro=otro_centro, estudio_id=1)
+        self.matricular_en_sigma(1001)
+        self.matricular_en_sigma(1002, plan_id=107)  # Movilidad
+        self.matricular_en_sigma(1003, cod_grupo_asignatura=2)
+        self.matricular_en_sigma(1004, plan_id=20)
+        self.matricular_en_sigma(1005, centro_id=200, plan_id=20, asignatura_id=30000)
+        self.matricular_en_sigma(1006, centro_id=200, plan_id=20, asignatura_id=40000)
+        del_centro = MatriculaAutomatica.objects.create(
+            curso=self.registro.curso, courseid=901, centro_id=200, plan_id=20
+        )
+
+        with self.assertNumQueries(1):
+            nips = sincronizacion.buscar_nips_sigma([self.registro, del_centro])
+
+        self.assertEqual(nips, {self.registro: {'1001', '1002'}, del_centro: {'1005', '1006'}})
+
+    def test_se_matricula_en_segundo_plano_al_activar_el_registro(self):
+        self.matricular_en_sigma(1001, 1002)
+        for nip in ('1001', '1002'):
+            self.moodle.crear_usuario(nip)
+        profesor = CustomUser.objects.create(username='545454', email='p@unizar.es')
+        ProfesorCurso.objects.create(
+            curso=self.registro.curso, profesor=profesor, fecha_alta=timezone.now()
+        )
+        MatriculaAutomatica.objects.filter(pk=self.registro.pk).update(active=False)
+        Group.objects.get_or_create(name='Gestores')
+        peticion = RequestFactory().patch('/')
+        peticion.user = profesor
+
+        codigo, respuesta = toggle_matricula_automatica(peticion, self.registro.id)
+
+        self.assertEqual((codigo, respuesta['queda_activado']), (200, True))
+        self.assertEqual(self.moodle.matriculas, {})  # Todavía no se ha matriculado a nadie
+        tareas.ejecutar(tareas.tomar_siguiente())
+        tarea = Tarea.objects.get(pk=respuesta['tarea_id'])
+        self.assertEqual(tarea.estado, Tarea.Estado.TERMINADA)
+        self.assertEqual(tarea.resultado, {'num_matriculados': 2})
+        self.assertEqual(len(self.moodle.matriculas), 2)
+
+        # Al desactivarlo no se encola nada, y si se desactiva mientras la tarea espera,
+        # la tarea no hace nada.
+        tarea = matricular_en_segundo_plano(self.registro, profesor)
+        self.assertEqual(
+            toggle_matricula_automatica(peticion, self.registro.id),
+            (200, {'queda_activado': False, 'tarea_id': None}),
+        )
+        llamadas = dict(self.moodle.llamadas)
+        tareas.ejecutar(tareas.tomar_siguiente())
+        tarea.refresh_from_db()
+        self.assertEqual(tarea.resultado, {'num_matriculados': 0})
+        self.assertEqual(self.moodle.llamadas, llamadas)
+
+    def test_omite_los_registros_sin_cambios(self):
+        self.matricular_en_sigma(1001, 1002)
+        for nip in ('1001', '1002'):
+            self.moodle.crear_usuario(nip)
+        resultado = self.sincronizar()
+        self.assertEqual(resultado['matriculados'], 2)
+        self.assertTrue(resultado['verificado'])
+        self.assertIsNotNone(self.registro.huella_sigma)
+        llamadas = dict(self.moodle.llamadas)
+
+        self.assertTrue(self.sincronizar()['sin_cambios'])
+        self.assertEqual(self.moodle.llamadas, llamadas)
+
+        # Un nuevo estudiante en Sigma cambia la huella: se matricula sólo a él.
+        self.matricular_en_sigma(1003)
+        self.moodle.crear_usuario('1003')
+        resultado = self.sincronizar()
+        self.assertFalse(resultado['sin_cambios'])
+        self.assertEqual((resultado['ya_matriculados'], resultado['matriculados']), (2, 1))
+
+    def test_no_guarda_la_huella_si_faltan_estudiantes_en_moodle(self):
+        self.matricular_en_sigma(1001, 1002)
+        self.moodle.crear_usuario('1001')
+        resultado = self.sincronizar()
+        self.assertEqual((resultado['matriculados'], resultado['no_encontrados']), (1, 1))
+        self.assertIsNone(self.registro.huella_sigma)
+        self.assertIsNone(self.registro.fecha_sincronizacion)
+
+        # En la siguiente sincronización se vuelve a intentar con el que faltaba.
+        self.moodle.crear_usuario('1002')
+        resultado = self.sincronizar()
+        self.assertEqual((resultado['ya_matriculados'], resultado['matriculados']), (1, 1))
+        self.assertIsNotNone(self.registro.huella_sigma)
+
+    def test_sin_estudiantes_en_sigma_no_se_da_por_verificado(self):
+        resultado = self.sincronizar()
+        self.assertFalse(resultado['verificado'])
+        self.assertIsNotNone(self.registro.huella_sigma)
+        self.assertIsNone(self.registro.fecha_sincronizacion)
+        self.assertEqual(self.moodle.llamadas, {})
+
+    def test_copia_local_de_las_matriculas(self):
+        self.matricular_en_sigma(1001, 1002)
+        for nip in ('1001', '1002', '1003'):
+            self.moodle.crear_usuario(nip)
+        self.sincronizar()
+        matriculas = self.registro.curso.matriculas_moodle
+        self.assertEqual(set(matriculas.values_list('nip', flat=True)), {'1001', '1002'})
+
+        # Mientras no toque verificar el curso, no se piden a Moodle sus matriculados.
+        self.matricular_en_sigma(1003)
+        self.moodle.llamadas.clear()
+        resultado = self.sincronizar()
+        self.assertEqual((resultado['ya_matriculados'], resultado['matriculados']), (2, 1))
+        self.assertNotIn('core_enrol_get_enrolled_users', self.moodle.llamadas)
+
+        # Al verificarlo, la copia local se corrige con lo que hay en Moodle.
+        self.moodle.matriculas.clear()
+        self.moodle.matricular(self.moodle.crear_usuario('9999')['id'], 901)
+        (resultado,) = sincronizacion.matricular_registros(
+            sincronizacion.registros_activos(), completa=True
+        )
+        self.assertTrue(resultado['verificado'])
+        self.assertEqual(resultado['matriculados'], 3)
+        self.assertEqual(
+            set(matriculas.values_list('nip', flat=True)), {'1001', '1002', '1003', '9999'}
+        )
+
+
+class TareasTests(TestCase):
+    """Las tareas que fallan se reintentan con esperas crecientes, hasta `max_intentos` veces."""
+
+    def setUp(self):
+        self.fallos = 2
+        parche = mock.patch.dict(tareas.REGISTRO)
+        parche.start()
+        self.addCleanup(parche.stop)
+        tareas.registrar_tarea('prueba', max_intentos=3)(self.tarea_de_prueba)
+
+    def tarea_de_prueba(self):
+        if self.fallos:
+            self.fallos -= 1
+            raise ValueError('Moodle ha rechazado el curso')
+        return 'hecho'
+
+    def ejecutar_siguiente(self):
+        tarea = tareas.tomar_siguiente('prueba')
+        self.assertIsNotNone(tarea)
+        with self.assertLogs('geo.tareas', 'ERROR') if self.fallos else nullcontext():
+            tareas.ejecutar(tarea)
+        tarea.refresh_from_db()
+        return tarea
+
+    def adelantar(self, tarea):
+        Tarea.objects.filter(pk=tarea.pk).update(disponible_desde=timezone.now())
+
+    def test_reintentos_con_espera_creciente(self):
+        tareas.encolar_tarea('prueba')
+        esperas = []
+        for _ in range(2):
+            antes = timezone.now()
+            tarea = self.ejecutar_siguiente()
+            self.assertEqual(tarea.estado, Tarea.Estado.PENDIENTE)
+            esperas.append(tarea.disponible_desde - antes)
+            # Mientras no llega su momento, la tarea no se vuelve a tomar.
+            self.assertIsNone(tareas.tomar_siguiente('prueba'))
+            self.adelantar(tarea)
+        self.assertGreaterEqual(esperas[0], tareas.ESPERA_REINTENTO)
+        self.assertGreaterEqual(esperas[1], 2 * tareas.ESPERA_REINTENTO)
+
+        tarea = self.ejecutar_siguiente()
+        self.assertEqual(tarea.estado, Tarea.Estado.TERMINADA)
+        self.assertEqual((tarea.intentos, tarea.resultado, tarea.error), (3, 'hecho', None))
+
+    def test_falla_al_agotar_los_intentos_sin_mostrar_la_traza(self):
+        self.fallos = 3
+        tarea = tareas.encolar_tarea('prueba')
+        for _ in range(3):
+            tarea = self.ejecutar_siguiente()
+            self.adelantar(tarea)
+        self.assertEqual(tarea.estado, Tarea.Estado.FALLIDA)
+        self.assertEqual(tarea.error, 'Moodle ha rechazado el curso')
+
+    def test_estado_de_las_tareas_de_un_curso(self):
+        solicitante = CustomUser.objects.create(username='1', email='1@unizar.es')
+        otro_profesor = CustomUser.objects.create(username='2', email='2@unizar.es')
+        del_curso = tareas.encolar_tarea('prueba', {'curso_id': 1}, usuario=solicitante)
+        otra = tareas.encolar_tarea('prueba', usuario=solicitante)
+
+        peticion = RequestFactory().get('/')
+        peticion.user = otro_profesor
+        self.assertEqual(estado_tarea(peticion, del_curso.id), (200, del_curso))
+        self.assertEqual(estado_tarea(peticion, otra.id), (403, None))
+
+
+class MetricasTests(SimpleTestCase):
+    """Sólo vuelcan sus métricas los procesos largos, y se descartan las de procesos muertos."""
+
+    def setUp(self):
+        directorio = tempfile.TemporaryDirectory()
+        self.addCleanup(directorio.cleanup)
+        self.directorio = directorio.name
+        self.metricas = MetricasMoodle(self.directorio, intervalo=0)
+
+    def guardar(self, host, pid, llamadas):
+        otras = MetricasMoodle()
+        for _ in range(llamadas):
+            otras.registrar('core_course_get_courses', 0.1)
+        with open(os.path.join(self.directorio, f'metricas_{host}_{pid}.json'), 'w') as fichero:
+            json.dump(otras.instantanea(), fichero)
+
+    def llamadas(self):
+        prefijo = 'geoda_moodle_llamadas_total{wsfunction="core_course_get_courses"} '
+        for linea in self.metricas.texto().splitlines():
+            if linea.startswith(prefijo):
+                return int(linea[len(prefijo) :])
+
+    def test_sin_compartir_no_se_escribe_ningun_fichero(self):
+        self.metricas.registrar('core_course_get_courses', 0.1)
+        self.assertEqual(os.listdir(self.directorio), [])
+
+    def test_el_fichero_del_proceso_se_borra_al_terminar(self):
+        with mock.patch('atexit.register') as registrar:
+            self.metricas.compartir()
+        registrar.assert_called_once_with(self.metricas.borrar)
+        self.metricas.registrar('core_course_get_courses', 0.1)
+        self.assertEqual(len(os.listdir(self.directorio)), 1)
+        self.metricas.borrar()
+        self.assertEqual(os.listdir(self.directorio), [])
+
+    def test_se_descartan_los_ficheros_de_procesos_muertos(self):
+        proceso = subprocess.Popen(['true'])
+        proceso.wait()
+        self.metricas.registrar('core_course_get_courses', 0.1)
+        self.guardar(socket.gethostname(), proceso.pid, 5)
+        self.guardar('otro-contenedor', proceso.pid, 2)
+
+        self.assertEqual(self.llamadas(), 3)
+        self.assertEqual(
+            os.listdir(self.directorio), [f'metricas_otro-contenedor_{proceso.pid}.json']
+        )
+
+
+class AgrupadorMatriculasTests(ConMoodleSimulado, TestCase):
+    """Las matrículas de varios registros y cursos se buscan y se envían juntas."""
+
+    def test_junta_las_matriculas_de_varios_cursos(self):
+        cursos = [crear_curso(901), crear_curso(902, cod_grupo=2)]
+        registros = [
+            MatriculaAutomatica.objects.create(curso=curso, courseid=curso.id_nk)
+            for curso in (*cursos, cursos[0])
+        ]
+        for curso in cursos:
+            self.moodle.cursos[int(curso.id_nk)] = {'id': int(curso.id_nk), 'shortname': 'C'}
+        for nip in ('1001', '1002', '1003'):
+            self.moodle.crear_usuario(nip)
+
+        agrupador = sincronizacion.AgrupadorMatriculas()
+        agrupador.anyadir(registros[0], cursos[0], {'1001', '1002'})
+        agrupador.anyadir(registros[1], cursos[1], {'1002', '1003', '9999'})
+        agrupador.anyadir(registros[2], cursos[0], {'1001'})  # Mismo curso que el primero
+        resultados = agrupador.enviar()
+
+        self.assertEqual(
+            resultados,
+            {
+                registros[0]: (2, [], []),
+                registros[1]: (2, ['9999'], []),
+                registros[2]: (1, [], []),
+            },
+        )
+        self.assertEqual(self.moodle.llamadas['core_user_get_users_by_field'], 1)
+        self.assertEqual(self.moodle.llamadas['enrol_manual_enrol_users'], 1)
+        self.assertEqual(len(self.moodle.matriculas), 4)
+        self.assertEqual(
+            set(MatriculaMoodle.objects.values_list('curso_id', 'nip')),
+            {
+                (cursos[0].id, '1001'),
+                (cursos[0].id, '1002'),
+                (cursos[1].id, '1002'),
+                (cursos[1].id, '1003'),
+            },
+        )
+        self.assertEqual(agrupador.enviar(), {})
+
+
+class MatricularAlumnosTests(ConMoodleSimulado, SimpleTestCase):
+    """Los lotes de matrículas que Moodle rechaza se devuelven a quien matricula."""
+
+    def test_devuelve_los_nips_de_los_lotes_fallidos(self):
+        curso = Curso(id_nk='901')
+        self.moodle.cursos[901] = {'id': 901, 'fullname': 'Curso', 'shortname': 'C'}
+        rechazado = self.moodle.crear_usuario('1002')['id']
+        self.moodle.crear_usuario('1001')
+        cliente = WSClient()
+        cliente.tamanyo_lote = 1
+        matricular_lote = cliente._matricular_lote
+
+        def fallar_con_el_rechazado(lote, timestart):
+            if lote[0]['userid'] == rechazado:
+                raise requests.exceptions.HTTPError('Error 400')
+            return matricular_lote(lote, timestart)
+
+        with mock.patch.object(cliente, '_matricular_lote', fallar_con_el_rechazado):
+            with self.assertLogs('geo.wsclient', 'WARNING'):
+                num, no_encontrados, no_matriculados = cliente.matricular_alumnos(
+                    ['1001', '1002', '1003'], curso
+                )
+
+        self.assertEqual((num, no_encontrados), (1, ['1003']))
+        ((nips, ex),) = no_matriculados
+        self.assertEqual((nips, str(ex)), (['1002'], 'Error 400'))
+
+
+class MatriculadosPorPaginasTests(ConMoodleSimulado, SimpleTestCase):
+    """Los matriculados de un curso se piden a Moodle por páginas, sólo con su NIP."""
+
+    def test_recorre_todas_las_paginas(self):
+        self.moodle.cursos[901] = {'id': 901, 'fullname': 'Curso', 'shortname': 'C'}
+        for nip in ('1001', '1002', '1003', '1004', '1005'):
+            self.moodle.matricular(self.moodle.crear_usuario(nip)['id'], 901)
+        cliente = WSClient()
+        cliente.tamanyo_pagina = 2
+
+        with mock.patch.object(cliente, '_request_url', wraps=cliente._request_url) as peticion:
+            nips = cliente.buscar_nips_matriculados(Curso(id_nk='901'))
+
+        self.assertEqual(nips, {'1001', '1002', '1003', '1004', '1005'})
+        self.assertEqual(self.moodle.llamadas['core_enrol_get_enrolled_users'], 3)
+        self.assertEqual(
+            [llamada.args[3]['options[1][value]'] for llamada in peticion.call_args_list],
+            [0, 2, 4],
+        )
+        self.assertEqual(peticion.call_args.args[3]['options[0][value]'], 'id,username')
+
+    def test_pagina_final_vacia(self):
+        self.moodle.cursos[901] = {'id': 901, 'fullname': 'Curso', 'shortname': 'C'}
+        for nip in ('1001', '1002'):
+            self.moodle.matricular(self.moodle.crear_usuario(nip)['id'], 901)
+        cliente = WSClient()
+        cliente.tamanyo_pagina = 2
+
+        self.assertEqual(cliente.buscar_nips_matriculados(Curso(id_nk='901')), {'1001', '1002'})
+        self.assertEqual(self.moodle.llamadas['core_enrol_get_enrolled_users'], 2)
+
+
+class CacheUsuariosTests(SimpleTestCase):
+    """Los usuarios se recuerdan hasta que caducan, y los no encontrados, menos tiempo."""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.addCleanup(caches['default'].clear)
+        parche = mock.patch('geo.wscache.time')
+        self.reloj = parche.start()
+        self.addCleanup(parche.stop)
+        self.reloj.time.return_value = self.reloj.monotonic.return_value = 1000.0
+
+    def nueva_cache(self):
+        return CacheUsuarios(alias='default', tamanyo=10, ttl=3600, ttl_negativo=60)
+
+    def adelantar(self, segundos):
+        self.reloj.time.return_value += segundos
+        self.reloj.monotonic.return_value += segundos
+
+    def test_los_no_encontrados_caducan_antes(self):
+        cache = self.nueva_cache()
+        cache.set_many({'nip:1': {'id': 1, 'username': '1'}, 'nip:2': NO_ENCONTRADO})
+        self.assertEqual(
+            cache.get_many(['nip:1', 'nip:2', 'nip:3']),
+            {'nip:1': {'id': 1, 'username': '1'}, 'nip:2': NO_ENCONTRADO},
+        )
+        self.adelantar(61)
+        self.assertEqual(cache.get_many(['nip:1', 'nip:2']), {'nip:1': {'id': 1, 'username': '1'}})
+        self.adelantar(3600)
+        self.assertEqual(cache.get_many(['nip:1']), {})
+        self.assertEqual((cache.aciertos, cache.fallos), (3, 3))
+
+    def test_lo_leido_de_la_compartida_dura_lo_que_le_queda(self):
+        # Otro proceso guarda en la caché compartida que el NIP no existe en Moodle.
+        self.nueva_cache().set('nip:2', NO_ENCONTRADO)
+        self.adelantar(50)
+        cache = self.nueva_cache()
+        self.assertIs(cache.get('nip:2'), NO_ENCONTRADO)
+        self.adelantar(11)
+        self.assertIsNone(cache.get('nip:2'))
+
+    def test_se_descartan_los_usados_hace_mas_tiempo(self):
+        cache = self.nueva_cache()
+        cache.tamanyo = 2
+        cache.set_many({f'nip:{i}': {'id': i, 'username': str(i)} for i in range(3)})
+        caches['default'].clear()
+        self.assertEqual(set(cache.get_many(['nip:0', 'nip:1', 'nip:2'])), {'nip:1', 'nip:2'})
+
+
+class SinCacheTests(ConMoodleSimulado, SimpleTestCase):
+    """Sin caché de usuarios, cada búsqueda llega a Moodle."""
+
+    def test_sin_cache_se_pregunta_siempre_a_moodle(self):
+        self.moodle.crear_usuario('1001')
+        cliente = WSClient(cache=SinCache())
+        for _ in range(2):
+            self.assertEqual(cliente.buscar_usuarios_nip(['1001'])[1], [])
+        self.assertEqual(self.moodle.llamadas['core_user_get_users_by_field'], 2)
+
+        # Con la caché, la segunda búsqueda no llega a Moodle.
+        cliente = WSClient()
+        for _ in range(2):
+            cliente.buscar_usuarios_nip(['1001'])
+        self.assertEqual(self.moodle.llamadas['core_user_get_users_by_field'], 3)
+
+
+class LimitadorTests(SimpleTestCase):
+    """Las tareas por lotes sólo usan sus turnos, y dejan libres los de las peticiones web."""
+
+    def setUp(self):
+        directorio = tempfile.TemporaryDirectory()
+        self.addCleanup(directorio.cleanup)
+        self.limitador = Limitador(directorio.name, total=3, lotes=1, espera=0.05)
+
+    def test_los_lotes_dejan_turnos_para_las_peticiones_interactivas(self):
+        with self.limitador.turno(LOTES):
+            with self.assertRaises(MoodleSaturado):
+                with self.limitador.turno(LOTES):
+                    pass
+            with self.limitador.turno(), self.limitador.turno():
+                with self.assertRaises(MoodleSaturado):
+                    with self.limitador.turno():
+                        pass
+
+        # Al salir del bloque se libera el turno.
+        with self.limitador.turno(LOTES):
+            pass
+
+    def test_la_prioridad_del_proceso(self):
+        self.limitador.establecer_prioridad(LOTES)
+        with self.limitador.turno():
+            with self.assertRaises(MoodleSaturado):
+                with self.limitador.turno():
+                    pass
+
+    def test_sin_limite(self):
+        self.limitador.total = 0
+        with self.limitador.turno(), self.limitador.turno():
+            pass
+
+
+class CambioAnyoTests(TestCase):
+    """Mientras se prepara un año, no se puede empezar a preparar otro."""
+
+    def test_no_se_inicia_otro_cambio_de_anyo_hasta_que_acabe_el_actual(self):
+        usuario = CustomUser.objects.create(username='gestor', email='g@unizar.es')
+        tarea = iniciar_cambio_anyo(2025, usuario)
+        self.assertEqual(iniciar_cambio_anyo(2025, usuario), tarea)
+        with self.assertRaisesMessage(CambioAnyoEnCurso, '2025'):
+            iniciar_cambio_anyo(2026, usuario)
+
+        Tarea.objects.filter(pk=tarea.pk).update(estado=Tarea.Estado.TERMINADA)
+        self.assertEqual(iniciar_cambio_anyo(2026, usuario).parametros, {'anyo': 2026})
+
+
+class ArbolCategoriasTests(ConMoodleSimulado, TransactionTestCase):
+    """El árbol de categorías del año se crea una sola vez, aunque lo creen dos tareas a la vez."""
+
+    def setUp(self):
+        super().setUp()
+        crear_curso()
+        self.bloqueados = []
+
+    @contextmanager
+    def bloqueo_categorias(self, anyo):
+        self.bloqueados.append(anyo)
+        yield
+        self.bloqueados.remove(anyo)
+
+    def test_reutiliza_las_categorias_creadas_por_otra_tarea(self):
+        # La otra tarea tenía el bloqueo, y acaba de crear la categoría del año al obtenerlo.
+        @contextmanager
+        def otra_tarea_acaba_antes(anyo):
+            Categoria.objects.create(
+                nombre='Cursos 2024-2025', anyo_academico=2024, plataforma_id=1, id_nk='1'
+            )
+            with self.bloqueo_categorias(anyo):
+                yield
+
+        with mock.patch('geo.models.bloqueo_categorias', otra_tarea_acaba_antes):
+            indice, errores = Categoria.crear_arbol(2024)
+
+        self.assertEqual(errores, [])
+        self.assertEqual(set(indice), {(None, None), (100, None), (100, 10)})
+        self.assertEqual(Categoria.objects.count(), 3)
+        self.assertEqual(indice[(None, None)].id_nk, '1')
+        self.assertTrue(all(categoria.id_nk for categoria in indice.values()))
+
+        # Con el árbol ya creado, no se crea nada más.
+        self.assertEqual(Categoria.crear_arbol(2024)[0], indice)
+        self.assertEqual(Categoria.objects.count(), 3)
+
+    def test_se_crea_en_moodle_sin_soltar_el_bloqueo(self):
+        crear_varias = Categoria.crear_varias_en_plataforma
+        bloqueados = []
+
+        def crear_en_plataforma(categorias):
+            bloqueados.append(list(self.bloqueados))
+            return crear_varias(categorias)
+
+        with (
+            mock.patch('geo.models.bloqueo_categorias', self.bloqueo_categorias),
+            mock.patch.object(Categoria, 'crear_varias_en_plataforma', crear_en_plataforma),
+        ):
+            _indice, errores = Categoria.crear_arbol(2024)
+
+        self.assertEqual(errores, [])
+        self.assertEqual(bloqueados, [[2024]])
+        self.assertEqual(self.bloqueados, [])
+
+
+class AprovisionamientoTests(ConMoodleSimulado, TestCase):
+    """Un curso que ya se creó en Moodle, aunque no llegara la respuesta, no se duplica."""
+
+    def test_no_duplica_un_curso_creado_en_un_intento_anterior(self):
+        curso = crear_curso()
+        curso.id_nk = None
+        curso.save()
+        self.moodle.cursos[901] = {'id': 901, 'shortname': 'C', 'idnumber': str(curso.id)}
+
+        aprovisionamiento._crear_curso(curso, None)
+
+        self.assertEqual(curso.id_nk, 901)
+        self.assertNotIn('core_course_create_courses', self.moodle.llamadas)
+
+
+class CrearCursosTests(ConMoodleSimulado, TransactionTestCase):
+    """La orden `crear_cursos` crea los cursos de un plan, con la prioridad de los lotes."""
+
+    def test_crea_los_cursos_del_plan(self):
+        ya_creado = crear_curso()
+        Asignatura.objects.create(
+            plan_id_nk=10,
+            asignatura_id=20001,
+            cod_grupo_asignatura=1,
+            centro_id=100,
+            anyo_academico=2024,
+            nombre_asignatura='Otra asignatura',
+            nombre_centro='Facultad',
+            nombre_estudio='Grado',
+        )
+        CustomUser.objects.create(username='545454', email='p@unizar.es')
+
+        with (
+            mock.patch('geo.management.commands.crear_cursos.limitador') as limitador,
+            redirect_stdout(io.StringIO()) as salida,
+        ):
+            call_command('crear_cursos', plan=[10], anyo=2024, solicitante='545454')
+
+        limitador.establecer_prioridad.assert_called_once_with(LOTES)
+        nuevo = Curso.objects.exclude(pk=ya_creado.pk).get()
+        self.assertEqual(nuevo.estado, Curso.Estado.CREADO)
+        self.assertIn(int(nuevo.id_nk), self.moodle.cursos)
+        self.assertTrue(MatriculaAutomatica.objects.filter(curso=nuevo).exists())
+        self.assertIn('Cursos creados: 1.', salida.getvalue())
+
+
+class BorradoTests(ConMoodleSimulado, TestCase):
+    """Los cursos de años pasados se borran por lotes en Moodle, y después en Geoda."""
+
+    def test_borra_por_lotes(self):
+        cursos = [crear_curso(id_nk, cod_grupo=id_nk) for id_nk in (901, 902, 903, 904)]
+        sin_moodle = crear_curso(905, cod_grupo=905)
+        Curso.objects.filter(pk=sin_moodle.pk).update(id_nk=None)
+        for curso in cursos[:3]:  # El 904 ya se borró en Moodle en un intento anterior
+            self.moodle.cursos[int(curso.id_nk)] = {'id': int(curso.id_nk), 'shortname': 'C'}
+        profesor = CustomUser.objects.create(username='545454', email='p@unizar.es')
+        for curso in cursos:
+            ProfesorCurso.objects.create(curso=curso, profesor=profesor)
+            MatriculaAutomatica.objects.create(curso=curso, courseid=curso.id_nk)
+
+        borrar_en_moodle = self.moodle.ws_core_course_delete_courses
+
+        def no_borra_el_903(courseids):
+            respuesta = borrar_en_moodle([c for c in courseids if int(c) != 903])
+            if '903' in map(str, courseids):
+                respuesta['warnings'].append(
+                    {'itemid': 903, 'warningcode': 'cannotdeletecourse', 'message': 'No'}
+                )
+            return respuesta
+
+        todos = Curso.objects.all()
+        self.assertEqual(
+            borrado.contar(todos),
+            {'cursos': 5, 'en_moodle': 4, 'profesores': 4, 'matriculas_automaticas': 4},
+        )
+        informes = []
+        with mock.patch.object(self.moodle, 'ws_core_course_delete_courses', no_borra_el_903):
+            num_borrados, errores = borrado.borrar(todos, informes.append, 2, 0)
+
+        self.assertEqual(num_borrados, 4)
+        self.assertEqual(errores, [f'{cursos[2].id} «Curso 903»: No'])
+        self.assertEqual(self.moodle.llamadas['core_course_delete_courses'], 2)
+        self.assertEqual(set(self.moodle.cursos), {903})
+        self.assertEqual(list(Curso.objects.values_list('id', flat=True)), [cursos[2].id])
+        self.assertEqual(ProfesorCurso.objects.get().curso, cursos[2])
+        self.assertEqual(MatriculaAutomatica.objects.get().curso, cursos[2])
+        self.assertEqual(informes[-1], 'Borrados 4 de 5 cursos.')
+
+
+class AsyncWSClientTests(ConMoodleSimulado, SimpleTestCase):
+    """Las llamadas del cliente asíncrono no abren otro pool de hilos para sus lotes."""
+
+    def test_la_concurrencia_no_se_multiplica(self):
+        self.moodle.cursos[901] = {'id': 901, 'shortname': 'C'}
+        matriculas = [
+            {'roleid': 5, 'userid': self.moodle.crear_usuario(nip)['id'], 'courseid': 901}
+            for nip in ('1', '2', '3')
+        ]
+        cliente = WSClient()
+        cliente.tamanyo_lote = 1
+        with (
+            AsyncWSClient(concurrencia=2, cliente=cliente) as asincrono,
+            mock.patch.object(wsclient, 'ThreadPoolExecutor') as pool,
+        ):
+            resultado = asyncio.run(asincrono.enviar_matriculas(matriculas))
+
+        pool.assert_not_called()
+        self.assertEqual(resultado, (3, []))
+        self.assertEqual(cliente.hilos, WSClient.hilos)
@@ -18,6 +18,7 @@ from .views import (  # ForanoResolverView,; MatricularPlanView,
     HomePageView,
     MatriculaAutomaticaAnyadirView,
     MatriculaAutomaticaLinkView,
+    MetricasView,
     MisAsignaturasView,
     MisCursosView,
     ProfesorCursoAnularView,
@@ -49,6 +50,7 @@ urlpatterns = [
         ProfesorCursoAnularView.as_view(),
         name='pc_anular',
     ),
+    path('metricas/', MetricasView.as_view(), name='metricas'),
     path('pod/', MisAsignaturasView.as_view(), name='mis_asignaturas'),
     path(
         'curso/<int:pk>/matricula-automatica/',
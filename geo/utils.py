@@ -1,8 +1,8 @@
-from django.db import connection
 from django_tables2 import SingleTableView
 
-from geo.models import Curso
-from geo.wsclient import WSClient
+from geo.models import MatriculaAutomatica, Tarea
+from geo.sincronizacion import matricular_registros
+from geo.tareas import encolar_tarea, registrar_tarea
 
 
 class PagedFilteredTableView(SingleTableView):
@@ -21,72 +21,23 @@ class PagedFilteredTableView(SingleTableView):
         return context
 
 
-def matricular_grupo_sigma(  # noqa: C901
-    courseid, asignatura_nk, cod_grupo_asignatura, centro_id, plan_id
-) -> int:
-    """Matricula en un curso Moodle los NIPs matriculados en Sigma que cumplan los filtros."""
+def matricular_en_segundo_plano(registro, usuario):
+    """Encola la matriculación de los estudiantes de un registro de matrícula automática.
 
-    print(
-        f'Curso Moodle: {courseid}'
-        f'  Asignatura: {asignatura_nk}  Grupo: {cod_grupo_asignatura}'
-        f'  Centro: {centro_id}  Plan: {plan_id}'
+    Devuelve la tarea, cuyo resultado incluirá el número de estudiantes matriculados.
+    """
+    return encolar_tarea(
+        'matricular_matricula_automatica', {'registro_id': registro.id}, usuario=usuario
     )
 
-    try:
-        curso = Curso.objects.get(id_nk=courseid)
-    except Exception:  # as ex:
-        print(f'ERROR: Curso #{courseid} no encontrado en Moodle!')
-        return 0
 
-    # Buscamos los NIPs matriculados en Sigma que cumplan los filtros
-    consulta = '''
-    SELECT nip
-    FROM matriculacion
-    WHERE 1=1
-    '''
-    if asignatura_nk:
-        consulta += f' AND asignatura_id = {asignatura_nk}'
-    if cod_grupo_asignatura:
-        consulta += f' AND cod_grupo_asignatura = {cod_grupo_asignatura}'
-    if centro_id:
-        consulta += f' AND centro_id = {centro_id}'
-    if plan_id:
-        # 107 (estudio 449): Movilidad para 1º y 2º ciclo y grado
-        # 266 (estudio 634): Movilidad para máster
-        consulta += f' AND plan_id IN ({plan_id}, 107, 266)'
-
-    with connection.cursor() as cursor:
-        cursor.execute(consulta)
-        filas = cursor.fetchall()
-    nips_en_sigma = [str(fila[0]) for fila in filas]
-
-    if len(nips_en_sigma) == 0:
-        print("No hay estudiantes en Sigma que cumplan los criterios indicados.")
-        return 0
-
-    cliente = WSClient()
-    usuarios_ya_matriculados = cliente.buscar_alumnos(curso)
-    nips_ya_matriculados = [u.get('username') for u in usuarios_ya_matriculados]
-    nips_a_matricular = set(nips_en_sigma) - set(nips_ya_matriculados)
-
-    # Matriculamos en el curso Moodle indicado los NIPs de Sigma que todavía no lo estén
-    num_a_matricular = len(nips_a_matricular)
-    if num_a_matricular == 0:
-        print('Todos los alumnos de Sigma están ya matriculados en el curso Moodle.')
-        return 0
-
-    print(
-        f'Se va a intentar matricular a {num_a_matricular} estudiantes'
-        f' en el curso Moodle #{courseid}.'
-    )
-
-    try:
-        num_matriculados, _ = cliente.matricular_alumnos(nips_a_matricular, curso)
-        print(f'Matriculados {num_matriculados} estudiantes en el curso Moodle #{courseid}.')
-        if num_a_matricular != num_matriculados:
-            print('AVISO:', num_a_matricular - num_matriculados, 'estudiantes no matriculados!')
-    except Exception:
-        print("ERROR al intentar matricular estudiantes en el curso de Moodle #{courseid}.")
-        return 0
-
-    return num_matriculados
+@registrar_tarea(prioridad=Tarea.Prioridad.ALTA)
+def matricular_matricula_automatica(registro_id):
+    """Matricula en Moodle a los estudiantes de un registro de matrícula automática activo."""
+    ma = MatriculaAutomatica.objects.filter(pk=registro_id, active=True).first()
+    if not ma:  # Se ha borrado o desactivado mientras esperaba en la cola
+        return {'num_matriculados': 0}
+    (resultado,) = matricular_registros([ma], completa=True)
+    if resultado['error']:
+        raise Exception(resultado['error'])
+    return {'num_matriculados': resultado['matriculados']}
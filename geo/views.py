@@ -19,8 +19,9 @@ from django.contrib.auth.mixins import (
 )
 from django.contrib.auth.models import Group
 from django.contrib.messages.views import SuccessMessageMixin
+from django.db import transaction
 from django.db.models import Q
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
@@ -53,7 +54,8 @@ from .models import (
     Curso,
     Forano,
     MatriculaAutomatica,
-    Matriculacion,
+    MatriculaMoodle,
+    OperacionMoodle,
     Plan,
     Pod,
     ProfesorCurso,
@@ -65,10 +67,27 @@ from .tables import (
     CursoTable,
     ForanoTodosTable,
 )
-from .utils import PagedFilteredTableView, matricular_grupo_sigma
+from .aprovisionamiento import aprovisionar, ultima_tarea
+from .cambio_anyo import CambioAnyoEnCurso, iniciar_cambio_anyo, ultimo_cambio
+from .metricas import metricas
+from .operaciones import encolar, grupo_curso, hay_pendientes, rechazo
+from .sincronizacion import ROL_ESTUDIANTE, ROL_PROFESOR, anotar_matriculas
+from .utils import PagedFilteredTableView, matricular_en_segundo_plano
 from .wsclient import WSClient
 
 
+def avisar_si_pendiente(request, curso):
+    """Avisa al usuario si quedan cambios del curso pendientes de aplicar en Moodle."""
+    if hay_pendientes(grupo_curso(curso)):
+        messages.warning(
+            request,
+            _(
+                'Moodle no está disponible en este momento. Los cambios se aplicarán'
+                ' automáticamente en Moodle en cuanto vuelva a estarlo.'
+            ),
+        )
+
+
 class ChecksMixin(UserPassesTestMixin):
     """Proporciona comprobaciones para autorizar o no una acción a un usuario."""
 
@@ -116,10 +135,11 @@ class HomePageView(TemplateView):
 class ASCrearCursoView(LoginRequiredMixin, ChecksMixin, View):
     """Crea un nuevo Curso para una asignatura Sigma.
 
-    Si la creación tiene éxito, el navegador es redirigido a la ficha del curso.
+    El curso se crea en Moodle en segundo plano (véase `geo/aprovisionamiento.py`),
+    y el navegador es redirigido a la ficha del curso, que muestra el progreso.
     """
 
-    def post(self, request, *args, **kwargs):  # noqa: lint.ignore=C901
+    def post(self, request, *args, **kwargs):
         usuario = self.request.user
         if not usuario.email:
             messages.error(
@@ -144,74 +164,22 @@ class ASCrearCursoView(LoginRequiredMixin, ChecksMixin, View):
             )
             return redirect('mis_asignaturas')
 
-        try:
-            curso = self._cargar_asignatura_en_curso(asignatura, usuario)
-        except Exception as ex:
-            messages.error(request, _('ERROR: %(ex)s') % {'ex': ex})
-            return redirect('mis_asignaturas')
-
-        # Comprobar si existe la categoría en la plataforma, y si no, crearla.
-        categoria = curso.categoria
-        if not categoria.id_nk:
-            categoria.crear_en_plataforma()
-
-        # Crear el curso en la plataforma
-        cliente = WSClient()
-        datos_curso = curso.get_datos()
-        try:
-            datos_recibidos = cliente.crear_curso(datos_curso)
-        except Exception as ex:
-            messages.error(request, _('ERROR: %(ex)s') % {'ex': ex})
-            return redirect('curso_detail', curso.id)
-        curso.actualizar_tras_creacion(datos_recibidos)
-
-        # Dejamos de rellenar la tabla `sigma`: usamos la tabla `matricula_automatica` local
-        # mensaje = cliente.automatricular(asignatura, curso)
-        # messages.info(request, mensaje)
-
-        # Crear registro desactivado en la tabla `matricula_automatica` local
-        try:
-            ma = MatriculaAutomatica(
-                courseid=curso.id_nk,
-                asignatura_nk=asignatura.asignatura_id,  # Cód. Sigma de la asignatura
-                cod_grupo_asignatura=asignatura.cod_grupo_asignatura,
-                centro_id=asignatura.centro_id,
-                plan_id=asignatura.plan_id_nk,
-                active=False,
-                fijo=True,
-                curso_id=curso.id,
-            )
-            ma.save()
-        except Exception as ex:
-            messages.warning(
-                request,
-                _(
-                    'AVISO: No fue posible crear el registro de matrícula automática. {ex}'.format(
-                        ex=ex
-                    )
-                ),
-            )
-
-        # Matricular profesores: primero el solicitante, luego los demás del POD
-        # Matricular al solicitante PRIMERO
-        try:
-            curso.anyadir_profesor(usuario)
-        except Exception as ex:
-            messages.error(request, f'ERROR: {ex}')
+        curso = get_object_or_None(Curso, asignatura=asignatura)
+        if curso and curso.estado == Curso.Estado.CREADO:
+            messages.error(request, _('ERROR: Ya existe un curso para esta asignatura.'))
             return redirect('curso_detail', curso.id)
 
-        # Matricular otros profesores DESPUÉS
-        profesores = asignatura.get_profesores()
-        profesores.sort(key=lambda x: x.username)
-        for profesor in profesores:
-            if profesor != usuario:
-                try:
-                    curso.anyadir_profesor(profesor)
-                except Exception as ex:
-                    messages.error(request, f'ERROR: {ex}')
-                    return redirect('curso_detail', curso.id)
-
-        messages.success(request, _('Curso creado correctamente en Moodle.'))
+        # La creación en Moodle se hace en segundo plano, y la ficha del curso muestra su progreso.
+        # Si ya existía el curso es porque falló un intento anterior, que ahora se reanuda.
+        tarea = ultima_tarea(curso) if curso else None
+        if not tarea or tarea.esta_acabada:
+            try:
+                with transaction.atomic():
+                    curso = curso or self._cargar_asignatura_en_curso(asignatura, usuario)
+                    aprovisionar(curso, usuario)
+            except Exception as ex:
+                messages.error(request, _('ERROR: %(ex)s') % {'ex': ex})
+                return redirect('mis_asignaturas')
 
         return redirect('curso_detail', curso.id)
 
@@ -229,7 +197,13 @@ class ASCrearCursoView(LoginRequiredMixin, ChecksMixin, View):
             fecha_autorizacion=timezone.now(),
             autorizador_id=1,
             plataforma_id=1,
-            categoria=asignatura.get_categoria(),
+            # Si la categoría todavía no existe, se crea en segundo plano junto con el curso.
+            categoria=get_object_or_None(
+                Categoria,
+                plan_id_nk=asignatura.plan_id_nk,
+                centro_id=asignatura.centro_id,
+                anyo_academico=asignatura.anyo_academico,
+            ),
             anyo_academico=asignatura.anyo_academico,
             asignatura_id=asignatura.id,
             # Las asignaturas regladas son aprobadas automáticamente
@@ -281,92 +255,42 @@ class CalendarioUpdate(
     fields = ('anyo',)
     template_name = 'gestion/calendario_form.html'
 
-    # Tras cambiar el año hay que mover en Moodle
-    # las categorías «Varios» (5047) y «Escuela de Doctorado» (5021),
-    # así como la de cursos no reglados bienales que toque.
-
-    # NOTA: La Escuela de Doctorado tiene dos categorías:
-    #
-    # * una categoría (5021) directamente en «Cursos 20xx-20yy»,
-    #   con 1 curso por cada PD, que es la que se pasa de un año al siguiente.
-    # * otra categoría (5747, 5701, 5776...) dentro de la categoría «No reglada» de cada año,
-    #   para actividades de formación transversal y específica.
-
-    # Se puede usar `moosh` para mover en Moodle una categoría a otra.
-    # Example: Move the category with id 5021 to be in the category with id 6543:
-    #     moosh category-move 5021 6543
-
-    # También hay que mover esas tres categorías en Geoda:
-    #
-    # SELECT id, anyo_academico FROM categoria WHERE supercategoria_id IS NULL
-    #   ORDER BY anyo_academico DESC LIMIT 1;  -- Obtener el `id` de la nueva supercategoría
-    # UPDATE categoria SET anyo_academico=<anyo>, supercategoria_id=<id> WHERE id_nk=5047;
-    # UPDATE categoria SET anyo_academico=<anyo>, supercategoria_id=<id> WHERE id_nk=5021;
-    # y la de cursos no reglados bienales que toque:
-    # SELECT * FROM categoria WHERE nombre LIKE 'Bienales%'
-    #   ORDER BY anyo_academico DESC LIMIT 1,1; -- Obtener el id_nk de la penúltima bienal
-    # SELECT * FROM categoria WHERE nombre = 'No reglada' AND anyo_academico = <anyo>; -- id
-    # UPDATE categoria SET anyo_academico=<anyo>, supercategoria_id=<id> WHERE id_nk=<id_nk>;
+    # Al cambiar el año, la tarea `cambiar_anyo` crea las categorías del nuevo año,
+    # mueve a éste las que pasan de un año a otro y borra las matriculaciones del año anterior.
+    # Véase `geo/cambio_anyo.py`.
 
     success_message = mark_safe(
         str(_('Se ha actualizado el curso académico actual.'))
         + '<br><br>\n'
-        + str(_('Recuerde que a continuación <b>se debe</b>:'))
-        + '<br>\n<ul>\n<li>'
         + str(
             _(
-                'Mover las categorías «Varios» y «Escuela de Doctorado» del año anterior '
-                'a la del año actual, tanto en GEO como en Moodle.<br>'
-                'Así como la de cursos no reglados bienales que toque.'
+                'Las categorías del nuevo año se están preparando en segundo plano. '
+                'Puede consultar el progreso en esta página.'
             )
         )
-        + '</li>\n<li>'
+        + '<br><br>\n'
+        + str(_('Recuerde que a continuación <b>se debe</b>:'))
+        + '<br>\n<ul>\n<li>'
         + str(_('Actualizar el año en las pasarelas de GEO (carga de asignaturas y POD).'))
         + '</li>\n</ul>\n'
-        + str(_('<b>Contacte con los responsables de Moodle y GEO del SICUZ.</b>'))
+        + str(_('<b>Contacte con los responsables de GEO del SICUZ.</b>'))
     )
     success_url = reverse_lazy('calendario', args=['actual'])
 
-    def form_valid(self, form):
-        # This method is called when valid form data has been POSTed.
-        # It should return an HttpResponse.
-        anyo = int(self.request.POST.get('anyo'))
-        anyo_anterior = anyo - 1
-        siguiente_anyo = anyo + 1
-        nombre_cat_anyo = f'Cursos {anyo}-{siguiente_anyo}'
-
-        # Eliminar de la tabla `matriculacion` los alumnos del año anterior, si los hubiera.
-        Matriculacion.objects.filter(anyo_academico=anyo_anterior).delete()
-
-        # Crear categoría para el año académico. Vg: «Cursos 2019-2020»
-        cat_anyo = self._crear_categoria(anyo, nombre_cat_anyo, None)
-        # Crear categoría «No reglada».
-        cat_nr = self._crear_categoria(anyo, 'No reglada', cat_anyo.id)
-        # Crear las subcategorías de los estudios no reglados
-        for nombre in Categoria.NO_REGLADAS:
-            self._crear_categoria(anyo, nombre, cat_nr.id)
-        # Crear nueva categoría de cursos no reglados bienales
-        self._crear_categoria(anyo, f'Bienales {anyo}-{anyo+2}', cat_nr.id)
-
-        return super().form_valid(form)
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['cambio_anyo'] = ultimo_cambio()
+        return context
 
-    @staticmethod
-    def _crear_categoria(anyo, nombre, supercategoria_id):
-        """Comprueba si existe la categoría, y la crea si es necesario."""
-        cat = get_object_or_None(
-            Categoria, anyo_academico=anyo, nombre=nombre, supercategoria_id=supercategoria_id
-        )
-        if not cat:
-            cat = Categoria(
-                plataforma_id=1,
-                anyo_academico=anyo,
-                nombre=nombre,
-                supercategoria_id=supercategoria_id,
-            )
-            cat.save()
-        if not cat.id_nk:
-            cat.crear_en_plataforma()
-        return cat
+    def form_valid(self, form):
+        try:
+            with transaction.atomic():
+                # Si el cambio anterior falló, volver a enviar el formulario lo reanuda.
+                iniciar_cambio_anyo(form.instance.anyo, self.request.user)
+                return super().form_valid(form)
+        except CambioAnyoEnCurso as ex:
+            form.add_error('anyo', str(ex))
+            return self.form_invalid(form)
 
 
 class CursoDeleteView(LoginRequiredMixin, PermissionRequiredMixin, DeleteView):
@@ -389,11 +313,8 @@ class CursoDeleteView(LoginRequiredMixin, PermissionRequiredMixin, DeleteView):
                     )
                 return redirect('curso_detail', curso.id)
 
-            for pc in curso.profesorcurso_set.all():
-                pc.delete()
-
-            matriculas_automaticas = MatriculaAutomatica.objects.filter(courseid=curso.id_nk)
-            matriculas_automaticas.delete()
+            curso.profesorcurso_set.all().delete()
+            MatriculaAutomatica.objects.filter(courseid=curso.id_nk).delete()
 
         # Innecesario porque el registro será eliminado de la tabla.
         # curso.estado = Curso.Estado.BORRADO
@@ -444,6 +365,7 @@ class CursoDetailView(LoginRequiredMixin, DetailView):
                 or self.request.user.has_perm('geo.anyadir_profesorcurso'),
                 'puede_matricular_alumnos': es_profesor_del_curso
                 or self.request.user.has_perm('geo.anyadir_alumnos'),
+                'aprovisionamiento': ultima_tarea(self.object) if self.object.asignatura else None,
             }
         )
 
@@ -490,11 +412,28 @@ class CursoMatricularNipsView(LoginRequiredMixin, ChecksMixin, View):
 
         cliente = WSClient()
         try:
-            num_matriculados, usuarios_no_encontrados = cliente.matricular_alumnos(nips, curso)
+            num_matriculados, usuarios_no_encontrados, no_matriculados = (
+                cliente.matricular_alumnos(nips, curso)
+            )
         except Exception as ex:
             messages.error(self.request, _('ERROR: %(ex)s.') % {'ex': ex})
             return redirect('curso_detail', curso_id)
 
+        fallidos = {nip for nips_lote, _ex in no_matriculados for nip in nips_lote}
+        matriculados = (
+            {nip.strip() for nip in nips if nip.strip()} - set(usuarios_no_encontrados) - fallidos
+        )
+        anotar_matriculas(
+            ((curso, nip) for nip in matriculados), ROL_ESTUDIANTE, MatriculaMoodle.Origen.GEODA
+        )
+
+        for nips_lote, ex in no_matriculados:
+            messages.error(
+                request,
+                _('No se pudo matricular a los siguientes NIPs: %(nips)s. ERROR: %(ex)s.')
+                % {'nips': ', '.join(nips_lote), 'ex': ex},
+            )
+
         if usuarios_no_encontrados:
             messages.warning(
                 request,
@@ -521,15 +460,32 @@ class CursoRematricularView(LoginRequiredMixin, ChecksMixin, View):
         curso_id = request.POST.get('curso_id')
         curso = get_object_or_404(Curso, pk=curso_id)
 
-        cliente = WSClient()
-        for profesor in curso.profesores_activos:
-            try:
-                cliente.matricular_profesor(profesor, curso)
-            except Exception as ex:
-                messages.error(self.request, _('ERROR: %(ex)s.') % {'ex': ex})
-                return redirect('curso_detail', curso_id)
+        profesores = list(curso.profesores_activos)
+        try:
+            errores = WSClient().matricular_profesores(profesores, curso)
+        except Exception as ex:
+            messages.error(self.request, _('ERROR: %(ex)s.') % {'ex': ex})
+            return redirect('curso_detail', curso_id)
 
-        messages.success(request, _('Se ha vuelto a matricular al profesorado del curso.'))
+        anotar_matriculas(
+            [(curso, p.username.strip()) for p, error in zip(profesores, errores) if not error],
+            ROL_PROFESOR,
+            MatriculaMoodle.Origen.GEODA,
+        )
+        num_matriculados = errores.count(None)
+        if num_matriculados:
+            messages.success(
+                request,
+                _('Se ha vuelto a matricular a %(num)s de %(total)s profesores del curso.')
+                % {'num': num_matriculados, 'total': len(profesores)},
+            )
+        for profesor, error in zip(profesores, errores):
+            if error:
+                messages.error(
+                    request,
+                    _('ERROR al matricular a %(profesor)s: %(ex)s')
+                    % {'profesor': profesor.full_name, 'ex': error},
+                )
         return redirect('curso_detail', curso_id)
 
     def test_func(self):
@@ -703,9 +659,17 @@ class ResolverSolicitudCursoView(LoginRequiredMixin, PermissionRequiredMixin, Re
 
             curso.actualizar_tras_creacion(datos_recibidos)
             try:
-                cliente.matricular_profesor(curso.profesores.first(), curso)
+                with transaction.atomic(durable=True):
+                    operacion = encolar(
+                        OperacionMoodle.Tipo.MATRICULAR_PROFESOR,
+                        {'usuario_id': curso.profesores.first().id, 'curso_id': curso.id},
+                        grupo=grupo_curso(curso),
+                    )
+                if rechazo(operacion):
+                    raise rechazo(operacion)
             except Exception as ex:
                 messages.warning(self.request, _('AVISO: %(ex)s.') % {'ex': ex})
+            avisar_si_pendiente(request, curso)
 
             messages.info(
                 request,
@@ -1083,7 +1047,11 @@ class MatriculaAutomaticaAnyadirView(LoginRequiredMixin, ChecksMixin, View):
             ma.curso_id = curso.id  # id en GEO
             ma.courseid = curso.id_nk  # id en Moodle
             try:
-                ma.save()
+                with transaction.atomic():
+                    ma.save()
+                    # Los estudiantes del nuevo registro se matriculan en Moodle en segundo plano,
+                    # y la ficha del curso consulta la tarea para mostrar cuántos se matricularon.
+                    tarea = matricular_en_segundo_plano(ma, request.user)
             except Exception as ex:
                 mensaje = mark_safe(
                     _(
@@ -1095,19 +1063,13 @@ class MatriculaAutomaticaAnyadirView(LoginRequiredMixin, ChecksMixin, View):
                 messages.error(request, mensaje)
                 return redirect('curso_detail', curso_id)
 
-            # Matricular en Moodle a los estudiantes del nuevo registro de matrícula automática.
-            num_matriculados = matricular_grupo_sigma(
-                ma.courseid, ma.asignatura_nk, ma.cod_grupo_asignatura, ma.centro_id, ma.plan_id
-            )
-            mensaje = _(f'Se ha matriculado a {num_matriculados} estudiantes.')
-            messages.info(request, mensaje)
-
         else:
             messages.error(request, formulario.errors)
             return redirect('curso_detail', curso_id)
 
         return redirect(
-            reverse('curso_detail', kwargs={'pk': curso_id}) + '#matriculacion-automatica'
+            reverse('curso_detail', kwargs={'pk': curso_id})
+            + f'?tarea={tarea.id}#matriculacion-automatica'
         )
 
     def test_func(self):
@@ -1147,20 +1109,29 @@ class ProfesorCursoAnularView(
     def form_valid(self, form):
         # This method is called when valid form data has been POSTed.
         # It should return an HttpResponse.
-        cliente = WSClient()
-        try:
-            respuestas = cliente.desmatricular(self.object.profesor, self.object.curso)
-        except Exception as ex:
-            messages.error(self.request, _('ERROR: %(ex)s.') % {'ex': ex})
+        # Se guarda la fecha de baja y la desmatriculación en Moodle a la vez,
+        # y si Moodle la rechaza se deshace la baja.
+        with transaction.atomic(durable=True):
+            # Sin el mensaje de `SuccessMessageMixin`, que sólo se muestra si Moodle la acepta.
+            respuesta = super(SuccessMessageMixin, self).form_valid(form)
+            operacion = encolar(
+                OperacionMoodle.Tipo.DESMATRICULAR,
+                {'usuario_id': self.object.profesor_id, 'curso_id': self.object.curso_id},
+                grupo=grupo_curso(self.object.curso),
+            )
+        error = rechazo(operacion)
+        if error:
+            ProfesorCurso.objects.filter(pk=self.object.pk).update(
+                fecha_baja=form.initial.get('fecha_baja')
+            )
+            messages.error(
+                self.request, _('ERROR al dar de baja en Moodle: %(ex)s.') % {'ex': error}
+            )
             return redirect('curso_detail', self.object.curso_id)
 
-        for respuesta in respuestas:
-            for error in respuesta.get('errors'):
-                messages.error(
-                    self.request, _('ERROR al dar de baja en Moodle: ') + error.get('message')
-                )
-
-        return super().form_valid(form)
+        messages.success(self.request, self.get_success_message(form.cleaned_data))
+        avisar_si_pendiente(self.request, self.object.curso)
+        return respuesta
 
     def get_success_message(self, cleaned_data):
         docente = self.object.profesor
@@ -1250,6 +1221,7 @@ class ProfesorCursoAnyadirView(LoginRequiredMixin, ChecksMixin, View):
             return redirect('curso_detail', curso_id)
 
         messages.success(request, _('Se ha añadido el profesor al curso.'))
+        avisar_si_pendiente(request, curso)
         return redirect('curso_detail', curso_id)
 
     def test_func(self):
@@ -1258,6 +1230,20 @@ class ProfesorCursoAnyadirView(LoginRequiredMixin, ChecksMixin, View):
         ) or self.request.user.has_perm('geo.anyadir_profesorcurso')
 
 
+class MetricasView(View):
+    """Métricas de las llamadas a Moodle, en el formato de texto de Prometheus."""
+
+    def get(self, request, *args, **kwargs):
+        if (
+            request.META.get('REMOTE_ADDR') not in get_config('METRICAS_IPS', ['127.0.0.1'])
+            and not request.user.is_superuser
+        ):
+            return HttpResponseForbidden()
+        return HttpResponse(
+            metricas.texto(), content_type='text/plain; version=0.0.4; charset=utf-8'
+        )
+
+
 def teapot(request, whatever):
     """Pasarle a Django direcciones PHP es como pedirle a una tetera que haga café."""
     return HttpResponse("I'm a teapot", status=418)
@@ -0,0 +1,171 @@
+"""Caché de la correspondencia entre usuarios de Geoda y usuarios de Moodle.
+
+El `id` de un usuario en Moodle no cambia nunca, así que no es necesario preguntárselo
+a Moodle cada vez que se matricula o desmatricula a alguien.
+
+La caché tiene dos niveles:
+
+- una caché LRU en la memoria de cada proceso, de tamaño limitado;
+- la caché `moodle` de Django (véase `CACHES` en `settings`), compartida
+  por todos los workers de uWSGI y las órdenes de consola.
+
+También se recuerdan, durante menos tiempo, los NIPs que no existen en Moodle
+(los usuarios se crean en Moodle cada noche), para no volver a preguntar por ellos.
+
+La caché compartida guarda con cada valor el instante en que caduca, de modo que
+lo que se lee de ella se guarda en la local sólo durante el tiempo que le queda.
+"""
+
+# Standard library
+import threading
+import time
+from collections import OrderedDict
+
+# Third-party
+from annoying.functions import get_config
+
+# Django
+from django.core.cache import caches
+
+# Valor que se guarda para los usuarios que no existen en Moodle.
+NO_ENCONTRADO = False
+
+
+class CacheUsuarios:
+    """Caché de usuarios de Moodle, con caducidad y caché negativa."""
+
+    def __init__(self, alias, tamanyo, ttl, ttl_negativo):
+        self.alias = alias
+        self.tamanyo = tamanyo
+        self.ttl = ttl
+        self.ttl_negativo = ttl_negativo
+        self._local = OrderedDict()  # clave → (instante de caducidad, valor)
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    @property
+    def compartida(self):
+        return caches[self.alias]
+
+    def get_many(self, claves):
+        """Devuelve un diccionario con las claves encontradas en la caché y sus valores.
+
+        Los usuarios inexistentes en Moodle tienen como valor `NO_ENCONTRADO`.
+        """
+        encontrados, pendientes = {}, []
+        ahora = time.monotonic()
+        with self._lock:
+            for clave in claves:
+                entrada = self._local.get(clave)
+                if entrada and entrada[0] > ahora:
+                    self._local.move_to_end(clave)
+                    encontrados[clave] = entrada[1]
+                else:
+                    pendientes.append(clave)
+
+        if pendientes:
+            ahora = time.time()
+            compartidos = {
+                clave: (caducidad - ahora, valor)
+                for clave, (caducidad, valor) in self.compartida.get_many(pendientes).items()
+                if caducidad > ahora
+            }
+            encontrados.update({clave: valor for clave, (_ttl, valor) in compartidos.items()})
+            self._guardar_en_local(compartidos)
+
+        with self._lock:
+            self.aciertos += len(encontrados)
+            self.fallos += len(claves) - len(encontrados)
+        return encontrados
+
+    def get(self, clave):
+        """Devuelve el valor guardado para la clave, o `None` si no está en la caché."""
+        return self.get_many([clave]).get(clave)
+
+    def set_many(self, datos):
+        """Guarda los valores indicados, tanto en la caché local como en la compartida."""
+        ahora = time.time()
+        positivos = {k: v for k, v in datos.items() if v is not NO_ENCONTRADO}
+        negativos = {k: v for k, v in datos.items() if v is NO_ENCONTRADO}
+        for valores, ttl in ((positivos, self.ttl), (negativos, self.ttl_negativo)):
+            if valores:
+                self.compartida.set_many(
+                    {clave: (ahora + ttl, valor) for clave, valor in valores.items()}, timeout=ttl
+                )
+        self._guardar_en_local(
+            {clave: (self._ttl(valor), valor) for clave, valor in datos.items()}
+        )
+
+    def set(self, clave, valor):
+        self.set_many({clave: valor})
+
+    def delete(self, clave):
+        with self._lock:
+            self._local.pop(clave, None)
+        self.compartida.delete(clave)
+
+    def estadisticas(self):
+        """Devuelve un texto con el número de aciertos y fallos de la caché en este proceso."""
+        total = self.aciertos + self.fallos
+        porcentaje = 100 * self.aciertos / total if total else 0
+        return (
+            f'Caché de usuarios Moodle: {self.aciertos} aciertos, {self.fallos} fallos'
+            f' ({porcentaje:.1f}% resueltas sin consultar a Moodle).'
+        )
+
+    def _ttl(self, valor):
+        return self.ttl_negativo if valor is NO_ENCONTRADO else self.ttl
+
+    def _guardar_en_local(self, datos):
+        """Guarda en la caché local los valores indicados, como {clave: (segundos, valor)}."""
+        ahora = time.monotonic()
+        with self._lock:
+            for clave, (ttl, valor) in datos.items():
+                self._local[clave] = (ahora + ttl, valor)
+                self._local.move_to_end(clave)
+            while len(self._local) > self.tamanyo:
+                self._local.popitem(last=False)  # Descartamos el usado hace más tiempo
+
+
+class SinCache:
+    """Caché que no guarda nada, para que todas las búsquedas lleguen a Moodle.
+
+    Por ejemplo, para medir el tiempo de las llamadas: `WSClient(cache=SinCache())`.
+    """
+
+    def get_many(self, claves):
+        return {}
+
+    def get(self, clave):
+        return None
+
+    def set_many(self, datos):
+        pass
+
+    def set(self, clave, valor):
+        pass
+
+    def delete(self, clave):
+        pass
+
+
+def clave_nip(nip):
+    return f'nip:{nip}'
+
+
+def clave_correo(nip, email):
+    return f'correo:{nip}:{email}'
+
+
+def compactar(usuario_moodle):
+    """Devuelve sólo los datos del usuario de Moodle que se usan en Geoda."""
+    return {'id': usuario_moodle['id'], 'username': usuario_moodle['username']}
+
+
+cache_usuarios = CacheUsuarios(
+    alias='moodle',
+    tamanyo=get_config('CACHE_USUARIOS_TAMANYO', 20_000),
+    ttl=get_config('CACHE_USUARIOS_TTL', 7 * 24 * 3600),
+    ttl_negativo=get_config('CACHE_USUARIOS_TTL_NEGATIVO', 15 * 60),
+)
@@ -1,15 +1,131 @@
 # standard library
 import json
+import logging
+import os
+import random
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # third-party libraries
 import requests
 from annoying.functions import get_config
+from requests.adapters import HTTPAdapter
 
 # Django
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+# Local Django
+from .grabacion import montar_casete
+from .limitador import MoodleSaturado, limitador
+from .metricas import metricas
+from .wscache import NO_ENCONTRADO, cache_usuarios, clave_correo, clave_nip, compactar
+
+logger = logging.getLogger(__name__)
+
+# Sesión HTTP compartida por todos los clientes de un mismo proceso.
+# Mantiene abiertas (keep-alive) las conexiones con Moodle, de modo que las llamadas
+# consecutivas reutilizan la conexión TCP y la sesión TLS, en vez de negociarlas cada vez.
+_sesion = None
+_sesion_pid = None
+_sesion_lock = threading.Lock()
+
+
+def get_sesion():
+    """Devuelve la sesión HTTP persistente del proceso actual, creándola si es necesario.
+
+    uWSGI crea los workers mediante `fork()`, y los sockets no se deben compartir entre
+    procesos, así que cada proceso tiene su propia sesión (y su propio pool de conexiones).
+    """
+    global _sesion, _sesion_pid
+    pid = os.getpid()
+    if _sesion is None or _sesion_pid != pid:
+        with _sesion_lock:
+            if _sesion is None or _sesion_pid != pid:
+                adaptador = HTTPAdapter(
+                    pool_connections=get_config('WS_POOL_CONNECTIONS', 4),
+                    pool_maxsize=get_config('WS_POOL_MAXSIZE', 10),
+                )
+                sesion = requests.Session()
+                sesion.mount('https://', adaptador)
+                sesion.mount('http://', adaptador)
+                if get_config('WS_CASETE', None):
+                    montar_casete(
+                        sesion,
+                        get_config('WS_CASETE'),
+                        get_config('WS_CASETE_MODO', 'reproducir'),
+                        adaptador,
+                    )
+                _sesion, _sesion_pid = sesion, pid
+    return _sesion
+
+
+class MoodleNoDisponible(requests.exceptions.ConnectionError):
+    """Moodle ha fallado repetidamente, y no se le envían peticiones durante un tiempo."""
+
+
+class Cortacircuitos:
+    """Circuit breaker que deja de llamar a Moodle mientras no responda correctamente.
+
+    Tras `umbral` fallos consecutivos de transporte (errores de conexión, timeouts,
+    respuestas 5xx u otros errores de `requests`) el circuito se abre, y durante `espera`
+    segundos las peticiones fallan inmediatamente, sin ocupar al worker.  Pasado ese tiempo
+    se deja pasar una petición de prueba (circuito semiabierto): si tiene éxito se cierra
+    el circuito, y si no, se vuelve a abrir.
+    """
+
+    def __init__(self, umbral, espera):
+        self.umbral = umbral
+        self.espera = espera
+        self.fallos = 0
+        self.abierto_desde = None
+        self.probando = False
+        self._lock = threading.Lock()
+
+    def comprobar(self):
+        """Lanza `MoodleNoDisponible` si el circuito está abierto."""
+        with self._lock:
+            if self.abierto_desde is None:
+                return
+            if time.monotonic() - self.abierto_desde >= self.espera and not self.probando:
+                self.probando = True  # Dejamos pasar esta petición como prueba
+                return
+        raise MoodleNoDisponible(
+            _('Moodle no está respondiendo. Vuelva a intentarlo en unos minutos.')
+        )
+
+    def registrar_exito(self):
+        with self._lock:
+            self.fallos = 0
+            self.abierto_desde = None
+            self.probando = False
+
+    def registrar_fallo(self):
+        with self._lock:
+            self.fallos += 1
+            if self.probando or self.fallos >= self.umbral:
+                self.abierto_desde = time.monotonic()
+            self.probando = False
+
+    def cancelar_prueba(self):
+        """Permite otra petición de prueba, si la actual no ha llegado a enviarse a Moodle."""
+        with self._lock:
+            self.probando = False
+
+
+def trocear(elementos, tamanyo):
+    """Divide una secuencia en listas de, como mucho, `tamanyo` elementos."""
+    elementos = list(elementos)
+    return [elementos[i : i + tamanyo] for i in range(0, len(elementos), tamanyo)]
+
+
+# Compartido por todos los clientes (e hilos) del proceso.
+cortacircuitos = Cortacircuitos(
+    umbral=get_config('WS_CIRCUITO_UMBRAL', 5), espera=get_config('WS_CIRCUITO_ESPERA', 30)
+)
+
 
 class WSClient:
     """Cliente para conectarse a los Web Services de Moodle usando el protocolo REST.
@@ -25,6 +141,44 @@ class WSClient:
     api_url = get_config('API_URL')
     geodaws_token = get_config('GEODAWS_TOKEN')
 
+    # Tiempo máximo de espera (conexión, lectura) en segundos.
+    # Se puede ajustar para cada función con el diccionario `WS_TIMEOUTS` de `settings`.
+    timeout = get_config('WS_TIMEOUT', (5, 30))
+    timeouts = {
+        'core_course_create_courses': (5, 60),
+        'core_course_delete_courses': (5, 120),
+        'core_enrol_get_enrolled_users': (5, 60),
+        'enrol_manual_enrol_users': (5, 120),
+        **get_config('WS_TIMEOUTS', {}),
+    }
+    # Funciones de sólo lectura, que se pueden reintentar sin riesgo si fallan.
+    funciones_idempotentes = {
+        'core_course_get_categories',
+        'core_course_get_courses_by_field',
+        'core_enrol_get_enrolled_users',
+        'core_user_get_users',
+        'core_user_get_users_by_field',
+        'local_geodaws_get_user_enrolments',
+    }
+    reintentos = get_config('WS_REINTENTOS', 3)
+    # Espera base y máxima (en segundos) entre reintentos (backoff exponencial con jitter).
+    espera_reintento = get_config('WS_ESPERA_REINTENTO', 0.5)
+    espera_reintento_max = get_config('WS_ESPERA_REINTENTO_MAX', 8)
+    # Las peticiones masivas se dividen en lotes, para no superar el `max_input_vars` de PHP
+    # (cada matrícula son 4 variables), y se envían varios lotes simultáneamente.
+    tamanyo_lote = get_config('WS_TAMANYO_LOTE', 200)
+    hilos = get_config('WS_HILOS', 4)
+    # Nº de usuarios que se piden en cada página al descargar los matriculados en un curso.
+    tamanyo_pagina = get_config('WS_TAMANYO_PAGINA', 1000)
+    # Caché de la correspondencia entre NIPs y usuarios de Moodle
+    cache = cache_usuarios
+
+    def __init__(self, sesion=None, cache=None):
+        # Por omisión se usan la sesión persistente y la caché de usuarios del proceso.
+        self.sesion = sesion or get_sesion()
+        if cache is not None:
+            self.cache = cache
+
     def crear_categoria(self, datos_categoria):
         """Crea una nueva categoría en Moodle con los datos indicados.
 
@@ -42,6 +196,55 @@ class WSClient:
         )
         return datos_recibidos[0]
 
+    def crear_categorias(self, lista_datos):
+        """Crea varias categorías en Moodle, en lotes.
+
+        Todas las categorías superiores deben existir ya en Moodle.
+        Devuelve, para cada categoría, los datos recibidos (como `crear_categoria`),
+        o la excepción producida.
+        """
+        resultados = []
+        for lote, respuesta, excepcion in self._en_paralelo(
+            self._crear_lote_categorias, lista_datos
+        ):
+            resultados += [excepcion] * len(lote) if excepcion else respuesta
+        return resultados
+
+    def _crear_lote_categorias(self, lista_datos):
+        payload = {}
+        for i, datos_categoria in enumerate(lista_datos):
+            for clave, valor in datos_categoria.items():
+                payload[f'categories[{i}][{clave}]'] = valor
+        return self._request_url('POST', 'core_course_create_categories', self.geo_token, payload)
+
+    def mover_categorias(self, movimientos):
+        """Mueve en Moodle cada categoría a su nueva categoría superior.
+
+        `movimientos` es una lista de tuplas (id de la categoría, id de su nueva categoría padre).
+        """
+        payload = {}
+        for i, (categoria_id, superior_id) in enumerate(movimientos):
+            payload[f'categories[{i}][id]'] = categoria_id
+            payload[f'categories[{i}][parent]'] = superior_id
+        return self._request_url('POST', 'core_course_update_categories', self.geo_token, payload)
+
+    def buscar_categorias(self, clave, valor):
+        """Busca en Moodle las categorías con ese valor en el campo `clave` (p. ej. `idnumber`)."""
+        payload = {
+            'criteria[0][key]': clave,
+            'criteria[0][value]': valor,
+            'addsubcategories': 0,
+        }
+        return self._request_url('POST', 'core_course_get_categories', self.geo_token, payload)
+
+    def buscar_cursos(self, clave, valor):
+        """Busca en Moodle los cursos con ese valor en el campo `clave` (p. ej. `idnumber`)."""
+        payload = {'field': clave, 'value': valor}
+        datos_recibidos = self._request_url(
+            'POST', 'core_course_get_courses_by_field', self.geo_token, payload
+        )
+        return datos_recibidos['courses']
+
     def crear_curso(self, datos_curso):
         """Crea nuevo curso en Moodle con los datos indicados.
 
@@ -56,6 +259,36 @@ class WSClient:
         )
         return datos_recibidos[0]
 
+    def crear_cursos(self, lista_datos):
+        """Crea varios cursos en Moodle, en lotes.
+
+        Moodle crea todos los cursos de un lote o ninguno, así que si rechaza un lote
+        se vuelven a enviar sus cursos uno a uno, para saber cuáles fallan.
+        Devuelve, para cada curso, los datos recibidos (como `crear_curso`),
+        o la excepción producida.
+        """
+        resultados = []
+        for lote, respuesta, excepcion in self._en_paralelo(self._crear_lote_cursos, lista_datos):
+            if not excepcion:
+                resultados += respuesta
+            elif len(lote) == 1 or isinstance(excepcion, requests.exceptions.RequestException):
+                resultados += [excepcion] * len(lote)
+            else:
+                resultados += [
+                    excepcion_curso or respuesta_curso[0]
+                    for _datos, respuesta_curso, excepcion_curso in self._uno_a_uno(
+                        lambda datos: self._crear_lote_cursos([datos]), lote
+                    )
+                ]
+        return resultados
+
+    def _crear_lote_cursos(self, lista_datos):
+        payload = {}
+        for i, datos_curso in enumerate(lista_datos):
+            for clave, valor in datos_curso.items():
+                payload[f'courses[{i}][{clave}]'] = valor
+        return self._request_url('POST', 'core_course_create_courses', self.geo_token, payload)
+
     def automatricular(self, asignatura, curso, active=0):
         """Crea un registro en la tabla `sigma` de la base de datos de Moodle.
 
@@ -80,6 +313,18 @@ class WSClient:
         )
         return respuesta
 
+    def borrar_cursos(self, ids_nk):
+        """Borra varios cursos en Moodle con una sola llamada.
+
+        Devuelve un diccionario {id del curso en Moodle: aviso} con los cursos que Moodle
+        no ha borrado (o que ya no existían, con el aviso `unknowncourseidnumber`).
+        """
+        payload = {f'courseids[{i}]': id_nk for i, id_nk in enumerate(ids_nk)}
+        respuesta = self._request_url(
+            'POST', 'core_course_delete_courses', self.geo_token, payload
+        )
+        return {int(aviso['itemid']): aviso for aviso in (respuesta or {}).get('warnings', [])}
+
     def buscar_alumnos(self, curso):
         """Obtiene de Moodle los alumnos matriculados en el curso indicado."""
         # Doc de `core_enrol_get_enrolled_users` en <web_moodle>/admin/webservice/documentation.php
@@ -89,8 +334,45 @@ class WSClient:
         )
         return alumnos_matriculados
 
+    def buscar_nips_matriculados(self, curso):
+        """Devuelve el conjunto de `username` (NIPs) de los usuarios matriculados en el curso.
+
+        A diferencia de `buscar_alumnos`, sólo pide a Moodle el id y el nombre de usuario
+        (sin perfiles, grupos ni roles), y recorre los cursos grandes por páginas,
+        de modo que nunca se tiene en memoria más de una página de la respuesta.
+        """
+        nips = set()
+        inicio = 0
+        while True:
+            payload = {
+                'courseid': curso.id_nk,
+                'options[0][name]': 'userfields',
+                'options[0][value]': 'id,username',
+                'options[1][name]': 'limitfrom',
+                'options[1][value]': inicio,
+                'options[2][name]': 'limitnumber',
+                'options[2][value]': self.tamanyo_pagina,
+                'options[3][name]': 'sortby',
+                'options[3][value]': 'id',  # Orden estable entre páginas
+            }
+            pagina = self._request_url(
+                'POST', 'core_enrol_get_enrolled_users', self.geo_token, payload
+            )
+            nips.update(usuario.get('username') for usuario in pagina)
+            if len(pagina) < self.tamanyo_pagina:
+                return nips
+            inicio += self.tamanyo_pagina
+
     def buscar_usuario_correo(self, usuario):
         """Busca en Moodle el usuarioCorreo correspondiente al usuario de Geoda indicado."""
+        clave = clave_correo(usuario.username, usuario.email)
+        usuario_moodle = self.cache.get(clave)
+        if not usuario_moodle:
+            usuario_moodle = compactar(self._buscar_usuario_correo(usuario))
+            self.cache.set(clave, usuario_moodle)
+        return usuario_moodle
+
+    def _buscar_usuario_correo(self, usuario):
         # Buscamos a un usuarioCorreo con ese NIP (idnumber) y dirección de correo.
         payload = {
             'criteria[0][key]': 'idnumber',
@@ -140,58 +422,127 @@ class WSClient:
 
     def buscar_usuario_nip_or_None(self, nip):
         """Busca en Moodle el usuarioNip correspondiente al NIP indicado, o `None`."""
-        payload = {
-            'criteria[0][key]': 'username',
-            'criteria[0][value]': nip,
-        }
-        respuesta = self._request_url('POST', 'core_user_get_users', self.geo_token, payload)
-        usuarios_moodle = respuesta['users']
-        if not usuarios_moodle:
-            return None
-        return usuarios_moodle[0]
+        usuario_moodle = self.cache.get(clave_nip(nip))
+        if usuario_moodle is None:
+            payload = {
+                'criteria[0][key]': 'username',
+                'criteria[0][value]': nip,
+            }
+            respuesta = self._request_url('POST', 'core_user_get_users', self.geo_token, payload)
+            usuarios_moodle = respuesta['users']
+            usuario_moodle = compactar(usuarios_moodle[0]) if usuarios_moodle else NO_ENCONTRADO
+            self.cache.set(clave_nip(nip), usuario_moodle)
+        return usuario_moodle or None
 
     def buscar_usuarios_nip(self, nips):
-        """Busca en Moodle los usuariosNip correspondientes a los NIPs indicados."""
+        """Busca en Moodle los usuariosNip correspondientes a los NIPs indicados.
+
+        Devuelve los usuarios encontrados y la lista de NIPs no encontrados.
+        """
+        nips = list(dict.fromkeys(str(nip).strip() for nip in nips if str(nip).strip()))
+        en_cache = self.cache.get_many([clave_nip(nip) for nip in nips])
+        # Sólo se pregunta a Moodle por los NIPs que no están en la caché.
+        pendientes = sorted(nip for nip in nips if clave_nip(nip) not in en_cache)
+        nuevos = dict.fromkeys((clave_nip(nip) for nip in pendientes), NO_ENCONTRADO)
+        for lote, respuesta, excepcion in self._en_paralelo(self._buscar_lote_nips, pendientes):
+            if excepcion:
+                raise excepcion
+            for usuario in respuesta:
+                nuevos[clave_nip(usuario['username'])] = compactar(usuario)
+        self.cache.set_many(nuevos)
+
+        resultado = {**en_cache, **nuevos}
+        usuarios = [resultado[clave_nip(nip)] for nip in nips if resultado[clave_nip(nip)]]
+        return usuarios, [nip for nip in nips if not resultado[clave_nip(nip)]]
+
+    def _buscar_lote_nips(self, nips):
         # Doc de `get_users_by_field`` en <sitio_moodle>/admin/webservice/documentation.php
         payload = {'field': 'username'}
-
         for i, nip in enumerate(nips):
-            payload.update({f'values[{i}]': str(nip)})
-
-        usuarios = self._request_url(
-            'POST', 'core_user_get_users_by_field', self.geo_token, payload
-        )
-        # TODO: Devolver NIPs de usuarios no encontrados
-        return usuarios, []
+            payload[f'values[{i}]'] = nip
+        return self._request_url('POST', 'core_user_get_users_by_field', self.geo_token, payload)
 
     def desmatricular(self, usuario, curso):
         """Desmatricula a un usuario de un curso."""
+        resultado = self.desmatricular_varios([(usuario, curso)])[0]
+        if isinstance(resultado, Exception):
+            raise resultado
+        return resultado
+
+    def desmatricular_varios(self, pares):
+        """Desmatricula a varios usuarios de varios cursos.
+
+        `pares` es una lista de tuplas (usuario de Geoda, curso).  Los usuarioNip se buscan
+        en bloque, y las consultas de matrículas y las bajas se envían simultáneamente.
+        Devuelve, en el orden de los pares, la lista de respuestas de Moodle a cada baja,
+        o la excepción producida al desmatricular a ese usuario de ese curso.
+        """
+        pares = list(pares)
+        resultados = self._buscar_usuarios_pares(pares)
+        consultas = [
+            (i, usuario_moodle['id'], curso.id_nk)
+            for i, (usuario_moodle, (_usuario, curso)) in enumerate(zip(resultados, pares))
+            if not isinstance(usuario_moodle, Exception)
+        ]
+
+        bajas = []  # (índice del par, ueid)
+        for (i, usuario_id, curso_id), ueids, excepcion in self._uno_a_uno(
+            lambda consulta: self._request_url(
+                'GET',
+                'local_geodaws_get_user_enrolments',
+                self.geodaws_token,
+                {'usuario_id_nk': consulta[1], 'curso_id_nk': consulta[2]},
+            ),
+            consultas,
+        ):
+            resultados[i] = excepcion or []
+            if not excepcion:
+                bajas.extend((i, ueid['id']) for ueid in ueids)
+
+        # Con `core_enrol_edit_user_enrolment` podríamos establecer una fecha de finalización,
+        # pero esta función fue deprecated en la versión 3.6,
+        # por lo que dejará de funcionar en el futuro.
+        # En su lugar se podría usar `core_enrol_submit_user_enrolment`,
+        # pero todavía no existía en la versión 3.5 LTS que es la que usamos.
+        # `core_enrol_unenrol_user_enrolment` sólo admite un `ueid` por llamada.
+        for (i, _ueid), respuesta, excepcion in self._uno_a_uno(
+            lambda baja: self._request_url(
+                'POST', 'core_enrol_unenrol_user_enrolment', self.geo_token, {'ueid': baja[1]}
+            ),
+            bajas,
+        ):
+            if not isinstance(resultados[i], Exception):
+                resultados[i] = excepcion or resultados[i] + [respuesta]
+
+        return resultados
+
+    def _buscar_usuarios_pares(self, pares):
+        """Devuelve el usuario de Moodle de cada par (usuario, curso), o la excepción."""
         # Hasta el curso 2019-20 los profesores entraban en Moodle con su usuario de correo.
-        if curso.anyo_academico < 2020:
-            usuario_moodle = self.buscar_usuario_correo(usuario)
-        else:
-            usuario_moodle = self.buscar_usuario_nip(usuario)
-        payload = {
-            'usuario_id_nk': usuario_moodle['id'],
-            'curso_id_nk': curso.id_nk,
-        }
-        ueids = self._request_url(
-            'GET', 'local_geodaws_get_user_enrolments', self.geodaws_token, payload
+        usuarios_correo = list({u.pk: u for u, c in pares if c.anyo_academico < 2020}.values())
+        usuarios_nip, _no_encontrados = self.buscar_usuarios_nip(
+            u.username.strip() for u, c in pares if c.anyo_academico >= 2020
         )
-
-        respuestas = []
-        for ueid in ueids:
-            # Con `core_enrol_edit_user_enrolment` podríamos establecer una fecha de finalización,
-            # pero esta función fue deprecated en la versión 3.6,
-            # por lo que dejará de funcionar en el futuro.
-            # En su lugar se podría usar `core_enrol_submit_user_enrolment`,
-            # pero todavía no existía en la versión 3.5 LTS que es la que usamos.
-            respuesta = self._request_url(
-                'POST', 'core_enrol_unenrol_user_enrolment', self.geo_token, {'ueid': ueid['id']}
+        por_nip = {usuario_moodle['username']: usuario_moodle for usuario_moodle in usuarios_nip}
+        por_correo = {
+            usuario.pk: excepcion or usuario_moodle
+            for usuario, usuario_moodle, excepcion in self._uno_a_uno(
+                self.buscar_usuario_correo, usuarios_correo
             )
-            respuestas.append(respuesta)
+        }
 
-        return respuestas
+        resultados = []
+        for usuario, curso in pares:
+            nip = usuario.username.strip()
+            if curso.anyo_academico < 2020:
+                resultados.append(por_correo[usuario.pk])
+            elif nip in por_nip:
+                resultados.append(por_nip[nip])
+            else:
+                resultados.append(
+                    Exception(f'Usuario {usuario.full_name} (NIP {nip}) no encontrado en Moodle.')
+                )
+        return resultados
 
     def matricular_profesor(self, usuario, curso):
         """Matricula a un usuario como profesor de un curso de Moodle."""
@@ -209,47 +560,207 @@ class WSClient:
         mensaje = self._request_url('POST', 'enrol_manual_enrol_users', self.geo_token, payload)
         return mensaje
 
-    def matricular_alumnos(self, nips, curso) -> tuple[int, list]:
-        """Matricula una lista de usuarios como alumnos de un curso de Moodle."""
+    def matricular_profesores(self, usuarios, curso) -> list:
+        """Matricula varios usuarios como profesores de un curso de Moodle.
+
+        Busca a todos los usuarios en Moodle a la vez, y los matricula en un solo lote.
+        Devuelve, para cada usuario, `None` si se ha matriculado, o la excepción producida.
+        """
+        nips = [u.username.strip() for u in usuarios]
+        usuarios_moodle, _no_encontrados = self.buscar_usuarios_nip(nips)
+        id_de_nip = {usuario['username']: usuario['id'] for usuario in usuarios_moodle}
+        matriculas = {
+            id_de_nip[nip]: {
+                'roleid': 3,  # id del rol `editingteacher` en Moodle
+                'userid': id_de_nip[nip],
+                'courseid': curso.id_nk,
+            }
+            for nip in nips
+            if nip in id_de_nip
+        }
+        _num, errores = self.enviar_matriculas(list(matriculas.values()))
+        error_de_id = {matricula['userid']: ex for lote, ex in errores for matricula in lote}
+
+        return [
+            (
+                error_de_id.get(id_de_nip[nip])
+                if nip in id_de_nip
+                else Exception(f'Usuario {u.full_name} (NIP {nip}) no encontrado en Moodle.')
+            )
+            for u, nip in zip(usuarios, nips)
+        ]
+
+    def matricular_alumnos(self, nips, curso) -> tuple[int, list, list]:
+        """Matricula una lista de usuarios como alumnos de un curso de Moodle.
+
+        Devuelve el número de usuarios matriculados, la lista de NIPs no encontrados,
+        y una lista de tuplas (NIPs no matriculados, excepción producida)
+        con los lotes que Moodle no ha aceptado.
+        """
         if not nips:
-            return 0, []
+            return 0, [], []
 
         usuarios_moodle, usuarios_no_encontrados = self.buscar_usuarios_nip(nips)
-        if usuarios_moodle:
-            # Preparamos payload con todos los usuarios de la lista de NIPs encontrados en Moodle
-            payload = {}
-            for i, usuario in enumerate(usuarios_moodle):
-                payload.update(
-                    {
-                        f'enrolments[{i}][roleid]': 5,  # id del rol `Student` en Moodle
-                        f'enrolments[{i}][userid]': usuario['id'],
-                        f'enrolments[{i}][courseid]': curso.id_nk,
-                        f'enrolments[{i}][timestart]': int(timezone.now().timestamp()),
-                    }
+        nip_de_id = {usuario['id']: usuario['username'] for usuario in usuarios_moodle}
+        matriculas = [
+            {'roleid': 5, 'userid': usuario['id'], 'courseid': curso.id_nk}  # 5: `Student`
+            for usuario in usuarios_moodle
+        ]
+        num_matriculados, errores = self.enviar_matriculas(matriculas)
+        no_matriculados = [
+            ([nip_de_id[matricula['userid']] for matricula in lote], ex) for lote, ex in errores
+        ]
+        return num_matriculados, usuarios_no_encontrados, no_matriculados
+
+    def enviar_matriculas(self, matriculas) -> tuple[int, list]:
+        """Envía a Moodle las matrículas indicadas, en lotes simultáneos.
+
+        Cada matrícula es un diccionario con las claves `roleid`, `userid` y `courseid`,
+        y pueden ser de cursos distintos.  Si falla un lote, se siguen enviando los demás.
+        Devuelve el número de matrículas realizadas y una lista de tuplas
+        (lote de matrículas no realizadas, excepción producida).
+        """
+        timestart = int(timezone.now().timestamp())
+        num_matriculados, errores = 0, []
+        for lote, _respuesta, excepcion in self._en_paralelo(
+            lambda lote: self._matricular_lote(lote, timestart), matriculas
+        ):
+            if excepcion:
+                logger.warning(
+                    'Error al matricular un lote de %s usuarios: %s', len(lote), excepcion
                 )
-            # Matriculamos en el curso a los usuarios encontrados
-            self._request_url('POST', 'enrol_manual_enrol_users', self.geo_token, payload)
+                errores.append((lote, excepcion))
+            else:
+                num_matriculados += len(lote)
+        return num_matriculados, errores
 
-        return len(usuarios_moodle), usuarios_no_encontrados
+    def _matricular_lote(self, matriculas, timestart):
+        payload = {}
+        for i, matricula in enumerate(matriculas):
+            for clave in ('roleid', 'userid', 'courseid'):
+                payload[f'enrolments[{i}][{clave}]'] = matricula[clave]
+            payload[f'enrolments[{i}][timestart]'] = timestart
+        return self._request_url('POST', 'enrol_manual_enrol_users', self.geo_token, payload)
+
+    def _en_paralelo(self, funcion, elementos, tamanyo=None):
+        """Aplica la función a cada lote de elementos, usando varios hilos.
+
+        Devuelve una lista de tuplas (lote, resultado, excepción), en el orden de los lotes.
+        """
+        lotes = trocear(elementos, tamanyo or self.tamanyo_lote)
+        if len(lotes) <= 1 or self.hilos <= 1:
+            return [self._ejecutar(funcion, lote) for lote in lotes]
+        with ThreadPoolExecutor(max_workers=self.hilos) as executor:
+            return list(executor.map(lambda lote: self._ejecutar(funcion, lote), lotes))
 
-    def _request_url(self, verb, wsfunction, token, data=None):  # noqa: C901
-        """Envía una petición al Web Service."""
+    def _uno_a_uno(self, funcion, elementos):
+        """Como `_en_paralelo()`, pero para funciones que reciben un solo elemento.
+
+        Devuelve una lista de tuplas (elemento, resultado, excepción).
+        """
+        return [
+            (lote[0], resultado, excepcion)
+            for lote, resultado, excepcion in self._en_paralelo(
+                lambda lote: funcion(lote[0]), elementos, tamanyo=1
+            )
+        ]
+
+    @staticmethod
+    def _ejecutar(funcion, lote):
+        try:
+            return lote, funcion(lote), None
+        except Exception as ex:
+            return lote, None, ex
+
+    def _request_url(self, verb, wsfunction, token, data=None):
+        """Envía una petición al Web Service.
+
+        Las funciones de sólo lectura se reintentan si falla la conexión o Moodle no responde,
+        esperando un tiempo aleatorio creciente entre intentos.
+        """
+        intentos = self.reintentos + 1 if wsfunction in self.funciones_idempotentes else 1
+        for intento in range(intentos):
+            self._comprobar_circuito(wsfunction)
+            try:
+                resp = self._enviar_y_medir(verb, wsfunction, token, data)
+            except Exception as ex:
+                if not self._anotar_fallo(ex) or intento + 1 == intentos:
+                    raise
+            else:
+                cortacircuitos.registrar_exito()
+                try:
+                    return self._procesar_respuesta(resp, data)
+                except Exception:
+                    metricas.registrar_error(wsfunction, 'MoodleException')
+                    raise
+
+            # "Full jitter", véase
+            # <https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/>
+            tope = min(self.espera_reintento_max, self.espera_reintento * 2**intento)
+            time.sleep(random.uniform(0, tope))
+
+    @staticmethod
+    def _anotar_fallo(ex):
+        """Anota en el circuit breaker una petición fallida, y devuelve si se puede reintentar.
+
+        La petición de prueba del circuito semiabierto siempre lo cierra o lo vuelve a abrir,
+        salvo que no haya llegado a enviarse a Moodle.
+        """
+        if isinstance(ex, MoodleSaturado):
+            cortacircuitos.cancelar_prueba()  # No se ha llegado a llamar a Moodle
+            return False
+        if isinstance(ex, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            cortacircuitos.registrar_fallo()
+            return True
+        if isinstance(ex, requests.exceptions.HTTPError):
+            codigo = ex.response.status_code
+            if codigo >= 500:
+                cortacircuitos.registrar_fallo()
+            else:
+                cortacircuitos.registrar_exito()  # Moodle responde, aunque sea un error
+            return codigo in (429, 502, 503, 504)
+        if isinstance(ex, requests.exceptions.RequestException):
+            cortacircuitos.registrar_fallo()
+        else:
+            cortacircuitos.cancelar_prueba()
+        return False
+
+    @staticmethod
+    def _comprobar_circuito(wsfunction):
+        try:
+            cortacircuitos.comprobar()
+        except MoodleNoDisponible as ex:
+            metricas.registrar_error(wsfunction, ex)
+            raise
+
+    def _enviar_y_medir(self, verb, wsfunction, token, data):
+        """Como `_enviar()`, pero esperando turno en el limitador y anotando las métricas."""
+        try:
+            with limitador.turno():
+                inicio = time.perf_counter()
+                try:
+                    resp = self._enviar(verb, wsfunction, token, data)
+                except Exception as ex:
+                    metricas.registrar(wsfunction, time.perf_counter() - inicio, data, error=ex)
+                    raise
+        except MoodleSaturado as ex:
+            metricas.registrar_error(wsfunction, ex)
+            raise
+        metricas.registrar(wsfunction, time.perf_counter() - inicio, data, respuesta=resp)
+        return resp
+
+    def _enviar(self, verb, wsfunction, token, data):  # noqa: C901
+        """Realiza una única petición HTTP al Web Service y devuelve la respuesta."""
+        url = f'{self.api_url}?wstoken={token}&wsfunction={wsfunction}&moodlewsrestformat=json'
+        timeout = self.timeouts.get(wsfunction, self.timeout)
         try:
             # https://docs.python-requests.org/en/latest/user/quickstart/#errors-and-exceptions
             if verb == 'POST':
-                resp = requests.post(
-                    f'{self.api_url}?wstoken={token}&wsfunction={wsfunction}'
-                    '&moodlewsrestformat=json',
-                    data=data,
-                )
+                resp = self.sesion.post(url, data=data, timeout=timeout)
                 resp.raise_for_status()
 
             elif verb == 'GET':
-                resp = requests.get(
-                    f'{self.api_url}?wstoken={token}&wsfunction={wsfunction}'
-                    '&moodlewsrestformat=json',
-                    params=data,
-                )
+                resp = self.sesion.get(url, params=data, timeout=timeout)
                 resp.raise_for_status()
 
             else:
@@ -262,13 +773,16 @@ class WSClient:
         except requests.exceptions.ConnectionError:
             raise requests.exceptions.ConnectionError('No fue posible conectar con Moodle')
         except requests.exceptions.HTTPError as err:
-            # print(repr(sys.exc_info()))
-            # print(repr(sys.exc_info()[0]))  # str
-            print(err.response.status_code)
-            print(err.response.text)
+            logger.warning(
+                'Moodle devolvió el código HTTP %s en %s: %s',
+                err.response.status_code,
+                wsfunction,
+                err.response.text,
+            )
             raise requests.exceptions.HTTPError(
                 _('Moodle devolvió un código de estado HTTP sin éxito (%(code)s')
-                % {'code': err.response.status_code}
+                % {'code': err.response.status_code},
+                response=err.response,
             )
         except requests.exceptions.Timeout:
             raise requests.exceptions.Timeout('Moodle no respondió')
@@ -280,6 +794,11 @@ class WSClient:
                 % {'info': sys.exc_info()[0]}
             )
 
+        return resp
+
+    @staticmethod
+    def _procesar_respuesta(resp, data):
+        """Decodifica la respuesta JSON de Moodle, lanzando una excepción si contiene un error."""
         try:
             received_data = json.loads(resp.content.decode('utf-8'))
         except json.JSONDecodeError:
@@ -289,8 +808,7 @@ class WSClient:
             )
 
         if isinstance(received_data, dict) and received_data.get('exception', None):
-            print('DATA:', repr(data))
-            print('RECEIVED DATA:', repr(received_data))
+            logger.warning('Moodle rechazó la petición %r: %r', data, received_data)
             raise Exception(received_data.get('message'))
 
         return received_data
@@ -68,6 +68,21 @@ DATABASES = {
 # https://docs.djangoproject.com/en/3.2/releases/3.2/#customizing-type-of-auto-created-primary-keys
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
+# CACHES
+# ------------------------------------------------------------------------------
+# https://docs.djangoproject.com/en/dev/ref/settings/#caches
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Correspondencia NIP → usuario de Moodle, compartida por todos los procesos.
+    'moodle': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CACHE_MOODLE_DIR', '/tmp/geoda_cache_moodle'),
+        'OPTIONS': {'MAX_ENTRIES': 200_000},
+    },
+}
+
 # URLS
 # ------------------------------------------------------------------------------
 # https://docs.djangoproject.com/en/dev/ref/settings/#root-urlconf
@@ -322,6 +337,61 @@ URL_PLATAFORMA = os.environ.get("URL_PLATAFORMA")
 GEO_TOKEN = os.environ.get("GEO_TOKEN")
 GEODAWS_TOKEN = os.environ.get("GEODAWS_TOKEN")
 API_URL = f"{URL_PLATAFORMA}/webservice/rest/server.php"
+# Conexiones persistentes (keep-alive) con Moodle que mantiene cada proceso.
+# Véase <https://requests.readthedocs.io/en/latest/api/#requests.adapters.HTTPAdapter>
+WS_POOL_CONNECTIONS = int(os.environ.get('WS_POOL_CONNECTIONS', 4))  # Nº de hosts
+WS_POOL_MAXSIZE = int(os.environ.get('WS_POOL_MAXSIZE', 10))  # Conexiones por host
+# Tiempo máximo de espera (conexión, lectura) de las peticiones a Moodle, en segundos.
+# Se puede indicar otro para funciones concretas. Vg: WS_TIMEOUTS = {'core_user_get_users': 10}
+WS_TIMEOUT = (
+    float(os.environ.get('WS_TIMEOUT_CONEXION', 5)),
+    float(os.environ.get('WS_TIMEOUT_LECTURA', 30)),
+)
+# Reintentos de las funciones de sólo lectura si Moodle falla o no responde.
+WS_REINTENTOS = int(os.environ.get('WS_REINTENTOS', 3))
+# Tras este número de fallos seguidos, se deja de llamar a Moodle durante unos segundos.
+WS_CIRCUITO_UMBRAL = int(os.environ.get('WS_CIRCUITO_UMBRAL', 5))
+WS_CIRCUITO_ESPERA = int(os.environ.get('WS_CIRCUITO_ESPERA', 30))
+# Las matriculaciones masivas se envían en lotes de este tamaño, con varios hilos simultáneos.
+WS_TAMANYO_LOTE = int(os.environ.get('WS_TAMANYO_LOTE', 200))
+WS_HILOS = int(os.environ.get('WS_HILOS', 4))
+# Peticiones simultáneas a Moodle, como máximo, de cada AsyncWSClient.
+WS_CONCURRENCIA = int(os.environ.get('WS_CONCURRENCIA', 8))
+# Los usuarios matriculados en un curso se descargan de Moodle en páginas de este tamaño.
+WS_TAMANYO_PAGINA = int(os.environ.get('WS_TAMANYO_PAGINA', 1000))
+# Caché de usuarios de Moodle: nº de entradas de la caché en memoria de cada proceso,
+# y duración en segundos de las entradas (en ella y en la caché compartida `moodle`).
+CACHE_USUARIOS_TAMANYO = int(os.environ.get('CACHE_USUARIOS_TAMANYO', 20_000))
+CACHE_USUARIOS_TTL = int(os.environ.get('CACHE_USUARIOS_TTL', 7 * 24 * 3600))
+# Los usuarios no encontrados se recuerdan menos tiempo, porque se crean en Moodle cada noche.
+CACHE_USUARIOS_TTL_NEGATIVO = int(os.environ.get('CACHE_USUARIOS_TTL_NEGATIVO', 15 * 60))
+# Límite de llamadas simultáneas a Moodle, entre todos los procesos (0 para no limitarlas),
+# cuántas de ellas pueden usar las tareas por lotes y cuántos segundos se espera turno.
+WS_LIMITE_DIR = os.environ.get('WS_LIMITE_DIR', '/tmp/geoda_limitador_moodle')
+WS_LIMITE_TOTAL = int(os.environ.get('WS_LIMITE_TOTAL', 8))
+WS_LIMITE_LOTES = int(os.environ.get('WS_LIMITE_LOTES', 3))
+WS_LIMITE_ESPERA = int(os.environ.get('WS_LIMITE_ESPERA', 20))
+# Casete en el que se graban las llamadas a Moodle, o con el que se reproducen sin conectar
+# con Moodle (modos `grabar` y `reproducir`).  Véase `geo/grabacion.py`.
+WS_CASETE = os.environ.get('WS_CASETE')
+WS_CASETE_MODO = os.environ.get('WS_CASETE_MODO', 'reproducir')
+# Directorio donde los workers de uWSGI y `procesar_tareas` guardan sus métricas de Moodle,
+# para que la vista `metricas` las sume, y cada cuántos segundos las guarda.
+METRICAS_MOODLE_DIR = os.environ.get('METRICAS_MOODLE_DIR', '/tmp/geoda_metricas_moodle')
+METRICAS_MOODLE_INTERVALO = int(os.environ.get('METRICAS_MOODLE_INTERVALO', 10))
+# Direcciones IP desde las que Prometheus puede consultar las métricas.
+METRICAS_IPS = os.environ.get('METRICAS_IPS', '127.0.0.1').split(',')
+# Códigos en Moodle de las categorías que cada año pasan a la del nuevo año académico.
+CATEGORIAS_ANUALES = os.environ.get('CATEGORIAS_ANUALES', '5047,5021').split(',')
+# Cursos que se borran en cada llamada a Moodle al borrar cursos de años pasados,
+# y segundos de pausa entre lotes, para no sobrecargar Moodle.
+TAMANYO_LOTE_BORRADO = int(os.environ.get('TAMANYO_LOTE_BORRADO', 20))
+PAUSA_BORRADO = float(os.environ.get('PAUSA_BORRADO', 2))
+# Días tras los que la matriculación nocturna vuelve a comparar con Moodle un registro
+# de matrícula automática aunque sus estudiantes en Sigma no hayan cambiado.
+MATRICULAS_RECONCILIAR_DIAS = int(os.environ.get('MATRICULAS_RECONCILIAR_DIAS', 7))
+# Segundos que se espera a que otro proceso acabe de crear las categorías de un año.
+ESPERA_BLOQUEO_CATEGORIAS = int(os.environ.get('ESPERA_BLOQUEO_CATEGORIAS', 600))
 
 # WEB SERVICE de GESTIÓN DE IDENTIDADES
 WSDL_IDENTIDAD = os.environ.get('WSDL_IDENTIDAD')
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'geoda_project.settings')
 
 application = get_wsgi_application()
+
+# Los workers de uWSGI vuelcan sus métricas de Moodle, para que la vista `metricas` las sume.
+from geo.metricas import metricas  # noqa: E402
+
+metricas.compartir()